@@ -511,7 +511,14 @@ class CloudController(object):
         db.security_group_destroy(context, security_group.id)
         return True
 
-    def get_console_output(self, context, instance_id, **kwargs):
+    def get_console_output(self, context, instance_id, since_offset=None,
+                           max_bytes=None, **kwargs):
+        """Returns the latest console output of an instance.
+
+        With since_offset, returns the output written since then instead, so
+        clients can pass the nextOffset of their last call to fetch only the
+        new output.
+        """
         LOG.audit(_("Get console output for instance %s"), instance_id,
                   context=context)
         # instance_id may be passed in as a list of instances
@@ -520,12 +527,27 @@ class CloudController(object):
         else:
             ec2_id = instance_id
         instance_id = ec2_id_to_id(ec2_id)
+        arguments = {'since_offset': since_offset, 'max_bytes': max_bytes}
+        for name, value in arguments.items():
+            if value is None:
+                continue
+            try:
+                arguments[name] = int(value)
+            except ValueError:
+                raise exception.ApiError(_('%s must be a number') % name)
+            if arguments[name] < 0:
+                raise exception.ApiError(_('%s must not be negative') % name)
+        since_offset = arguments['since_offset']
+        max_bytes = arguments['max_bytes']
         output = self.compute_api.get_console_output(
-                context, instance_id=instance_id)
+                context, instance_id=instance_id, since_offset=since_offset,
+                max_bytes=max_bytes)
         now = datetime.datetime.utcnow()
         return {"InstanceId": ec2_id,
                 "Timestamp": now,
-                "output": base64.b64encode(output)}
+                "output": base64.b64encode(output['output']),
+                "offset": output['offset'],
+                "nextOffset": output['next_offset']}
 
     def get_ajax_console(self, context, instance_id, **kwargs):
         ec2_id = instance_id[0]
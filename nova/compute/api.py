@@ -182,15 +182,17 @@ class API(base.Base):
             instance = self.update(context, instance_id, **updates)
             instances.append(instance)
 
+        if instances:
+            instance_ids = [instance['id'] for instance in instances]
             pid = context.project_id
             uid = context.user_id
             LOG.debug(_("Casting to scheduler for %(pid)s/%(uid)s's"
-                    " instance %(instance_id)s") % locals())
+                    " instances %(instance_ids)s") % locals())
             rpc.cast(context,
                      FLAGS.scheduler_topic,
-                     {"method": "run_instance",
+                     {"method": "run_instances",
                       "args": {"topic": FLAGS.compute_topic,
-                               "instance_id": instance_id,
+                               "instance_ids": instance_ids,
                                "availability_zone": availability_zone,
                                "onset_files": onset_files}})
 
@@ -286,6 +288,9 @@ class API(base.Base):
 
         """
         rv = self.db.instance_update(context, instance_id, kwargs)
+        if rv['host']:
+            self._cast_compute_message('invalidate_instance', context,
+                                       instance_id, host=rv['host'])
         return dict(rv.iteritems())
 
     def delete(self, context, instance_id):
@@ -450,11 +455,14 @@ class API(base.Base):
         return {'url': '%s?token=%s' % (FLAGS.ajax_console_proxy_url,
                 output['token'])}
 
-    def get_console_output(self, context, instance_id):
+    def get_console_output(self, context, instance_id, since_offset=None,
+                           max_bytes=None):
         """Get console output for an an instance"""
         return self._call_compute_message('get_console_output',
                                           context,
-                                          instance_id)
+                                          instance_id,
+                                          params={'since_offset': since_offset,
+                                                  'max_bytes': max_bytes})
 
     def lock(self, context, instance_id):
         """lock the instance with instance_id"""
@@ -0,0 +1,95 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Instance Cache
+
+The compute manager looks the same instance up several times per request:
+the lock check, the method itself and every state refresh each loaded the
+full record with its fixed ip, floating ips, security groups and volumes.
+:class:`InstanceCache` keeps the records of a host in memory for up to
+instance_cache_ttl seconds.  The manager applies its own writes to the
+cached record, and nova.compute.api casts invalidate_instance when the
+record is changed elsewhere, so the ttl only bounds how long changes made
+behind nova's back go unnoticed.
+
+Records are returned with the updates still pending in the
+:class:`nova.compute.state_journal.StateJournal` applied.
+"""
+
+import time
+
+from nova import flags
+from nova import log as logging
+
+
+LOG = logging.getLogger('nova.compute.instance_cache')
+FLAGS = flags.FLAGS
+flags.DEFINE_integer('instance_cache_ttl', 30,
+                     'seconds the compute manager keeps an instance record '
+                     'in memory, 0 disables the cache')
+
+
+class InstanceCache(object):
+    """Instance records of one compute host, keyed by id."""
+
+    def __init__(self, db, journal=None):
+        self.db = db
+        self.journal = journal
+        self._records = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, context, instance_id):
+        """Returns the record of instance_id, loading it if needed."""
+        entry = self._records.get(instance_id)
+        if entry and entry[0] > time.time():
+            self.hits += 1
+            instance_ref = entry[1]
+        else:
+            self.misses += 1
+            instance_ref = self.db.instance_get(context, instance_id)
+            self.put(instance_ref)
+        if self.journal:
+            for key, value in self.journal.pending(instance_id).iteritems():
+                instance_ref[key] = value
+        return instance_ref
+
+    def put(self, instance_ref):
+        """Keeps instance_ref for instance_cache_ttl seconds."""
+        if FLAGS.instance_cache_ttl > 0:
+            self._records[instance_ref['id']] = (
+                    time.time() + FLAGS.instance_cache_ttl, instance_ref)
+
+    def update(self, instance_id, values):
+        """Applies values written, or about to be, to the cached record."""
+        entry = self._records.get(instance_id)
+        if entry:
+            for key, value in values.iteritems():
+                entry[1][key] = value
+
+    def set_state(self, instance_id, state, description):
+        """Applies a state change already written to the database."""
+        self.update(instance_id, {'state': state,
+                                  'state_description': description})
+
+    def invalidate(self, instance_id=None):
+        """Drops the record of instance_id, or every record."""
+        if instance_id is None:
+            self._records.clear()
+        else:
+            self._records.pop(instance_id, None)
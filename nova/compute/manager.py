@@ -40,6 +40,10 @@ import random
 import string
 import socket
 import functools
+import time
+
+from eventlet import greenpool
+from eventlet import semaphore
 
 from nova import exception
 from nova import flags
@@ -47,7 +51,9 @@ from nova import log as logging
 from nova import manager
 from nova import rpc
 from nova import utils
+from nova.compute import instance_cache
 from nova.compute import power_state
+from nova.compute import state_journal
 
 FLAGS = flags.FLAGS
 flags.DEFINE_string('instances_path', '$state_path/instances',
@@ -61,6 +67,11 @@ flags.DEFINE_integer('password_length', 12,
 flags.DEFINE_string('console_host', socket.gethostname(),
                     'Console proxy host to use to connect to instances on'
                     'this host.')
+flags.DEFINE_integer('max_concurrent_prefetches', 1,
+                     'number of images a compute host prefetches at once')
+flags.DEFINE_integer('max_concurrent_builds', 10,
+                     'number of instances a compute host builds at once, '
+                     'further builds queue up')
 
 LOG = logging.getLogger('nova.compute.manager')
 
@@ -112,24 +123,103 @@ class ComputeManager(manager.Manager):
         self.driver = utils.import_object(compute_driver)
         self.network_manager = utils.import_object(FLAGS.network_manager)
         self.volume_manager = utils.import_object(FLAGS.volume_manager)
+        self._prefetch_semaphore = semaphore.Semaphore(
+                FLAGS.max_concurrent_prefetches)
+        self._build_semaphore = semaphore.Semaphore(
+                FLAGS.max_concurrent_builds)
+        self.builds_running = 0
+        self.builds_queued = 0
         super(ComputeManager, self).__init__(*args, **kwargs)
+        self.state_journal = state_journal.StateJournal.instance()
+        self.instance_cache = instance_cache.InstanceCache(self.db,
+                                                           self.state_journal)
 
     def init_host(self):
         """Do any initialization that needs to be run if this is a
            standalone service.
         """
+        start = time.time()
         self.driver.init_host(host=self.host)
+        LOG.info(_('Initialized host %(host)s in %(seconds).3fs'),
+                 {'host': self.host, 'seconds': time.time() - start})
+
+    def periodic_tasks(self, context=None):
+        """Tasks to be run at a periodic interval."""
+        try:
+            self.driver.manage_image_cache(context)
+        except Exception:
+            LOG.exception(_("Error managing the image cache"))
+        try:
+            self._sync_power_states(context)
+        except Exception:
+            LOG.exception(_("Error syncing instance power states"))
+
+    def _sync_power_states(self, context):
+        """Writes the power state of every instance here that changed.
+
+        The driver reports all of its instances in one call and the
+        changed rows are written in one transaction.  Instances missing
+        from the driver are marked FAILED, unless they are still being
+        built (NOSTATE).
+        """
+        self.state_journal.flush()
+        infos = self.driver.get_all_info()
+        states = {}
+        for instance in self.db.instance_get_all_by_host(context, self.host):
+            if instance['name'] in infos:
+                state = infos[instance['name']]['state']
+            elif instance['state'] == power_state.NOSTATE:
+                continue
+            else:
+                state = power_state.FAILED
+            if state != instance['state']:
+                states[instance['id']] = state
+        if states:
+            LOG.info(_("Syncing the power state of %d instances"),
+                     len(states))
+            self.db.instance_set_states(context, states)
+            for instance_id, state in states.iteritems():
+                self.instance_cache.set_state(instance_id, state,
+                                              power_state.name(state))
 
     def _update_state(self, context, instance_id):
         """Update the state of an instance from the driver info."""
         # FIXME(ja): include other fields from state?
-        instance_ref = self.db.instance_get(context, instance_id)
+        instance_ref = self.instance_cache.get(context, instance_id)
         try:
             info = self.driver.get_info(instance_ref['name'])
             state = info['state']
         except exception.NotFound:
             state = power_state.FAILED
-        self.db.instance_set_state(context, instance_id, state)
+        self._instance_set_state(context, instance_id, state)
+
+    def _instance_update(self, context, instance_id, values, flush=False):
+        """Records values for the instance in the state journal.
+
+        They are merged with the other updates of the instance unless
+        flush is set.  The cached record gets the values at once, as they
+        are no longer pending once the journal writes them.
+        """
+        self.state_journal.update(instance_id, values, flush)
+        self.instance_cache.update(instance_id, values)
+
+    def _instance_set_state(self, context, instance_id, state,
+                            description=None):
+        """Records the state of the instance, in its cached record too."""
+        if not description:
+            description = power_state.name(state)
+        self.state_journal.set_state(instance_id, state, description)
+        self.instance_cache.set_state(instance_id, state, description)
+
+    def _instance_destroy(self, context, instance_id):
+        """Destroys the instance and forgets everything kept about it."""
+        self.state_journal.discard(instance_id)
+        self.instance_cache.invalidate(instance_id)
+        self.db.instance_destroy(context, instance_id)
+
+    def invalidate_instance(self, context, instance_id):
+        """Drops the cached record of an instance changed elsewhere."""
+        self.instance_cache.invalidate(instance_id)
 
     def get_console_topic(self, context, **kwargs):
         """Retrieves the console host for a project on this host
@@ -169,31 +259,55 @@ class ComputeManager(manager.Manager):
         """This call passes straight through to the virtualization driver."""
         return self.driver.refresh_security_group_members(security_group_id)
 
+    def service_state(self):
+        """Reports how many builds are running and waiting for a slot."""
+        return {'builds_running': self.builds_running,
+                'builds_queued': self.builds_queued}
+
     @exception.wrap_exception
     def run_instance(self, context, instance_id, **kwargs):
-        """Launch a new instance with specified options."""
+        """Launch a new instance with specified options.
+
+        Waits for a build slot if max_concurrent_builds instances are
+        already being built on this host.
+        """
+        self.builds_queued += 1
+        try:
+            self._build_semaphore.acquire()
+        finally:
+            self.builds_queued -= 1
+        self.builds_running += 1
+        try:
+            return self._run_instance(context, instance_id, **kwargs)
+        finally:
+            self.builds_running -= 1
+            self._build_semaphore.release()
+
+    def _run_instance(self, context, instance_id, **kwargs):
         context = context.elevated()
+        self.instance_cache.invalidate(instance_id)
         instance_ref = self.db.instance_get(context, instance_id)
         instance_ref.onset_files = kwargs.get('onset_files', [])
         if instance_ref['name'] in self.driver.list_instances():
             raise exception.Error(_("Instance has already been created"))
         LOG.audit(_("instance %s: starting..."), instance_id,
                   context=context)
-        self.db.instance_update(context,
-                                instance_id,
-                                {'host': self.host})
+        self._instance_update(context,
+                              instance_id,
+                              {'host': self.host})
 
-        self.db.instance_set_state(context,
-                                   instance_id,
-                                   power_state.NOSTATE,
-                                   'networking')
+        self._instance_set_state(context,
+                                 instance_id,
+                                 power_state.NOSTATE,
+                                 'networking')
 
         is_vpn = instance_ref['image_id'] == FLAGS.vpn_image_id
-        # NOTE(vish): This could be a cast because we don't do anything
-        #             with the address currently, but I'm leaving it as
-        #             a call to ensure that network setup completes.  We
-        #             will eventually also need to save the address here.
-        if not FLAGS.stub_network:
+
+        def _allocate_network():
+            # NOTE(vish): This could be a cast because we don't do anything
+            #             with the address currently, but I'm leaving it as
+            #             a call to ensure that network setup completes.  We
+            #             will eventually also need to save the address here.
             address = rpc.call(context,
                                self.get_network_topic(context),
                                {"method": "allocate_fixed_ip",
@@ -203,27 +317,81 @@ class ComputeManager(manager.Manager):
             self.network_manager.setup_compute_network(context,
                                                        instance_id)
 
+        # NOTE(vish): the disks don't depend on the network, so create them
+        #             while waiting for the network host
+        stages = [('images',
+                   functools.partial(self.driver.prepare_images,
+                                     instance_ref))]
+        if not FLAGS.stub_network:
+            stages.append(('network', _allocate_network))
+        try:
+            timings = utils.run_stages(stages)
+        except Exception:
+            LOG.exception(_("instance %s: Failed to prepare"), instance_id,
+                          context=context)
+            self._instance_set_state(context,
+                                     instance_id,
+                                     power_state.SHUTDOWN)
+            raise
+        for name, seconds in timings:
+            self.db.instance_action_create(context,
+                                           {'instance_id': instance_id,
+                                            'action': 'spawn.%s %.3fs' %
+                                                      (name, seconds)})
+
         # TODO(vish) check to make sure the availability zone matches
-        self.db.instance_set_state(context,
-                                   instance_id,
-                                   power_state.NOSTATE,
-                                   'spawning')
+        self._instance_set_state(context,
+                                 instance_id,
+                                 power_state.NOSTATE,
+                                 'spawning')
 
         try:
             self.driver.spawn(instance_ref)
             now = datetime.datetime.utcnow()
-            self.db.instance_update(context,
-                                    instance_id,
-                                    {'launched_at': now})
+            self._instance_update(context,
+                                  instance_id,
+                                  {'launched_at': now})
         except Exception:  # pylint: disable-msg=W0702
             LOG.exception(_("instance %s: Failed to spawn"), instance_id,
                           context=context)
-            self.db.instance_set_state(context,
-                                       instance_id,
-                                       power_state.SHUTDOWN)
+            self._instance_set_state(context,
+                                     instance_id,
+                                     power_state.SHUTDOWN)
 
         self._update_state(context, instance_id)
 
+    def run_instances(self, context, instance_ids, **kwargs):
+        """Launch a batch of instances the scheduler placed on this host.
+
+        The instances are built concurrently, as many at once as the
+        build slots of max_concurrent_builds allow.
+        """
+        pool = greenpool.GreenPool(max(len(instance_ids), 1))
+        for instance_id in instance_ids:
+            pool.spawn_n(self._run_one_of_batch, context, instance_id,
+                         **kwargs)
+        pool.waitall()
+
+    def _run_one_of_batch(self, context, instance_id, **kwargs):
+        try:
+            self.run_instance(context, instance_id, **kwargs)
+        except Exception:  # pylint: disable-msg=W0702
+            LOG.exception(_("instance %s: Failed to run"), instance_id,
+                          context=context)
+
+    @exception.wrap_exception
+    def prefetch_image(self, context, image_id, kernel_id=None,
+                       ramdisk_id=None):
+        """Caches an image on this host ahead of its first launch here.
+
+        At most max_concurrent_prefetches images are fetched at once, the
+        rest wait their turn.
+        """
+        LOG.audit(_("Prefetching image %s"), image_id, context=context)
+        with self._prefetch_semaphore:
+            self.driver.prefetch_image(context, image_id, kernel_id,
+                                       ramdisk_id)
+
     @exception.wrap_exception
     @checks_instance_lock
     def terminate_instance(self, context, instance_id):
@@ -264,13 +432,13 @@ class ComputeManager(manager.Manager):
         for volume in volumes:
             self.detach_volume(context, instance_id, volume['id'])
         if instance_ref['state'] == power_state.SHUTOFF:
-            self.db.instance_destroy(context, instance_id)
+            self._instance_destroy(context, instance_id)
             raise exception.Error(_('trying to destroy already destroyed'
                                     ' instance: %s') % instance_id)
         self.driver.destroy(instance_ref)
 
         # TODO(ja): should we keep it in a terminated state for a bit?
-        self.db.instance_destroy(context, instance_id)
+        self._instance_destroy(context, instance_id)
 
     @exception.wrap_exception
     @checks_instance_lock
@@ -278,7 +446,7 @@ class ComputeManager(manager.Manager):
         """Reboot an instance on this server."""
         context = context.elevated()
         self._update_state(context, instance_id)
-        instance_ref = self.db.instance_get(context, instance_id)
+        instance_ref = self.instance_cache.get(context, instance_id)
         LOG.audit(_("Rebooting instance %s"), instance_id, context=context)
 
         if instance_ref['state'] != power_state.RUNNING:
@@ -289,10 +457,10 @@ class ComputeManager(manager.Manager):
                      'expected: %(running)s)') % locals(),
                      context=context)
 
-        self.db.instance_set_state(context,
-                                   instance_id,
-                                   power_state.NOSTATE,
-                                   'rebooting')
+        self._instance_set_state(context,
+                                 instance_id,
+                                 power_state.NOSTATE,
+                                 'rebooting')
         self.network_manager.setup_compute_network(context, instance_id)
         self.driver.reboot(instance_ref)
         self._update_state(context, instance_id)
@@ -301,7 +469,7 @@ class ComputeManager(manager.Manager):
     def snapshot_instance(self, context, instance_id, image_id):
         """Snapshot an instance on this server."""
         context = context.elevated()
-        instance_ref = self.db.instance_get(context, instance_id)
+        instance_ref = self.instance_cache.get(context, instance_id)
 
         #NOTE(sirp): update_state currently only refreshes the state field
         # if we add is_snapshotting, we will need this refreshed too,
@@ -324,7 +492,7 @@ class ComputeManager(manager.Manager):
     def set_admin_password(self, context, instance_id, new_pass=None):
         """Set the root/admin password for an instance on this server."""
         context = context.elevated()
-        instance_ref = self.db.instance_get(context, instance_id)
+        instance_ref = self.instance_cache.get(context, instance_id)
         instance_id = instance_ref['id']
         instance_state = instance_ref['state']
         expected_state = power_state.RUNNING
@@ -345,7 +513,7 @@ class ComputeManager(manager.Manager):
     def inject_file(self, context, instance_id, path, file_contents):
         """Write a file to the specified path on an instance on this server"""
         context = context.elevated()
-        instance_ref = self.db.instance_get(context, instance_id)
+        instance_ref = self.instance_cache.get(context, instance_id)
         instance_id = instance_ref['id']
         instance_state = instance_ref['state']
         expected_state = power_state.RUNNING
@@ -368,12 +536,12 @@ class ComputeManager(manager.Manager):
     def rescue_instance(self, context, instance_id):
         """Rescue an instance on this server."""
         context = context.elevated()
-        instance_ref = self.db.instance_get(context, instance_id)
+        instance_ref = self.instance_cache.get(context, instance_id)
         LOG.audit(_('instance %s: rescuing'), instance_id, context=context)
-        self.db.instance_set_state(context,
-                                   instance_id,
-                                   power_state.NOSTATE,
-                                   'rescuing')
+        self._instance_set_state(context,
+                                 instance_id,
+                                 power_state.NOSTATE,
+                                 'rescuing')
         self.network_manager.setup_compute_network(context, instance_id)
         self.driver.rescue(instance_ref)
         self._update_state(context, instance_id)
@@ -383,12 +551,12 @@ class ComputeManager(manager.Manager):
     def unrescue_instance(self, context, instance_id):
         """Rescue an instance on this server."""
         context = context.elevated()
-        instance_ref = self.db.instance_get(context, instance_id)
+        instance_ref = self.instance_cache.get(context, instance_id)
         LOG.audit(_('instance %s: unrescuing'), instance_id, context=context)
-        self.db.instance_set_state(context,
-                                   instance_id,
-                                   power_state.NOSTATE,
-                                   'unrescuing')
+        self._instance_set_state(context,
+                                 instance_id,
+                                 power_state.NOSTATE,
+                                 'unrescuing')
         self.driver.unrescue(instance_ref)
         self._update_state(context, instance_id)
 
@@ -402,12 +570,12 @@ class ComputeManager(manager.Manager):
     def pause_instance(self, context, instance_id):
         """Pause an instance on this server."""
         context = context.elevated()
-        instance_ref = self.db.instance_get(context, instance_id)
+        instance_ref = self.instance_cache.get(context, instance_id)
         LOG.audit(_('instance %s: pausing'), instance_id, context=context)
-        self.db.instance_set_state(context,
-                                   instance_id,
-                                   power_state.NOSTATE,
-                                   'pausing')
+        self._instance_set_state(context,
+                                 instance_id,
+                                 power_state.NOSTATE,
+                                 'pausing')
         self.driver.pause(instance_ref,
             lambda result: self._update_state_callback(self,
                                                        context,
@@ -419,12 +587,12 @@ class ComputeManager(manager.Manager):
     def unpause_instance(self, context, instance_id):
         """Unpause a paused instance on this server."""
         context = context.elevated()
-        instance_ref = self.db.instance_get(context, instance_id)
+        instance_ref = self.instance_cache.get(context, instance_id)
         LOG.audit(_('instance %s: unpausing'), instance_id, context=context)
-        self.db.instance_set_state(context,
-                                   instance_id,
-                                   power_state.NOSTATE,
-                                   'unpausing')
+        self._instance_set_state(context,
+                                 instance_id,
+                                 power_state.NOSTATE,
+                                 'unpausing')
         self.driver.unpause(instance_ref,
             lambda result: self._update_state_callback(self,
                                                        context,
@@ -434,7 +602,7 @@ class ComputeManager(manager.Manager):
     @exception.wrap_exception
     def get_diagnostics(self, context, instance_id):
         """Retrieve diagnostics for an instance on this server."""
-        instance_ref = self.db.instance_get(context, instance_id)
+        instance_ref = self.instance_cache.get(context, instance_id)
 
         if instance_ref["state"] == power_state.RUNNING:
             LOG.audit(_("instance %s: retrieving diagnostics"), instance_id,
@@ -449,11 +617,11 @@ class ComputeManager(manager.Manager):
 
         """
         context = context.elevated()
-        instance_ref = self.db.instance_get(context, instance_id)
+        instance_ref = self.instance_cache.get(context, instance_id)
         LOG.audit(_('instance %s: suspending'), instance_id, context=context)
-        self.db.instance_set_state(context, instance_id,
-                                            power_state.NOSTATE,
-                                            'suspending')
+        self._instance_set_state(context, instance_id,
+                                          power_state.NOSTATE,
+                                          'suspending')
         self.driver.suspend(instance_ref,
             lambda result: self._update_state_callback(self,
                                                        context,
@@ -468,11 +636,11 @@ class ComputeManager(manager.Manager):
 
         """
         context = context.elevated()
-        instance_ref = self.db.instance_get(context, instance_id)
+        instance_ref = self.instance_cache.get(context, instance_id)
         LOG.audit(_('instance %s: resuming'), instance_id, context=context)
-        self.db.instance_set_state(context, instance_id,
-                                            power_state.NOSTATE,
-                                            'resuming')
+        self._instance_set_state(context, instance_id,
+                                          power_state.NOSTATE,
+                                          'resuming')
         self.driver.resume(instance_ref,
             lambda result: self._update_state_callback(self,
                                                        context,
@@ -486,10 +654,11 @@ class ComputeManager(manager.Manager):
 
         """
         context = context.elevated()
-        instance_ref = self.db.instance_get(context, instance_id)
+        instance_ref = self.instance_cache.get(context, instance_id)
 
         LOG.debug(_('instance %s: locking'), instance_id, context=context)
-        self.db.instance_update(context, instance_id, {'locked': True})
+        self._instance_update(context, instance_id, {'locked': True},
+                              flush=True)
 
     @exception.wrap_exception
     def unlock_instance(self, context, instance_id):
@@ -498,10 +667,11 @@ class ComputeManager(manager.Manager):
 
         """
         context = context.elevated()
-        instance_ref = self.db.instance_get(context, instance_id)
+        instance_ref = self.instance_cache.get(context, instance_id)
 
         LOG.debug(_('instance %s: unlocking'), instance_id, context=context)
-        self.db.instance_update(context, instance_id, {'locked': False})
+        self._instance_update(context, instance_id, {'locked': False},
+                              flush=True)
 
     @exception.wrap_exception
     def get_lock(self, context, instance_id):
@@ -512,7 +682,7 @@ class ComputeManager(manager.Manager):
         context = context.elevated()
         LOG.debug(_('instance %s: getting locked state'), instance_id,
                   context=context)
-        instance_ref = self.db.instance_get(context, instance_id)
+        instance_ref = self.instance_cache.get(context, instance_id)
         return instance_ref['locked']
 
     @checks_instance_lock
@@ -528,20 +698,27 @@ class ComputeManager(manager.Manager):
         self.driver.reset_network(instance_ref)
 
     @exception.wrap_exception
-    def get_console_output(self, context, instance_id):
-        """Send the console output for an instance."""
+    def get_console_output(self, context, instance_id, since_offset=None,
+                           max_bytes=None):
+        """Send the console output for an instance.
+
+        Returns at most max_bytes of the output written since since_offset,
+        or the latest output without since_offset, as a dict of output,
+        offset and next_offset.
+        """
         context = context.elevated()
-        instance_ref = self.db.instance_get(context, instance_id)
+        instance_ref = self.instance_cache.get(context, instance_id)
         LOG.audit(_("Get console output for instance %s"), instance_id,
                   context=context)
-        return self.driver.get_console_output(instance_ref)
+        return self.driver.get_console_output(instance_ref, since_offset,
+                                              max_bytes)
 
     @exception.wrap_exception
     def get_ajax_console(self, context, instance_id):
         """Return connection information for an ajax console"""
         context = context.elevated()
         LOG.debug(_("instance %s: getting ajax console"), instance_id)
-        instance_ref = self.db.instance_get(context, instance_id)
+        instance_ref = self.instance_cache.get(context, instance_id)
 
         return self.driver.get_ajax_console(instance_ref)
 
@@ -562,6 +739,7 @@ class ComputeManager(manager.Manager):
                                     volume_id,
                                     instance_id,
                                     mountpoint)
+            self.instance_cache.invalidate(instance_id)
         except Exception as exc:  # pylint: disable-msg=W0702
             # NOTE(vish): The inline callback eats the exception info so we
             #             log the traceback here and reraise the same
@@ -592,4 +770,5 @@ class ComputeManager(manager.Manager):
                                       volume_ref['mountpoint'])
         self.volume_manager.remove_compute_volume(context, volume_id)
         self.db.volume_detached(context, volume_id)
+        self.instance_cache.invalidate(instance_id)
         return True
@@ -19,23 +19,27 @@
 """
 Instance Monitoring:
 
-    Optionally may be run on each compute node. Provides RRD
-    based statistics and graphs and makes them internally available
-    in the object store.
+    Optionally may be run on each compute node. Keeps round robin
+    statistics of the running instances in nova.compute.timeseries and
+    serves graphs of them over http, drawn when they are requested.
 """
 
 import datetime
 import os
+import threading
 import time
+from multiprocessing import pool
 
-import boto
-import boto.s3
-import rrdtool
-from twisted.internet import task
+from twisted.application import internet
 from twisted.application import service
+from twisted.internet import task
+from twisted.internet import threads
+from twisted.web import resource
+from twisted.web import server
 
 from nova import flags
 from nova import log as logging
+from nova.compute import timeseries
 from nova.virt import connection as virt_connection
 
 
@@ -46,190 +50,59 @@ flags.DEFINE_integer('monitoring_instances_step', 300,
                      'Interval of RRD updates')
 flags.DEFINE_string('monitoring_rrd_path', '$state_path/monitor/instances',
                     'Location of RRD files')
+flags.DEFINE_string('monitoring_graph_host', '127.0.0.1',
+                    'address the instance monitor serves graphs on')
+flags.DEFINE_integer('monitoring_graph_port', 8779,
+                     'port the instance monitor serves graphs on')
+flags.DEFINE_integer('monitoring_workers', 8,
+                     'number of instances whose statistics are collected '
+                     'at once')
+flags.DEFINE_integer('monitoring_devices_ttl', 600,
+                     'seconds the disks and interfaces parsed from the '
+                     'domain XML are reused')
 
 
-RRD_VALUES = {
-    'cpu': [
-        'DS:cpu:GAUGE:600:0:100',
-        'RRA:AVERAGE:0.5:1:800',
-        'RRA:AVERAGE:0.5:6:800',
-        'RRA:AVERAGE:0.5:24:800',
-        'RRA:AVERAGE:0.5:288:800',
-        'RRA:MAX:0.5:1:800',
-        'RRA:MAX:0.5:6:800',
-        'RRA:MAX:0.5:24:800',
-        'RRA:MAX:0.5:288:800',
-        ],
-    'net': [
-        'DS:rx:COUNTER:600:0:1250000',
-        'DS:tx:COUNTER:600:0:1250000',
-        'RRA:AVERAGE:0.5:1:800',
-        'RRA:AVERAGE:0.5:6:800',
-        'RRA:AVERAGE:0.5:24:800',
-        'RRA:AVERAGE:0.5:288:800',
-        'RRA:MAX:0.5:1:800',
-        'RRA:MAX:0.5:6:800',
-        'RRA:MAX:0.5:24:800',
-        'RRA:MAX:0.5:288:800',
-        ],
-    'disk': [
-        'DS:rd:COUNTER:600:U:U',
-        'DS:wr:COUNTER:600:U:U',
-        'RRA:AVERAGE:0.5:1:800',
-        'RRA:AVERAGE:0.5:6:800',
-        'RRA:AVERAGE:0.5:24:800',
-        'RRA:AVERAGE:0.5:288:800',
-        'RRA:MAX:0.5:1:800',
-        'RRA:MAX:0.5:6:800',
-        'RRA:MAX:0.5:24:800',
-        'RRA:MAX:0.5:444:800',
-        ]}
-
-
-utcnow = datetime.datetime.utcnow
+SERIES = {
+    'cpu': [('cpu', timeseries.GAUGE)],
+    'net': [('rx', timeseries.COUNTER), ('tx', timeseries.COUNTER)],
+    'disk': [('rd', timeseries.COUNTER), ('wr', timeseries.COUNTER)],
+    }
 
+GRAPHS = {
+    'cpu': {'colors': ['eacc00'], 'maximum': 100},
+    'net': {'colors': ['00ff00', '0000ff'], 'maximum': None},
+    'disk': {'colors': ['00ff00', '0000ff'], 'maximum': None},
+    }
 
-LOG = logging.getLogger('nova.compute.monitor')
+DURATIONS = {'1d': 86400, '1w': 7 * 86400, '1m': 31 * 86400}
 
 
-def update_rrd(instance, name, data):
-    """
-    Updates the specified RRD file.
-    """
-    filename = os.path.join(instance.get_rrd_path(), '%s.rrd' % name)
+utcnow = datetime.datetime.utcnow
 
-    if not os.path.exists(filename):
-        init_rrd(instance, name)
 
-    timestamp = int(time.mktime(utcnow().timetuple()))
-    rrdtool.update(filename, '%d:%s' % (timestamp, data))
+LOG = logging.getLogger('nova.compute.monitor')
 
 
-def init_rrd(instance, name):
+def open_series(instance, name):
     """
-    Initializes the specified RRD file.
+    Opens the specified series, creating it if needed.
     """
-    path = os.path.join(FLAGS.monitoring_rrd_path, instance.instance_id)
+    path = instance.get_rrd_path()
 
     if not os.path.exists(path):
         os.makedirs(path)
 
-    filename = os.path.join(path, '%s.rrd' % name)
-
-    if not os.path.exists(filename):
-        rrdtool.create(
-            filename,
-            '--step', '%d' % FLAGS.monitoring_instances_step,
-            '--start', '0',
-            *RRD_VALUES[name])
-
-
-def graph_cpu(instance, duration):
-    """
-    Creates a graph of cpu usage for the specified instance and duration.
-    """
-    path = instance.get_rrd_path()
-    filename = os.path.join(path, 'cpu-%s.png' % duration)
-
-    rrdtool.graph(
-        filename,
-        '--disable-rrdtool-tag',
-        '--imgformat', 'PNG',
-        '--width', '400',
-        '--height', '120',
-        '--start', 'now-%s' % duration,
-        '--vertical-label', '% cpu used',
-        '-l', '0',
-        '-u', '100',
-        'DEF:cpu=%s:cpu:AVERAGE' % os.path.join(path, 'cpu.rrd'),
-        'AREA:cpu#eacc00:% CPU',)
-
-    store_graph(instance.instance_id, filename)
+    return timeseries.Series(os.path.join(path, '%s.ts' % name),
+                             SERIES[name], FLAGS.monitoring_instances_step)
 
 
-def graph_net(instance, duration):
+def graph(instance, name, duration):
     """
-    Creates a graph of network usage for the specified instance and duration.
+    Returns a PNG graph of the specified series and duration.
     """
-    path = instance.get_rrd_path()
-    filename = os.path.join(path, 'net-%s.png' % duration)
-
-    rrdtool.graph(
-        filename,
-        '--disable-rrdtool-tag',
-        '--imgformat', 'PNG',
-        '--width', '400',
-        '--height', '120',
-        '--start', 'now-%s' % duration,
-        '--vertical-label', 'bytes/s',
-        '--logarithmic',
-        '--units', 'si',
-        '--lower-limit', '1000',
-        '--rigid',
-        'DEF:rx=%s:rx:AVERAGE' % os.path.join(path, 'net.rrd'),
-        'DEF:tx=%s:tx:AVERAGE' % os.path.join(path, 'net.rrd'),
-        'AREA:rx#00FF00:In traffic',
-        'LINE1:tx#0000FF:Out traffic',)
-
-    store_graph(instance.instance_id, filename)
-
-
-def graph_disk(instance, duration):
-    """
-    Creates a graph of disk usage for the specified duration.
-    """
-    path = instance.get_rrd_path()
-    filename = os.path.join(path, 'disk-%s.png' % duration)
-
-    rrdtool.graph(
-        filename,
-        '--disable-rrdtool-tag',
-        '--imgformat', 'PNG',
-        '--width', '400',
-        '--height', '120',
-        '--start', 'now-%s' % duration,
-        '--vertical-label', 'bytes/s',
-        '--logarithmic',
-        '--units', 'si',
-        '--lower-limit', '1000',
-        '--rigid',
-        'DEF:rd=%s:rd:AVERAGE' % os.path.join(path, 'disk.rrd'),
-        'DEF:wr=%s:wr:AVERAGE' % os.path.join(path, 'disk.rrd'),
-        'AREA:rd#00FF00:Read',
-        'LINE1:wr#0000FF:Write',)
-
-    store_graph(instance.instance_id, filename)
-
-
-def store_graph(instance_id, filename):
-    """
-    Transmits the specified graph file to internal object store on cloud
-    controller.
-    """
-    # TODO(devcamcar): Need to use an asynchronous method to make this
-    #       connection. If boto has some separate method that generates
-    #       the request it would like to make and another method to parse
-    #       the response we can make our own client that does the actual
-    #       request and hands it off to the response parser.
-    s3 = boto.s3.connection.S3Connection(
-        aws_access_key_id=FLAGS.aws_access_key_id,
-        aws_secret_access_key=FLAGS.aws_secret_access_key,
-        is_secure=False,
-        calling_format=boto.s3.connection.OrdinaryCallingFormat(),
-        port=FLAGS.s3_port,
-        host=FLAGS.s3_host)
-    bucket_name = '_%s.monitor' % instance_id
-
-    # Object store isn't creating the bucket like it should currently
-    # when it is first requested, so have to catch and create manually.
-    try:
-        bucket = s3.get_bucket(bucket_name)
-    except Exception:
-        bucket = s3.create_bucket(bucket_name)
-
-    key = boto.s3.Key(bucket)
-    key.key = os.path.basename(filename)
-    key.set_contents_from_filename(filename)
+    _seconds, points = instance.series[name].fetch(
+            time.time() - DURATIONS[duration])
+    return timeseries.render_png(points, **GRAPHS[name])
 
 
 class Instance(object):
@@ -239,10 +112,10 @@ class Instance(object):
         self.last_updated = datetime.datetime.min
         self.cputime = 0
         self.cputime_last_updated = None
-
-        init_rrd(self, 'cpu')
-        init_rrd(self, 'net')
-        init_rrd(self, 'disk')
+        self.devices = None
+        self.devices_expire = 0
+        self.series = dict((name, open_series(self, name))
+                           for name in SERIES)
 
     def needs_update(self):
         """
@@ -251,64 +124,81 @@ class Instance(object):
         delta = utcnow() - self.last_updated
         return delta.seconds >= FLAGS.monitoring_instances_step
 
-    def update(self):
+    def collect(self, conn=None):
         """
-        Updates the instances statistics and stores the resulting graphs
-        in the internal object store on the cloud controller.
+        Returns the raw counters of this instance, in a single call to conn
+        or to the connection of the instance.  Runs in a worker thread of
+        the monitor.
+
+        The disks and interfaces come from the domain XML, which is only
+        parsed again once monitoring_devices_ttl passed or when fetching
+        the counters failed.
+        """
+        conn = conn or self.conn
+        if self.devices is None or time.time() > self.devices_expire:
+            self.devices = conn.get_devices(self.instance_id)
+            self.devices_expire = time.time() + FLAGS.monitoring_devices_ttl
+        try:
+            stats = conn.get_instance_stats(self.instance_id,
+                                            **self.devices)
+        except Exception:
+            self.devices = None
+            raise
+        stats['timestamp'] = time.time()
+        return stats
+
+    def update(self, stats=None):
+        """
+        Updates the instances statistics from stats, or from freshly
+        collected ones.
         """
         LOG.debug(_('updating %s...'), self.instance_id)
 
         try:
-            data = self.fetch_cpu_stats()
+            if stats is None:
+                stats = self.collect()
+
+            data = self.fetch_cpu_stats(stats)
             if data != None:
                 LOG.debug('CPU: %s', data)
-                update_rrd(self, 'cpu', data)
+                self.series['cpu'].update([data], stats['timestamp'])
 
-            data = self.fetch_net_stats()
+            data = self.fetch_net_stats(stats)
             LOG.debug('NET: %s', data)
-            update_rrd(self, 'net', data)
+            self.series['net'].update(data, stats['timestamp'])
 
-            data = self.fetch_disk_stats()
+            data = self.fetch_disk_stats(stats)
             LOG.debug('DISK: %s', data)
-            update_rrd(self, 'disk', data)
-
-            # TODO(devcamcar): Turn these into pool.ProcessPool.execute() calls
-            # and make the methods @defer.inlineCallbacks.
-            graph_cpu(self, '1d')
-            graph_cpu(self, '1w')
-            graph_cpu(self, '1m')
-
-            graph_net(self, '1d')
-            graph_net(self, '1w')
-            graph_net(self, '1m')
-
-            graph_disk(self, '1d')
-            graph_disk(self, '1w')
-            graph_disk(self, '1m')
+            self.series['disk'].update(data, stats['timestamp'])
         except Exception:
             LOG.exception(_('unexpected error during update'))
 
         self.last_updated = utcnow()
 
+    def close(self):
+        """
+        Closes the series files of this instance.
+        """
+        for series in self.series.values():
+            series.close()
+
     def get_rrd_path(self):
         """
-        Returns the path to where RRD files are stored.
+        Returns the path to where the series files are stored.
         """
         return os.path.join(FLAGS.monitoring_rrd_path, self.instance_id)
 
-    def fetch_cpu_stats(self):
+    def fetch_cpu_stats(self, stats):
         """
         Returns cpu usage statistics for this instance.
         """
-        info = self.conn.get_info(self.instance_id)
-
         # Get the previous values.
         cputime_last = self.cputime
         cputime_last_updated = self.cputime_last_updated
 
         # Get the raw CPU time used in nanoseconds.
-        self.cputime = float(info['cpu_time'])
-        self.cputime_last_updated = utcnow()
+        self.cputime = float(stats['cpu_time'])
+        self.cputime_last_updated = stats['timestamp']
 
         LOG.debug('CPU: %d', self.cputime)
 
@@ -317,8 +207,7 @@ class Instance(object):
             return None
 
         # Calculate the number of seconds between samples.
-        d = self.cputime_last_updated - cputime_last_updated
-        t = d.days * 86400 + d.seconds
+        t = self.cputime_last_updated - cputime_last_updated
 
         LOG.debug('t = %d', t)
 
@@ -328,64 +217,82 @@ class Instance(object):
         LOG.debug('cputime_delta = %s', cputime_delta)
 
         # Get the number of virtual cpus in this domain.
-        vcpus = int(info['num_cpu'])
+        vcpus = int(stats['num_cpu'])
 
         LOG.debug('vcpus = %d', vcpus)
 
         # Calculate CPU % used and cap at 100.
         return min(cputime_delta / (t * vcpus * 1.0e9) * 100, 100)
 
-    def fetch_disk_stats(self):
+    def fetch_disk_stats(self, stats):
         """
         Returns disk usage statistics for this instance.
         """
         rd = 0
         wr = 0
 
-        disks = self.conn.get_disks(self.instance_id)
-
         # Aggregate the read and write totals.
-        for disk in disks:
-            try:
-                rd_req, rd_bytes, wr_req, wr_bytes, errs = \
-                    self.conn.block_stats(self.instance_id, disk)
-                rd += rd_bytes
-                wr += wr_bytes
-            except TypeError:
-                iid = self.instance_id
-                LOG.error(_('Cannot get blockstats for "%(disk)s"'
-                        ' on "%(iid)s"') % locals())
-                raise
-
-        return '%d:%d' % (rd, wr)
-
-    def fetch_net_stats(self):
+        for rd_req, rd_bytes, wr_req, wr_bytes, errs in \
+                stats['disks'].values():
+            rd += rd_bytes
+            wr += wr_bytes
+
+        return rd, wr
+
+    def fetch_net_stats(self, stats):
         """
         Returns network usage statistics for this instance.
         """
         rx = 0
         tx = 0
 
-        interfaces = self.conn.get_interfaces(self.instance_id)
-
         # Aggregate the in and out totals.
-        for interface in interfaces:
-            try:
-                stats = self.conn.interface_stats(self.instance_id, interface)
-                rx += stats[0]
-                tx += stats[4]
-            except TypeError:
-                iid = self.instance_id
-                LOG.error(_('Cannot get ifstats for "%(interface)s"'
-                        ' on "%(iid)s"') % locals())
-                raise
+        for interface_stats in stats['interfaces'].values():
+            rx += interface_stats[0]
+            tx += interface_stats[4]
+
+        return rx, tx
 
-        return '%d:%d' % (rx, tx)
+
+_threads = threading.local()
+
+
+def _thread_connection():
+    """
+    Returns the read only connection of the calling thread, opening it on
+    first use.
+
+    The monitor runs no eventlet hub, so the driver is asked to call
+    libvirt directly from this thread instead of going through tpool.
+    """
+    conn = getattr(_threads, 'conn', None)
+    if conn is None:
+        conn = virt_connection.get_connection(read_only=True)
+        conn.use_tpool = False
+        _threads.conn = conn
+    return conn
+
+
+def _collect(instance):
+    """
+    Collects the counters of instance in a worker thread, returning None
+    instead of raising so one broken domain does not stop the others.
+    """
+    try:
+        return instance.collect(_thread_connection())
+    except Exception:
+        LOG.exception(_('Cannot collect statistics of %s'),
+                      instance.instance_id)
 
 
 class InstanceMonitor(object, service.Service):
     """
     Monitors the running instances of the current machine.
+
+    The counters of all the instances due for an update are collected
+    concurrently by monitoring_workers threads, so a slow domain only
+    delays itself, and the duration of every cycle is kept in the
+    cycle series next to the instance directories.
     """
 
     def __init__(self):
@@ -393,6 +300,9 @@ class InstanceMonitor(object, service.Service):
         Initialize the monitoring loop.
         """
         self._instances = {}
+        self._pool = None
+        self._cycles = None
+        self.last_cycle_duration = None
         self._loop = task.LoopingCall(self.updateInstances)
 
     def startService(self):
@@ -402,33 +312,104 @@ class InstanceMonitor(object, service.Service):
 
     def stopService(self):
         self._loop.stop()
+        if self._pool:
+            self._pool.close()
+            self._pool = None
+        for instance in self._instances.values():
+            instance.close()
+        self._instances = {}
         service.Service.stopService(self)
 
     def updateInstances(self):
         """
         Update resource usage for all running instances.
+
+        The update runs in a thread, the loop waits for the returned
+        deferred before starting the next cycle.
         """
+        d = threads.deferToThread(self._updateCycle)
+        d.addErrback(lambda failure: LOG.error('updateInstances_: %s',
+                                               failure.getTraceback()))
+        return d
+
+    def _updateCycle(self):
         try:
-            conn = virt_connection.get_connection(read_only=True)
+            conn = _thread_connection()
+            domain_ids = conn.list_instances()
         except Exception, exn:
             LOG.exception(_('unexpected exception getting connection'))
-            time.sleep(FLAGS.monitoring_instances_delay)
+            _threads.conn = None
             return
 
-        domain_ids = conn.list_instances()
-        try:
-            self.updateInstances_(conn, domain_ids)
-        except Exception, exn:
-            LOG.exception('updateInstances_')
+        self.updateInstances_(conn, domain_ids)
 
     def updateInstances_(self, conn, domain_ids):
+        start = time.time()
+        for domain_id in self._instances.keys():
+            if not domain_id in domain_ids:
+                self._instances.pop(domain_id).close()
+                LOG.debug(_('Instance gone: %s'), domain_id)
         for domain_id in domain_ids:
             if not domain_id in self._instances:
                 instance = Instance(conn, domain_id)
                 self._instances[domain_id] = instance
                 LOG.debug(_('Found instance: %s'), domain_id)
 
-        for key in self._instances.keys():
-            instance = self._instances[key]
-            if instance.needs_update():
-                instance.update()
+        due = [instance for instance in self._instances.values()
+               if instance.needs_update()]
+        if not due:
+            return
+        if self._pool is None:
+            self._pool = pool.ThreadPool(FLAGS.monitoring_workers)
+        for instance, stats in zip(due, self._pool.map(_collect, due)):
+            if stats is not None:
+                instance.update(stats)
+
+        self.last_cycle_duration = time.time() - start
+        if self._cycles is None:
+            if not os.path.exists(FLAGS.monitoring_rrd_path):
+                os.makedirs(FLAGS.monitoring_rrd_path)
+            self._cycles = timeseries.Series(
+                    os.path.join(FLAGS.monitoring_rrd_path, 'cycle.ts'),
+                    [('seconds', timeseries.GAUGE)],
+                    FLAGS.monitoring_instances_step)
+        self._cycles.update([self.last_cycle_duration])
+        LOG.debug(_('Updated %(count)d instances in %(seconds).3fs'),
+                  {'count': len(due), 'seconds': self.last_cycle_duration})
+
+
+class GraphResource(resource.Resource):
+    """
+    Serves /<instance_id>/<series>-<duration>.png, for example
+    /instance-00000001/cpu-1d.png, drawn on request.
+    """
+
+    isLeaf = True
+
+    def __init__(self, monitor):
+        resource.Resource.__init__(self)
+        self.monitor = monitor
+
+    def render_GET(self, request):  # pylint: disable-msg=C0103
+        try:
+            instance_id, filename = request.postpath
+            basename, extension = filename.split('.')
+            if extension != 'png':
+                raise ValueError(filename)
+            name, duration = basename.split('-')
+            instance = self.monitor._instances[instance_id]
+            png = graph(instance, name, duration)
+        except (KeyError, ValueError):
+            request.setResponseCode(404)
+            return ''
+        request.setHeader('Content-Type', 'image/png')
+        return png
+
+
+def graph_service(monitor):
+    """
+    Returns the service serving the graphs of monitor.
+    """
+    site = server.Site(GraphResource(monitor))
+    return internet.TCPServer(FLAGS.monitoring_graph_port, site,
+                              interface=FLAGS.monitoring_graph_host)
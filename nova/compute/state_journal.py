@@ -0,0 +1,139 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+State Journal
+
+Booting an instance used to write its row once for every step: the host,
+networking, spawning, launching, launched_at and the final state, plus one
+write per poll while waiting for the boot.  The compute manager and the
+virt drivers now record those writes in the :class:`StateJournal` of the
+process, which merges the values recorded for an instance and writes them
+in a single UPDATE state_flush_interval seconds after the first one.
+
+Recording a settled power state, anything but NOSTATE, writes the merged
+values at once, so the end of an operation is never delayed.  Readers in
+the same process see the pending values through
+:class:`nova.compute.instance_cache.InstanceCache`.
+"""
+
+from eventlet import greenthread
+
+from nova import context
+from nova import db
+from nova import exception
+from nova import flags
+from nova import log as logging
+from nova.compute import power_state
+
+
+LOG = logging.getLogger('nova.compute.state_journal')
+FLAGS = flags.FLAGS
+flags.DEFINE_float('state_flush_interval', 0.5,
+                   'seconds an instance update may wait to be merged with '
+                   'the following ones, 0 writes every update at once')
+
+
+class StateJournal(object):
+    """Write behind buffer of instance updates, keyed by instance id."""
+
+    def __init__(self):
+        self._pending = {}
+        self._timer = None
+        self.updates = 0
+        self.writes = 0
+
+    @classmethod
+    def instance(cls):
+        if not hasattr(cls, '_instance'):
+            cls._instance = cls()
+        return cls._instance
+
+    def update(self, instance_id, values, flush=False):
+        """Records values for the instance.
+
+        The values are written at once if flush is set, if they hold a
+        settled state or if state_flush_interval is 0.
+        """
+        self.updates += 1
+        self._pending.setdefault(instance_id, {}).update(values)
+        state = values.get('state', power_state.NOSTATE)
+        if (flush or state != power_state.NOSTATE or
+            FLAGS.state_flush_interval <= 0):
+            self.flush(instance_id)
+        else:
+            self._schedule(FLAGS.state_flush_interval)
+
+    def set_state(self, instance_id, state, description=None):
+        """Records the state of the instance."""
+        if not description:
+            description = power_state.name(state)
+        self.update(instance_id, {'state': state,
+                                  'state_description': description})
+
+    def pending(self, instance_id):
+        """Returns the values recorded but not yet written."""
+        return self._pending.get(instance_id, {})
+
+    def discard(self, instance_id):
+        """Forgets the pending values of an instance being destroyed."""
+        self._pending.pop(instance_id, None)
+
+    def _schedule(self, seconds):
+        if self._timer is None:
+            self._timer = greenthread.spawn_after(seconds, self._flush_all)
+
+    def _flush_all(self):
+        self._timer = None
+        self.flush()
+
+    def flush(self, instance_id=None):
+        """Writes the pending values of instance_id, or of every instance.
+
+        Values that fail to be written stay pending, unless the instance
+        is gone.
+        """
+        if instance_id is None:
+            instance_ids = self._pending.keys()
+        else:
+            instance_ids = [instance_id]
+        admin_context = context.get_admin_context()
+        for instance_id in instance_ids:
+            values = self._pending.pop(instance_id, None)
+            if not values:
+                continue
+            try:
+                db.instance_update(admin_context, instance_id, values)
+                self.writes += 1
+            except exception.NotFound:
+                LOG.debug(_('instance %s: gone, dropping its pending '
+                            'updates'), instance_id)
+            except Exception:
+                LOG.exception(_('instance %s: failed to write its state, '
+                                'will retry'), instance_id)
+                values.update(self._pending.get(instance_id, {}))
+                self._pending[instance_id] = values
+        if self._timer is not None and not self._pending:
+            self._timer.cancel()
+            self._timer = None
+        elif self._pending:
+            self._schedule(max(FLAGS.state_flush_interval, 1.0))
+
+
+def set_state(instance_id, state, description=None):
+    """Records the state of an instance in the journal of the process."""
+    StateJournal.instance().set_state(instance_id, state, description)
@@ -0,0 +1,230 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Time Series
+
+Round robin storage for the statistics of the instance monitor.  A
+:class:`Series` lives in one fixed size file mapped into memory, so an
+update is a handful of stores into the mapping rather than a call to
+rrdtool.
+
+The file holds several tiers of rows.  A tier of (steps, rows) sums up
+steps samples in each row and keeps the latest rows rows, overwriting the
+oldest, so recent samples keep their full resolution and older ones are
+downsampled.  Every row remembers which interval it holds, so rows left
+over from an earlier lap of the ring are never mistaken for fresh ones.
+
+:func:`render_png` draws fetched points as a small PNG without any
+graphics library.
+"""
+
+import math
+import mmap
+import os
+import struct
+import time
+import zlib
+
+from nova import log as logging
+
+
+LOG = logging.getLogger('nova.compute.timeseries')
+
+MAGIC = 'NOVATS01'
+GAUGE = 'gauge'
+COUNTER = 'counter'
+
+# NOTE(vish): the same tiers as the RRAs the monitor used to create, about
+#             3 days, 2 weeks, 2 months and 2 years at a 300 second step
+TIERS = ((1, 800), (6, 800), (24, 800), (288, 800))
+
+_HEADER = struct.Struct('<8sIII')
+_TIER = struct.Struct('<II')
+
+
+class Series(object):
+    """A round robin series of samples of one or more sources.
+
+    sources is a list of (name, kind) where kind is GAUGE for values that
+    are stored as given or COUNTER for ever growing totals that are stored
+    as a rate per second.
+    """
+
+    def __init__(self, path, sources, step, tiers=TIERS):
+        self.path = path
+        self.names = [name for name, _kind in sources]
+        self.kinds = [kind for _name, kind in sources]
+        self.step = step
+        self.tiers = tiers
+        count = len(sources)
+        self._state = struct.Struct('<d' + 'd' * count)
+        self._row = struct.Struct('<q' + 'ddd' * count)
+        header = (_HEADER.pack(MAGIC, step, count, len(tiers)) +
+                  ''.join(_TIER.pack(*tier) for tier in tiers))
+        self._state_offset = len(header)
+        self._offsets = []
+        offset = self._state_offset + self._state.size
+        for _steps, rows in tiers:
+            self._offsets.append(offset)
+            offset += rows * self._row.size
+        self._file = self._open(header, offset)
+        self._map = mmap.mmap(self._file.fileno(), offset)
+
+    def _open(self, header, size):
+        if os.path.exists(self.path) and os.path.getsize(self.path) == size:
+            f = open(self.path, 'r+b')
+            if f.read(len(header)) == header:
+                return f
+            f.close()
+        if os.path.exists(self.path):
+            LOG.warn(_('Recreating %s, its layout changed'), self.path)
+        empty_row = self._row.pack(-1, *([0.0] * (self._row.size / 8 - 1)))
+        f = open(self.path, 'w+b')
+        f.write(header)
+        f.write(self._state.pack(0.0, *([float('nan')] * len(self.names))))
+        for _steps, rows in self.tiers:
+            f.write(empty_row * rows)
+        f.flush()
+        return f
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def update(self, values, timestamp=None):
+        """Adds a sample of every source, None where one is unknown.
+
+        Samples not newer than the last one are ignored.  Returns whether
+        the sample was stored.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        state = self._state.unpack_from(self._map, self._state_offset)
+        last_update, last_values = state[0], state[1:]
+        if timestamp <= last_update:
+            return False
+        rates = []
+        for kind, value, last in zip(self.kinds, values, last_values):
+            if value is None:
+                rates.append(None)
+            elif kind == GAUGE:
+                rates.append(float(value))
+            elif math.isnan(last) or value < last:
+                rates.append(None)
+            else:
+                rates.append((value - last) / (timestamp - last_update))
+        kept = [last if value is None else float(value)
+                for value, last in zip(values, last_values)]
+        self._state.pack_into(self._map, self._state_offset, timestamp,
+                              *kept)
+
+        sample = int(timestamp // self.step)
+        for (steps, rows), offset in zip(self.tiers, self._offsets):
+            interval = sample // steps
+            position = offset + (interval % rows) * self._row.size
+            row = list(self._row.unpack_from(self._map, position))
+            if row[0] != interval:
+                row = [interval] + [0.0] * (len(row) - 1)
+            for i, rate in enumerate(rates):
+                if rate is None:
+                    continue
+                count, total, peak = row[1 + 3 * i:4 + 3 * i]
+                if count:
+                    peak = max(peak, rate)
+                else:
+                    peak = rate
+                row[1 + 3 * i:4 + 3 * i] = [count + 1, total + rate, peak]
+            self._row.pack_into(self._map, position, *row)
+        return True
+
+    def fetch(self, start, end=None, peak=False):
+        """Returns the samples between start and end.
+
+        Uses the finest tier that reaches back to start.  Returns the
+        seconds per point and a list of (timestamp, values) where values
+        holds the average, or the maximum if peak is set, of each source
+        or None where nothing was recorded.
+        """
+        if end is None:
+            end = time.time()
+        for (steps, rows), offset in zip(self.tiers, self._offsets):
+            if steps * rows * self.step >= end - start:
+                break
+        seconds = steps * self.step
+        last = int(end // seconds)
+        first = max(int(start // seconds), last - rows + 1)
+        points = []
+        for interval in xrange(first, last + 1):
+            position = offset + (interval % rows) * self._row.size
+            row = self._row.unpack_from(self._map, position)
+            values = []
+            for i in xrange(len(self.names)):
+                count, total, highest = row[1 + 3 * i:4 + 3 * i]
+                if row[0] != interval or not count:
+                    values.append(None)
+                elif peak:
+                    values.append(highest)
+                else:
+                    values.append(total / count)
+            points.append((interval * seconds, values))
+        return seconds, points
+
+
+def _png_chunk(kind, data):
+    return (struct.pack('>I', len(data)) + kind + data +
+            struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+
+def render_png(points, colors, width=400, height=120, maximum=None):
+    """Draws points returned by :meth:`Series.fetch` as a PNG.
+
+    The first source is drawn as a filled area and the others as lines,
+    each in the matching 'rrggbb' of colors.  The vertical axis goes from
+    0 to maximum, or to the largest value when maximum is None.
+    """
+    colors = [color.decode('hex') for color in colors]
+    if maximum is None:
+        maximum = max([value for _timestamp, values in points
+                       for value in values if value] or [1.0])
+    pixels = [bytearray('\xff\xff\xff' * width) for _y in xrange(height)]
+    previous = [None] * len(colors)
+    for x in xrange(width):
+        if not points:
+            break
+        values = points[x * len(points) // width][1]
+        for i, value in enumerate(values):
+            if value is None:
+                previous[i] = None
+                continue
+            y = height - 1 - int(min(value, maximum) * (height - 1) /
+                                 maximum)
+            if i == 0:
+                top, bottom = y, height - 1
+            elif previous[i] is None:
+                top, bottom = y, y
+            else:
+                top, bottom = min(y, previous[i]), max(y, previous[i])
+            for row in xrange(top, bottom + 1):
+                pixels[row][3 * x:3 * x + 3] = colors[i]
+            previous[i] = y
+    data = ''.join('\0' + str(row) for row in pixels)
+    return ('\x89PNG\r\n\x1a\n' +
+            _png_chunk('IHDR', struct.pack('>IIBBBBB', width, height,
+                                           8, 2, 0, 0, 0)) +
+            _png_chunk('IDAT', zlib.compress(data)) +
+            _png_chunk('IEND', ''))
@@ -71,6 +71,11 @@ class NoMoreTargets(exception.Error):
     """No more available blades"""
     pass
 
+
+class HostClaimConflict(exception.Error):
+    """Another scheduler claimed the host since it was read."""
+    pass
+
 ###################
 
 
@@ -108,6 +113,16 @@ def service_get_all_compute_sorted(context):
     return IMPL.service_get_all_compute_sorted(context)
 
 
+def service_get_all_compute_usage(context):
+    """Get all compute services along with the resources consumed on them.
+
+    Disabled services are included so callers can filter them themselves.
+    Returns a list of (Service, vcpus, memory_mb, local_gb) tuples.
+
+    """
+    return IMPL.service_get_all_compute_usage(context)
+
+
 def service_get_all_network_sorted(context):
     """Get all network services sorted by network count.
 
@@ -145,6 +160,18 @@ def service_update(context, service_id, values):
     return IMPL.service_update(context, service_id, values)
 
 
+def service_report_heartbeats(context, counts, states=None):
+    """Record heartbeats for many services in a single transaction.
+
+    counts is a dict mapping each service id to the number of heartbeats
+    received from it; report_count is bumped by that much and updated_at
+    is set to now.  states optionally maps service ids to the latest
+    values they reported.  Services that no longer exist are skipped.
+
+    """
+    return IMPL.service_report_heartbeats(context, counts, states)
+
+
 ###################
 
 
@@ -370,6 +397,17 @@ def instance_get_all_by_reservation(context, reservation_id):
     return IMPL.instance_get_all_by_reservation(context, reservation_id)
 
 
+def instance_get_popular_images(context, limit):
+    """Get the limit most launched image, kernel and ramdisk combinations.
+
+    Deleted instances count as launches too.  Each result is a dict with
+    image_id, kernel_id, ramdisk_id, launches and the user_id and
+    project_id of the latest instance launched from it.
+
+    """
+    return IMPL.instance_get_popular_images(context, limit)
+
+
 def instance_get_fixed_address(context, instance_id):
     """Get the fixed ip address of an instance."""
     return IMPL.instance_get_fixed_address(context, instance_id)
@@ -399,6 +437,27 @@ def instance_set_state(context, instance_id, state, description=None):
     return IMPL.instance_set_state(context, instance_id, state, description)
 
 
+def instance_set_states(context, states):
+    """Set the state of many instances in a single transaction.
+
+    states is a dict mapping instance ids to their new power state.
+
+    """
+    return IMPL.instance_set_states(context, states)
+
+
+def instance_claim_host(context, host, generation, instance_ids):
+    """Assign instances to a compute host if nobody else claimed it first.
+
+    generation is the claim_generation of the host's compute service as
+    seen by the caller.  It is bumped by every successful claim, so a
+    caller working from a stale view gets HostClaimConflict and should
+    reload the host before retrying.
+
+    """
+    return IMPL.instance_claim_host(context, host, generation, instance_ids)
+
+
 def instance_update(context, instance_id, values):
     """Set the given properties on an instance and update it.
 
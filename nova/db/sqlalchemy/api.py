@@ -28,6 +28,7 @@ from nova import flags
 from nova import utils
 from nova.db.sqlalchemy import models
 from nova.db.sqlalchemy.session import get_session
+from sqlalchemy import desc
 from sqlalchemy import or_
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import joinedload
@@ -203,6 +204,29 @@ def service_get_all_compute_sorted(context):
                                                label)
 
 
+@require_admin_context
+def service_get_all_compute_usage(context):
+    session = get_session()
+    with session.begin():
+        subq = session.query(models.Instance.host,
+                             func.sum(models.Instance.vcpus).label('vcpus'),
+                             func.sum(models.Instance.memory_mb).\
+                                  label('memory_mb'),
+                             func.sum(models.Instance.local_gb).\
+                                  label('local_gb')).\
+                       filter_by(deleted=False).\
+                       group_by(models.Instance.host).\
+                       subquery()
+        return session.query(models.Service,
+                             func.coalesce(subq.c.vcpus, 0),
+                             func.coalesce(subq.c.memory_mb, 0),
+                             func.coalesce(subq.c.local_gb, 0)).\
+                       filter_by(topic='compute').\
+                       filter_by(deleted=False).\
+                       outerjoin((subq, models.Service.host == subq.c.host)).\
+                       all()
+
+
 @require_admin_context
 def service_get_all_network_sorted(context):
     session = get_session()
@@ -273,6 +297,27 @@ def service_update(context, service_id, values):
         service_ref.save(session=session)
 
 
+@require_admin_context
+def service_report_heartbeats(context, counts, states=None):
+    by_count = {}
+    for service_id, count in counts.iteritems():
+        by_count.setdefault(count, []).append(service_id)
+    session = get_session()
+    with session.begin():
+        now = datetime.datetime.utcnow()
+        for count, service_ids in by_count.iteritems():
+            session.query(models.Service).\
+                    filter(models.Service.id.in_(service_ids)).\
+                    update({'report_count': models.Service.report_count +
+                                            count,
+                            'updated_at': now},
+                           synchronize_session=False)
+        for service_id, state in (states or {}).iteritems():
+            session.query(models.Service).\
+                    filter_by(id=service_id).\
+                    update(state, synchronize_session=False)
+
+
 ###################
 
 
@@ -784,6 +829,36 @@ def instance_get_all_by_project(context, project_id):
                    all()
 
 
+@require_admin_context
+def instance_get_popular_images(context, limit):
+    session = get_session()
+    launches = func.count(models.Instance.id).label('launches')
+    rows = session.query(models.Instance.image_id,
+                         models.Instance.kernel_id,
+                         models.Instance.ramdisk_id,
+                         launches,
+                         func.max(models.Instance.id)).\
+                   group_by(models.Instance.image_id,
+                            models.Instance.kernel_id,
+                            models.Instance.ramdisk_id).\
+                   order_by(desc(launches)).\
+                   limit(limit).\
+                   all()
+    result = []
+    for image_id, kernel_id, ramdisk_id, count, latest_id in rows:
+        user_id, project_id = session.query(models.Instance.user_id,
+                                            models.Instance.project_id).\
+                                      filter_by(id=latest_id).\
+                                      one()
+        result.append({'image_id': image_id,
+                       'kernel_id': kernel_id,
+                       'ramdisk_id': ramdisk_id,
+                       'launches': count,
+                       'user_id': user_id,
+                       'project_id': project_id})
+    return result
+
+
 @require_context
 def instance_get_all_by_reservation(context, reservation_id):
     session = get_session()
@@ -872,6 +947,22 @@ def instance_set_state(context, instance_id, state, description=None):
                         'state_description': description})
 
 
+@require_admin_context
+def instance_set_states(context, states):
+    from nova.compute import power_state
+    by_state = {}
+    for instance_id, state in states.iteritems():
+        by_state.setdefault(state, []).append(instance_id)
+    session = get_session()
+    with session.begin():
+        for state, instance_ids in by_state.iteritems():
+            session.query(models.Instance).\
+                    filter(models.Instance.id.in_(instance_ids)).\
+                    update({'state': state,
+                            'state_description': power_state.name(state)},
+                           synchronize_session=False)
+
+
 @require_context
 def instance_update(context, instance_id, values):
     session = get_session()
@@ -882,6 +973,28 @@ def instance_update(context, instance_id, values):
         return instance_ref
 
 
+@require_admin_context
+def instance_claim_host(context, host, generation, instance_ids):
+    session = get_session()
+    with session.begin():
+        claimed = session.query(models.Service).\
+                          filter_by(topic='compute').\
+                          filter_by(host=host).\
+                          filter_by(claim_generation=generation).\
+                          filter_by(deleted=False).\
+                          update({'claim_generation': generation + 1},
+                                 synchronize_session=False)
+        if not claimed:
+            raise db.HostClaimConflict(_('Host %(host)s changed since '
+                                         'generation %(generation)s')
+                                       % locals())
+        session.query(models.Instance).\
+                filter(models.Instance.id.in_(instance_ids)).\
+                update({'host': host,
+                        'scheduled_at': datetime.datetime.utcnow()},
+                       synchronize_session=False)
+
+
 def instance_add_security_group(context, instance_id, security_group_id):
     """Associate the given security group with the given instance"""
     session = get_session()
@@ -111,6 +111,12 @@ class Service(BASE, NovaBase):
     report_count = Column(Integer, nullable=False, default=0)
     disabled = Column(Boolean, default=False)
     availability_zone = Column(String(255), default='nova')
+    # NOTE(vish): bumped by every scheduler claim against this host so
+    #             concurrent schedulers can detect a stale view
+    claim_generation = Column(Integer, nullable=False, default=0)
+    # NOTE(vish): load reported by compute hosts with each heartbeat
+    builds_running = Column(Integer, default=0)
+    builds_queued = Column(Integer, default=0)
 
 
 class Certificate(BASE, NovaBase):
@@ -70,6 +70,14 @@ class Manager(base.Base):
         """Tasks to be run at a periodic interval"""
         pass
 
+    def service_state(self):
+        """Returns values stored in the service's row with every report.
+
+        Lets a service publish its load, e.g. queue depths, alongside its
+        heartbeat.  Child classes may override this method.
+        """
+        return {}
+
     def init_host(self):
         """Do any initialization that needs to be run if this is a standalone
         service. Child classes should override this method."""
@@ -74,51 +74,21 @@ def init_host():
     """Basic networking setup goes here"""
 
     if FLAGS.use_nova_chains:
-        _execute("sudo iptables -N nova_input", check_exit_code=False)
-        _execute("sudo iptables -D %s -j nova_input" % FLAGS.input_chain,
-                 check_exit_code=False)
-        _execute("sudo iptables -A %s -j nova_input" % FLAGS.input_chain)
-
-        _execute("sudo iptables -N nova_forward", check_exit_code=False)
-        _execute("sudo iptables -D FORWARD -j nova_forward",
-                 check_exit_code=False)
-        _execute("sudo iptables -A FORWARD -j nova_forward")
-
-        _execute("sudo iptables -N nova_output", check_exit_code=False)
-        _execute("sudo iptables -D OUTPUT -j nova_output",
-                 check_exit_code=False)
-        _execute("sudo iptables -A OUTPUT -j nova_output")
-
-        _execute("sudo iptables -t nat -N nova_prerouting",
-                 check_exit_code=False)
-        _execute("sudo iptables -t nat -D PREROUTING -j nova_prerouting",
-                 check_exit_code=False)
-        _execute("sudo iptables -t nat -A PREROUTING -j nova_prerouting")
-
-        _execute("sudo iptables -t nat -N nova_postrouting",
-                 check_exit_code=False)
-        _execute("sudo iptables -t nat -D POSTROUTING -j nova_postrouting",
-                 check_exit_code=False)
-        _execute("sudo iptables -t nat -A POSTROUTING -j nova_postrouting")
-
-        _execute("sudo iptables -t nat -N nova_snatting",
-                 check_exit_code=False)
-        _execute("sudo iptables -t nat -D POSTROUTING -j nova_snatting",
-                 check_exit_code=False)
-        _execute("sudo iptables -t nat -A POSTROUTING -j nova_snatting")
-
-        _execute("sudo iptables -t nat -N nova_output", check_exit_code=False)
-        _execute("sudo iptables -t nat -D OUTPUT -j nova_output",
-                 check_exit_code=False)
-        _execute("sudo iptables -t nat -A OUTPUT -j nova_output")
+        commands = []
+        for table, chain, parent in [(None, 'nova_input', FLAGS.input_chain),
+                                     (None, 'nova_forward', 'FORWARD'),
+                                     (None, 'nova_output', 'OUTPUT'),
+                                     ('nat', 'nova_prerouting', 'PREROUTING'),
+                                     ('nat', 'nova_postrouting',
+                                      'POSTROUTING'),
+                                     ('nat', 'nova_snatting', 'POSTROUTING'),
+                                     ('nat', 'nova_output', 'OUTPUT')]:
+            commands += _jump_to_chain(table, chain, parent)
+        _execute_batch(commands)
     else:
         # NOTE(vish): This makes it easy to ensure snatting rules always
         #             come after the accept rules in the postrouting chain
-        _execute("sudo iptables -t nat -N SNATTING",
-                 check_exit_code=False)
-        _execute("sudo iptables -t nat -D POSTROUTING -j SNATTING",
-                 check_exit_code=False)
-        _execute("sudo iptables -t nat -A POSTROUTING -j SNATTING")
+        _execute_batch(_jump_to_chain('nat', 'SNATTING', 'POSTROUTING'))
 
     # NOTE(devcamcar): Cloud public SNAT entries and the default
     # SNAT rule for outbound traffic.
@@ -383,6 +353,24 @@ def _execute(cmd, *args, **kwargs):
         return utils.execute(cmd, *args, **kwargs)
 
 
+def _execute_batch(commands):
+    """Wrapper around utils.execute_batch for fake_network"""
+    if FLAGS.fake_network:
+        for cmd, _check_exit_code in commands:
+            LOG.debug("FAKE NET: %s", cmd)
+        return [("fake", 0)] * len(commands)
+    else:
+        return utils.execute_batch(commands)
+
+
+def _jump_to_chain(table, chain, parent):
+    """Commands creating chain and jumping to it at the end of parent"""
+    table = table and '-t %s ' % table or ''
+    return [("sudo iptables %s-N %s" % (table, chain), False),
+            ("sudo iptables %s-D %s -j %s" % (table, parent, chain), False),
+            ("sudo iptables %s-A %s -j %s" % (table, parent, chain), True)]
+
+
 def _device_exists(device):
     """Check if ethernet device exists"""
     (_out, err) = _execute("ip link show dev %s" % device,
@@ -398,9 +386,8 @@ def _confirm_rule(chain, cmd, append=False):
         loc = "-A"
     else:
         loc = "-I"
-    _execute("sudo iptables --delete %s %s" % (chain, cmd),
-             check_exit_code=False)
-    _execute("sudo iptables %s %s %s" % (loc, chain, cmd))
+    _execute_batch([("sudo iptables --delete %s %s" % (chain, cmd), False),
+                    ("sudo iptables %s %s %s" % (loc, chain, cmd), True)])
 
 
 def _remove_rule(chain, cmd):
@@ -0,0 +1,231 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Root Helper
+
+A long running process, started once as root with bin/nova-root-helper,
+that runs privileged commands for the other nova services so they do not
+fork sudo for every iptables or lvm call.  Services talk to it over the
+unix socket named by --root_helper_socket; when that flag is empty,
+:func:`nova.utils.execute` keeps running ``sudo`` itself.
+
+Each request is one line of json holding a batch of commands, answered by
+one line holding their results.  The commands of a batch run in order and
+the batch stops at the first failing command whose exit code is checked, so
+a batch behaves like the same calls made one after the other.  Requests of
+different clients are served concurrently.
+
+A request may give a timeout in seconds; a command still running by then
+is killed along with everything it started, its exit code reported as
+null, and the batch stops there.
+
+Only commands named in --root_helper_commands are run, without a shell.
+They are given by bare name and looked up in the fixed :data:`PATH`, never
+in a directory chosen by the client.
+"""
+
+import grp
+import json
+import os
+import signal
+
+import eventlet
+from eventlet import greenpool
+from eventlet import greenthread
+from eventlet.green import socket
+from eventlet.green import subprocess
+
+from nova import exception
+from nova import flags
+from nova import log as logging
+
+
+LOG = logging.getLogger('nova.roothelper')
+FLAGS = flags.FLAGS
+flags.DEFINE_string('root_helper_socket', '',
+                    'unix socket of a running nova-root-helper, run sudo '
+                    'commands through it instead of forking sudo')
+flags.DEFINE_string('root_helper_group', '',
+                    'group allowed to connect to the root helper socket')
+flags.DEFINE_integer('root_helper_workers', 64,
+                     'number of requests the root helper serves at once')
+flags.DEFINE_list('root_helper_commands',
+                  ['aoe-discover', 'aoe-stat', 'brctl', 'chmod', 'chown',
+                   'dd', 'ietadm', 'ip', 'ip6tables-restore',
+                   'ip6tables-save', 'iptables', 'iptables-restore',
+                   'iptables-save', 'iscsiadm', 'kill', 'kpartx', 'losetup',
+                   'lvcreate', 'lvdisplay', 'lvremove', 'mkdir', 'mount',
+                   'qemu-nbd', 'route', 'tee', 'tune2fs', 'umount',
+                   'vblade-persist', 'vconfig', 'vgs'],
+                  'commands the root helper agrees to run')
+
+# NOTE(vish): commands using any of these need a shell, so they are left to
+#             sudo rather than sent to the helper
+SHELL_CHARACTERS = set('|&;<>()$`\\"\'*?[]#~\n')
+
+# NOTE(vish): only root can write to these, so a whitelisted name always
+#             resolves to the system binary
+PATH = '/usr/sbin:/usr/bin:/sbin:/bin'
+
+
+def can_run(cmd):
+    """True if the sudo command cmd can be sent to the helper."""
+    if not FLAGS.root_helper_socket or not cmd.startswith('sudo '):
+        return False
+    args = cmd.split()
+    if len(args) < 2 or args[1] not in FLAGS.root_helper_commands:
+        return False
+    return not SHELL_CHARACTERS.intersection(cmd)
+
+
+def execute(commands, timeout=None):
+    """Runs a batch on the helper and returns its results.
+
+    commands is a list of (cmd, process_input, check_exit_code) where cmd
+    has no sudo prefix.  Returns an (exit_code, stdout, stderr) triple for
+    every command that ran, with an exit_code of None for a command killed
+    after timeout seconds.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(FLAGS.root_helper_socket)
+        stream = sock.makefile('rw')
+        stream.write(json.dumps({'commands': commands,
+                                 'timeout': timeout}) + '\n')
+        stream.flush()
+        response = stream.readline()
+    finally:
+        sock.close()
+    if not response:
+        raise exception.Error(_('Root helper closed the connection'))
+    response = json.loads(response)
+    if 'error' in response:
+        raise exception.Error(response['error'])
+    return response['results']
+
+
+class RootHelper(object):
+    """Serves the batches sent by :func:`execute`."""
+
+    def __init__(self, path=None, commands=None):
+        self.path = path or FLAGS.root_helper_socket
+        self.commands = set(commands or FLAGS.root_helper_commands)
+
+    def run(self, cmd, process_input=None, timeout=None):
+        """Runs a single whitelisted command.
+
+        A command still running after timeout seconds is killed, and
+        None returned as its exit code.
+        """
+        if isinstance(cmd, unicode):
+            cmd = cmd.encode('utf-8')
+        if isinstance(process_input, unicode):
+            process_input = process_input.encode('utf-8')
+        args = cmd.split()
+        if not args or '/' in args[0] or args[0] not in self.commands:
+            LOG.warn(_('Refused to run %s'), cmd)
+            return 126, '', _('Command not allowed by root helper')
+        LOG.debug(_('Running cmd (root helper): %s'), cmd)
+        try:
+            obj = subprocess.Popen(args, stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE,
+                                   env={'PATH': PATH},
+                                   preexec_fn=timeout and os.setsid or None)
+        except OSError as e:
+            return 127, '', str(e)
+        timed_out = []
+
+        def kill():
+            LOG.warn(_('Killing %(cmd)s after %(timeout)s seconds'),
+                     {'cmd': cmd, 'timeout': timeout})
+            timed_out.append(True)
+            try:
+                os.killpg(obj.pid, signal.SIGKILL)
+            except OSError:
+                LOG.exception(_('Cannot kill %s'), cmd)
+
+        killer = None
+        if timeout:
+            killer = greenthread.spawn_after(timeout, kill)
+        # NOTE(vish): imported here as nova.utils imports this module;
+        #             its communicate lets the other clients be served
+        #             while the command runs
+        from nova import utils
+        try:
+            stdout, stderr = utils._communicate(obj, process_input)
+        finally:
+            if killer:
+                killer.cancel()
+        if timed_out:
+            return None, stdout, stderr
+        return obj.returncode, stdout, stderr
+
+    def run_batch(self, commands, timeout=None):
+        """Runs commands in order, stopping at the first checked failure.
+
+        Each command gets timeout seconds; the batch also stops at a
+        command killed for taking longer.
+        """
+        results = []
+        for cmd, process_input, check_exit_code in commands:
+            result = self.run(cmd, process_input, timeout)
+            results.append(result)
+            if result[0] is None or (check_exit_code and result[0]):
+                break
+        return results
+
+    def handle(self, sock):
+        """Answers the requests of one client until it disconnects."""
+        stream = sock.makefile('rw')
+        try:
+            for line in stream:
+                try:
+                    request = json.loads(line)
+                    response = {'results': self.run_batch(
+                            request['commands'], request.get('timeout'))}
+                except Exception as e:
+                    LOG.exception(_('Bad root helper request'))
+                    response = {'error': str(e)}
+                stream.write(json.dumps(response) + '\n')
+                stream.flush()
+        finally:
+            sock.close()
+
+    def listen(self):
+        """Opens the socket, which only root and root_helper_group use."""
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        old_umask = os.umask(0117)
+        try:
+            server = eventlet.listen(self.path, family=socket.AF_UNIX)
+        finally:
+            os.umask(old_umask)
+        if FLAGS.root_helper_group:
+            os.chown(self.path, -1,
+                     grp.getgrnam(FLAGS.root_helper_group).gr_gid)
+        return server
+
+    def serve(self, server=None):
+        """Serves requests forever."""
+        server = server or self.listen()
+        pool = greenpool.GreenPool(FLAGS.root_helper_workers)
+        LOG.info(_('Root helper listening on %s'), self.path)
+        while True:
+            sock, _address = server.accept()
+            pool.spawn_n(self.handle, sock)
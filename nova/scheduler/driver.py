@@ -26,7 +26,10 @@ import datetime
 from nova import db
 from nova import exception
 from nova import flags
+from nova import log as logging
+from nova.scheduler import liveness
 
+LOG = logging.getLogger('nova.scheduler.driver')
 FLAGS = flags.FLAGS
 flags.DEFINE_integer('service_down_time', 60,
                      'maximum time since last checkin for up service')
@@ -47,8 +50,16 @@ class Scheduler(object):
 
     @staticmethod
     def service_is_up(service):
-        """Check whether a service is up based on last heartbeat."""
+        """Check whether a service is up based on last heartbeat.
+
+        Heartbeats this scheduler received but has not written to the
+        database yet count too.
+        """
         last_heartbeat = service['updated_at'] or service['created_at']
+        last_seen = liveness.LivenessView.instance().last_heartbeat(
+                service['id'])
+        if last_seen and last_seen > last_heartbeat:
+            last_heartbeat = last_seen
         # Timestamps in DB are UTC.
         elapsed = datetime.datetime.utcnow() - last_heartbeat
         return elapsed < datetime.timedelta(seconds=FLAGS.service_down_time)
@@ -64,3 +75,37 @@ class Scheduler(object):
     def schedule(self, context, topic, *_args, **_kwargs):
         """Must override at least this method for scheduler to work."""
         raise NotImplementedError(_("Must implement a fallback schedule"))
+
+    def schedule_run_instances(self, context, instance_ids, *args, **kwargs):
+        """Places every instance of a reservation, one at a time.
+
+        Returns a dict mapping each chosen host to the list of instance ids
+        placed on it.  Drivers that can place a whole reservation against a
+        single view of the hosts should override this.
+        """
+        placement = {}
+        schedule_one = getattr(self, 'schedule_run_instance', None)
+        try:
+            for instance_id in instance_ids:
+                if schedule_one:
+                    host = schedule_one(context, instance_id, *args,
+                                        **kwargs)
+                else:
+                    host = self.schedule(context, FLAGS.compute_topic,
+                                         instance_id=instance_id, *args,
+                                         **kwargs)
+                placement.setdefault(host, []).append(instance_id)
+        except Exception:
+            # NOTE(vish): the instances placed so far will not be cast to
+            #             their hosts, so they must not keep them
+            self.release_hosts(context, placement)
+            raise
+        return placement
+
+    def release_hosts(self, context, placement):
+        """Undoes the placement of instances that will not be run."""
+        for host, instance_ids in placement.iteritems():
+            LOG.debug(_("Releasing %(instance_ids)s on %(host)s") % locals())
+            for instance_id in instance_ids:
+                db.instance_update(context, instance_id,
+                                   {'host': None, 'scheduled_at': None})
@@ -0,0 +1,83 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (c) 2010 Openstack, LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Service Liveness
+
+With --heartbeat_via_rpc, services cast their heartbeats to the scheduler
+instead of writing them to the database themselves.  Each scheduler keeps
+the time it last heard from every service in a :class:`LivenessView`, which
+:meth:`nova.scheduler.driver.Scheduler.service_is_up` consults before the
+updated_at column, and writes the heartbeats it collected to the database
+in one batch every heartbeat_flush_interval seconds so that other readers
+of the services table still see them.
+"""
+
+import datetime
+
+from nova import db
+from nova import flags
+from nova import log as logging
+
+LOG = logging.getLogger('nova.scheduler.liveness')
+FLAGS = flags.FLAGS
+flags.DEFINE_integer('heartbeat_flush_interval', 10,
+                     'seconds between batched writes of the heartbeats '
+                     'received by the scheduler')
+
+
+class LivenessView(object):
+    """In memory record of the heartbeats received by this process."""
+
+    def __init__(self):
+        self.last_seen = {}
+        self.pending = {}
+        self.states = {}
+
+    @classmethod
+    def instance(cls):
+        if not hasattr(cls, '_instance'):
+            cls._instance = cls()
+        return cls._instance
+
+    def record(self, service_id, state=None):
+        """Notes a heartbeat from service_id and the state it reported."""
+        self.last_seen[service_id] = datetime.datetime.utcnow()
+        self.pending[service_id] = self.pending.get(service_id, 0) + 1
+        if state:
+            self.states[service_id] = state
+
+    def last_heartbeat(self, service_id):
+        """Returns when service_id was last heard from, or None."""
+        return self.last_seen.get(service_id)
+
+    def flush(self, context):
+        """Writes the heartbeats received since the last flush."""
+        pending, self.pending = self.pending, {}
+        states, self.states = self.states, {}
+        if not pending:
+            return
+        try:
+            db.service_report_heartbeats(context, pending, states)
+        except Exception:
+            LOG.exception(_("Failed to write %d heartbeats, will retry"),
+                          len(pending))
+            for service_id, count in pending.iteritems():
+                self.pending[service_id] = (self.pending.get(service_id, 0) +
+                                            count)
+            for service_id, state in states.iteritems():
+                self.states.setdefault(service_id, state)
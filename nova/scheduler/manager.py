@@ -23,12 +23,14 @@ Scheduler Service
 
 import functools
 
+from nova import context
 from nova import db
 from nova import flags
 from nova import log as logging
 from nova import manager
 from nova import rpc
 from nova import utils
+from nova.scheduler import liveness
 
 LOG = logging.getLogger('nova.scheduler.manager')
 FLAGS = flags.FLAGS
@@ -49,6 +51,33 @@ class SchedulerManager(manager.Manager):
         """Converts all method calls to use the schedule method"""
         return functools.partial(self._schedule, key)
 
+    def init_host(self):
+        flush = utils.LoopingCall(self.flush_heartbeats)
+        flush.start(interval=FLAGS.heartbeat_flush_interval, now=False)
+
+    def service_heartbeat(self, context, service_id, state=None):
+        """Records a heartbeat cast by Service.report_state."""
+        liveness.LivenessView.instance().record(service_id, state)
+
+    def flush_heartbeats(self):
+        """Writes the heartbeats received so far to the database."""
+        liveness.LivenessView.instance().flush(context.get_admin_context())
+
+    def run_instances(self, context, topic, instance_ids, **kwargs):
+        """Places a whole reservation and casts each host its batch."""
+        elevated = context.elevated()
+        placement = self.driver.schedule_run_instances(elevated,
+                                                       instance_ids,
+                                                       **kwargs)
+        for host, host_instance_ids in placement.iteritems():
+            args = dict(kwargs, instance_ids=host_instance_ids)
+            rpc.cast(context,
+                     db.queue_get_for(context, topic, host),
+                     {"method": "run_instances",
+                      "args": args})
+            LOG.debug(_("Casting %(host_instance_ids)s to %(topic)s %(host)s"
+                        " for run_instances") % locals())
+
     def _schedule(self, method, context, topic, *args, **kwargs):
         """Tries to call schedule_* method on the driver to retrieve host.
 
@@ -0,0 +1,280 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (c) 2010 Openstack, LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Scheduler Simulator
+
+Replays a trace of run and terminate events through a scheduler driver
+against a synthetic cloud, so scheduler changes can be compared before they
+are deployed.  Compute hosts are plain service rows, scheduler casts travel
+over the in-memory broker (--fake_rabbit) and are picked up by
+:class:`SimulatedCompute`, which "boots" instances on one fake virt driver
+per host.
+
+A trace is a list of ``(action, key, instance_type)`` tuples, where action
+is 'run' or 'terminate' and key names an instance within the trace.  Traces
+can be generated with :func:`generate_trace` or recorded in a text file with
+one event per line::
+
+    run 1 m1.small
+    run 2 m1.large
+    terminate 1
+"""
+
+import datetime
+import math
+import random
+import time
+
+from nova import context
+from nova import db
+from nova import flags
+from nova import log as logging
+from nova import rpc
+from nova import utils
+from nova.compute import instance_types
+from nova.compute import power_state
+from nova.scheduler import driver
+from nova.virt import fake
+
+LOG = logging.getLogger('nova.scheduler.simulator')
+FLAGS = flags.FLAGS
+flags.DECLARE('max_cores', 'nova.scheduler.simple')
+flags.DECLARE('max_memory_mb', 'nova.scheduler.weighted')
+flags.DECLARE('scheduler_driver', 'nova.scheduler.manager')
+
+
+def generate_trace(num_events, terminate_ratio=0.3, seed=None,
+                   types=None):
+    """Generates a random trace of num_events events.
+
+    Roughly terminate_ratio of the events terminate a random instance that
+    is still running at that point of the trace.
+    """
+    rand = random.Random(seed)
+    types = types or sorted(instance_types.INSTANCE_TYPES.keys())
+    running = []
+    trace = []
+    for key in xrange(num_events):
+        if running and rand.random() < terminate_ratio:
+            victim = running.pop(rand.randrange(len(running)))
+            trace.append(('terminate', victim, None))
+        else:
+            running.append(key)
+            trace.append(('run', key, rand.choice(types)))
+    return trace
+
+
+def load_trace(path):
+    """Reads a trace recorded with save_trace."""
+    trace = []
+    with open(path) as trace_file:
+        for line in trace_file:
+            line = line.split('#')[0].split()
+            if not line:
+                continue
+            instance_type = None
+            if len(line) > 2:
+                instance_type = line[2]
+            trace.append((line[0], line[1], instance_type))
+    return trace
+
+
+def save_trace(trace, path):
+    """Writes trace in the format read by load_trace."""
+    with open(path, 'w') as trace_file:
+        for action, key, instance_type in trace:
+            trace_file.write(' '.join(str(field)
+                                      for field in (action, key, instance_type)
+                                      if field is not None) + '\n')
+
+
+def percentile(values, fraction):
+    """Returns the value below which fraction of the sorted values fall."""
+    if not values:
+        return 0.0
+    index = int(math.ceil(fraction * len(values))) - 1
+    return values[max(index, 0)]
+
+
+class SimulatedCompute(object):
+    """Stands in for every compute manager of the synthetic cloud."""
+
+    def __init__(self):
+        self.connections = {}
+
+    def _connection(self, host):
+        if host not in self.connections:
+            self.connections[host] = fake.FakeConnection()
+        return self.connections[host]
+
+    def run_instance(self, context, instance_id, **_kwargs):
+        instance_ref = db.instance_get(context, instance_id)
+        self._connection(instance_ref['host']).spawn(instance_ref)
+        db.instance_update(context,
+                           instance_id,
+                           {'state': power_state.RUNNING,
+                            'state_description': 'running',
+                            'launched_at': datetime.datetime.utcnow()})
+
+    def run_instances(self, context, instance_ids, **kwargs):
+        for instance_id in instance_ids:
+            self.run_instance(context, instance_id, **kwargs)
+
+    def terminate_instance(self, context, instance_id):
+        instance_ref = db.instance_get(context, instance_id)
+        self._connection(instance_ref['host']).destroy(instance_ref)
+        db.instance_destroy(context, instance_id)
+
+
+class Simulator(object):
+    """Replays traces through a scheduler against synthetic hosts."""
+
+    def __init__(self, scheduler_driver=None, num_hosts=1000):
+        self.context = context.get_admin_context()
+        self.driver = utils.import_object(scheduler_driver or
+                                          FLAGS.scheduler_driver)
+        self.compute = SimulatedCompute()
+        self.consumer = rpc.AdapterConsumer(
+                connection=rpc.Connection.instance(new=True),
+                topic=FLAGS.compute_topic,
+                proxy=self.compute)
+        self.service_ids = []
+        self.instances = {}
+        for i in xrange(num_hosts):
+            service_ref = db.service_create(self.context,
+                                            {'host': 'simhost%05d' % i,
+                                             'binary': 'nova-compute',
+                                             'topic': FLAGS.compute_topic,
+                                             'report_count': 0})
+            self.service_ids.append(service_ref['id'])
+
+    def _deliver(self):
+        """Hands the cast sent by the scheduler to SimulatedCompute.
+
+        The message is handled right here rather than on the consumer's
+        green pool, so every launch is done before the next event.
+        """
+        message = self.consumer.backend.get(self.consumer.queue)
+        if message:
+            self.consumer._receive(message.decode(), message)
+
+    def _run(self, key, instance_type):
+        values = {'image_id': 'ami-sim',
+                  'instance_type': instance_type,
+                  'reservation_id': 'r-sim'}
+        values.update((name, value) for name, value
+                      in instance_types.INSTANCE_TYPES[instance_type].items()
+                      if name != 'flavorid')
+        instance_id = db.instance_create(self.context, values)['id']
+        scheduler_driver = self.driver
+        start = time.time()
+        try:
+            # NOTE(vish): same dispatch as SchedulerManager._schedule, but we
+            #             need to know the host to play its compute manager
+            if hasattr(scheduler_driver, 'schedule_run_instance'):
+                host = scheduler_driver.schedule_run_instance(self.context,
+                                                              instance_id)
+            else:
+                host = scheduler_driver.schedule(self.context,
+                                                 FLAGS.compute_topic,
+                                                 instance_id=instance_id)
+        except driver.NoValidHost:
+            db.instance_destroy(self.context, instance_id)
+            return time.time() - start, False
+        rpc.cast(self.context,
+                 db.queue_get_for(self.context, FLAGS.compute_topic, host),
+                 {'method': 'run_instance',
+                  'args': {'instance_id': instance_id}})
+        elapsed = time.time() - start
+        self.instances[key] = instance_id
+        db.instance_update(self.context, instance_id, {'host': host})
+        self._deliver()
+        return elapsed, True
+
+    def _terminate(self, key):
+        instance_id = self.instances.pop(key, None)
+        if instance_id is None:
+            return False
+        self.compute.terminate_instance(self.context, instance_id)
+        return True
+
+    def replay(self, trace):
+        """Replays trace and returns a dict of statistics."""
+        latencies = []
+        rejected = terminated = 0
+        for action, key, instance_type in trace:
+            if action == 'run':
+                elapsed, placed = self._run(key, instance_type)
+                latencies.append(elapsed)
+                if not placed:
+                    rejected += 1
+            elif action == 'terminate':
+                if self._terminate(key):
+                    terminated += 1
+            else:
+                LOG.warn(_('Skipping unknown trace action %s'), action)
+
+        scheduling_time = sum(latencies)
+        latencies.sort()
+        stats = {'decisions': len(latencies),
+                 'rejected': rejected,
+                 'terminated': terminated,
+                 'running': len(self.instances),
+                 'scheduling_time': scheduling_time,
+                 'decisions_per_second': 0.0,
+                 'p50_ms': percentile(latencies, 0.5) * 1000.0,
+                 'p99_ms': percentile(latencies, 0.99) * 1000.0,
+                 'max_ms': percentile(latencies, 1.0) * 1000.0}
+        if scheduling_time:
+            stats['decisions_per_second'] = len(latencies) / scheduling_time
+        stats.update(self.packing())
+        return stats
+
+    def packing(self):
+        """Reports how tightly the running instances fill the hosts used.
+
+        Efficiency is the share of max_cores and max_memory_mb in use on
+        the hosts that run at least one instance; 1.0 means every used host
+        is full.
+        """
+        used_hosts = vcpus = memory_mb = 0
+        for service, host_vcpus, host_memory_mb, _local_gb in \
+                db.service_get_all_compute_usage(self.context):
+            if service['id'] in self.service_ids and host_vcpus:
+                used_hosts += 1
+                vcpus += host_vcpus
+                memory_mb += host_memory_mb
+        result = {'hosts': len(self.service_ids),
+                  'used_hosts': used_hosts,
+                  'cores_efficiency': 0.0,
+                  'memory_efficiency': 0.0}
+        if used_hosts:
+            result['cores_efficiency'] = (float(vcpus) /
+                                          (used_hosts * FLAGS.max_cores))
+            result['memory_efficiency'] = (float(memory_mb) /
+                                           (used_hosts * FLAGS.max_memory_mb))
+        return result
+
+    def destroy(self):
+        """Removes the synthetic hosts and any instances still running."""
+        for key in self.instances.keys():
+            self._terminate(key)
+        for service_id in self.service_ids:
+            db.service_destroy(self.context, service_id)
+        self.service_ids = []
+        self.consumer.close()
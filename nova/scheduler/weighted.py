@@ -0,0 +1,359 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (c) 2010 Openstack, LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Weighted Scheduler
+
+Runs every compute host through a chain of cheap filters and then picks the
+survivor with the lowest weighted cost.  Host state is loaded with a single
+query and kept as parallel columns, so each filter and cost function is one
+pass over all candidate hosts instead of a walk over sorted db rows.
+
+Filters and cost functions are plain functions taking
+``(state, instance_ref, candidates)``, where candidates is a list of indexes
+into the :class:`HostState` columns.  Filters return the indexes that pass,
+cost functions return one score per candidate (lower is better).  Either may
+be referred to by the short names below or by a full import path.
+
+Several schedulers may run at once.  Each placement is made against a
+snapshot and then claimed with :func:`nova.db.instance_claim_host`, which
+only succeeds if nobody else claimed the host since the snapshot was read;
+lost claims are re-placed against a fresh snapshot.  Picking at random among
+the scheduler_host_subset_size cheapest hosts keeps concurrent schedulers
+from all racing for the same host.
+"""
+
+import heapq
+import random
+
+from nova import db
+from nova import flags
+from nova import log as logging
+from nova import utils
+from nova.scheduler import driver
+from nova.scheduler import simple
+
+LOG = logging.getLogger('nova.scheduler.weighted')
+FLAGS = flags.FLAGS
+flags.DEFINE_integer('max_memory_mb', 32768,
+                     'maximum amount of instance memory (MB) to allow per '
+                     'host')
+flags.DEFINE_integer('max_local_gb', 1000,
+                     'maximum amount of instance local disk (GB) to allow per '
+                     'host')
+flags.DEFINE_list('scheduler_filters',
+                  ['alive', 'disabled', 'zone', 'cores', 'memory', 'disk'],
+                  'Host filters applied in order by the weighted scheduler')
+flags.DEFINE_list('scheduler_cost_functions',
+                  ['cores:1.0', 'memory:1.0'],
+                  'name:weight pairs of cost functions used by the weighted '
+                  'scheduler; positive weights spread, negative weights pack')
+flags.DEFINE_integer('scheduler_host_subset_size', 1,
+                     'pick at random among this many of the cheapest hosts, '
+                     'raise it when running several schedulers')
+flags.DEFINE_integer('scheduler_claim_retries', 3,
+                     'times to re-place instances whose host was claimed by '
+                     'another scheduler')
+
+
+class HostState(object):
+    """Column oriented snapshot of the compute hosts.
+
+    Every attribute is a list indexed by host position.
+    """
+
+    def __init__(self, rows, service_is_up):
+        self.hosts = []
+        self.zones = []
+        self.up = []
+        self.disabled = []
+        self.vcpus = []
+        self.memory_mb = []
+        self.local_gb = []
+        self.generations = []
+        for service, vcpus, memory_mb, local_gb in rows:
+            self.hosts.append(service['host'])
+            self.zones.append(service['availability_zone'])
+            self.up.append(service_is_up(service))
+            self.disabled.append(service['disabled'])
+            self.vcpus.append(int(vcpus))
+            self.memory_mb.append(int(memory_mb))
+            self.local_gb.append(int(local_gb))
+            self.generations.append(service['claim_generation'])
+
+    def __len__(self):
+        return len(self.hosts)
+
+    def consume(self, index, instance_ref):
+        """Charge the resources of instance_ref to the host at index."""
+        self.vcpus[index] += instance_ref['vcpus'] or 0
+        self.memory_mb[index] += instance_ref['memory_mb'] or 0
+        self.local_gb[index] += instance_ref['local_gb'] or 0
+
+
+def alive_filter(state, instance_ref, candidates):
+    """Drops hosts that have not checked in recently."""
+    up = state.up
+    return [i for i in candidates if up[i]]
+
+
+def disabled_filter(state, instance_ref, candidates):
+    """Drops hosts that an administrator has disabled."""
+    disabled = state.disabled
+    return [i for i in candidates if not disabled[i]]
+
+
+def zone_filter(state, instance_ref, candidates):
+    """Keeps hosts in the availability zone requested by the instance."""
+    zone = (instance_ref['availability_zone'] or '').partition(':')[0]
+    if not zone:
+        return candidates
+    zones = state.zones
+    return [i for i in candidates if zones[i] == zone]
+
+
+def cores_filter(state, instance_ref, candidates):
+    """Keeps hosts with room for the instance's vcpus."""
+    limit = FLAGS.max_cores - (instance_ref['vcpus'] or 0)
+    vcpus = state.vcpus
+    return [i for i in candidates if vcpus[i] <= limit]
+
+
+def memory_filter(state, instance_ref, candidates):
+    """Keeps hosts with room for the instance's memory."""
+    limit = FLAGS.max_memory_mb - (instance_ref['memory_mb'] or 0)
+    memory_mb = state.memory_mb
+    return [i for i in candidates if memory_mb[i] <= limit]
+
+
+def disk_filter(state, instance_ref, candidates):
+    """Keeps hosts with room for the instance's local disk."""
+    limit = FLAGS.max_local_gb - (instance_ref['local_gb'] or 0)
+    local_gb = state.local_gb
+    return [i for i in candidates if local_gb[i] <= limit]
+
+
+def cores_cost(state, instance_ref, candidates):
+    """Fraction of max_cores already in use."""
+    vcpus = state.vcpus
+    scale = float(FLAGS.max_cores)
+    return [vcpus[i] / scale for i in candidates]
+
+
+def memory_cost(state, instance_ref, candidates):
+    """Fraction of max_memory_mb already in use."""
+    memory_mb = state.memory_mb
+    scale = float(FLAGS.max_memory_mb)
+    return [memory_mb[i] / scale for i in candidates]
+
+
+def disk_cost(state, instance_ref, candidates):
+    """Fraction of max_local_gb already in use."""
+    local_gb = state.local_gb
+    scale = float(FLAGS.max_local_gb)
+    return [local_gb[i] / scale for i in candidates]
+
+
+FILTERS = {'alive': alive_filter,
+           'disabled': disabled_filter,
+           'zone': zone_filter,
+           'cores': cores_filter,
+           'memory': memory_filter,
+           'disk': disk_filter}
+
+COST_FUNCTIONS = {'cores': cores_cost,
+                  'memory': memory_cost,
+                  'disk': disk_cost}
+
+
+def _load_function(registry, name):
+    """Looks up name in registry, falling back to an import path."""
+    if name in registry:
+        return registry[name]
+    return utils.import_class(name)
+
+
+def get_filters():
+    """Returns (name, function) pairs for FLAGS.scheduler_filters."""
+    return [(name, _load_function(FILTERS, name))
+            for name in FLAGS.scheduler_filters]
+
+
+def get_cost_functions():
+    """Returns (name, function, weight) for FLAGS.scheduler_cost_functions."""
+    result = []
+    for item in FLAGS.scheduler_cost_functions:
+        name, _sep, weight = item.partition(':')
+        weight = float(weight or 1.0)
+        result.append((name, _load_function(COST_FUNCTIONS, name), weight))
+    return result
+
+
+class WeightedScheduler(simple.SimpleScheduler):
+    """Filters compute hosts and picks the one with the lowest cost."""
+
+    # NOTE(vish): number of claims lost to other schedulers, for reporting
+    claim_conflicts = 0
+
+    def host_state(self, context):
+        """Loads a HostState for every compute service."""
+        rows = db.service_get_all_compute_usage(context)
+        return HostState(rows, self.service_is_up)
+
+    def filter_hosts(self, state, instance_ref):
+        """Returns indexes of the hosts in state that can take instance_ref.
+
+        Raises NoValidHost naming the filter that eliminated the last host.
+        """
+        candidates = range(len(state))
+        if not candidates:
+            raise driver.NoValidHost(_("No hosts found"))
+        for name, function in get_filters():
+            candidates = function(state, instance_ref, candidates)
+            if not candidates:
+                raise driver.NoValidHost(_("No hosts passed filter %s")
+                                         % name)
+        return candidates
+
+    def weigh_hosts(self, state, instance_ref, candidates, policy=None):
+        """Returns the weighted cost of each candidate.
+
+        A policy of 'spread' or 'pack' overrides the sign of the configured
+        weights, otherwise they are used as given.
+        """
+        costs = [0.0] * len(candidates)
+        for _name, function, weight in get_cost_functions():
+            if policy == 'spread':
+                weight = abs(weight)
+            elif policy == 'pack':
+                weight = -abs(weight)
+            if not weight:
+                continue
+            scores = function(state, instance_ref, candidates)
+            costs = [cost + weight * score
+                     for cost, score in zip(costs, scores)]
+        return costs
+
+    def select_host(self, state, instance_ref, policy=None):
+        """Returns the index in state of the best host for instance_ref.
+
+        Ties for the lowest cost, or the scheduler_host_subset_size
+        cheapest hosts if that is larger, are broken at random.
+        """
+        candidates = self.filter_hosts(state, instance_ref)
+        costs = self.weigh_hosts(state, instance_ref, candidates, policy)
+        positions = xrange(len(candidates))
+        if FLAGS.scheduler_host_subset_size > 1:
+            top = heapq.nsmallest(FLAGS.scheduler_host_subset_size,
+                                  positions, key=costs.__getitem__)
+        else:
+            best = min(costs)
+            top = [i for i in positions if costs[i] == best]
+        return candidates[random.choice(top)]
+
+    def _is_forced_host(self, context, instance_ref):
+        """True if an admin asked for a specific host in the zone."""
+        zone = instance_ref['availability_zone']
+        return bool(zone and ':' in zone and context.is_admin)
+
+    def claim_hosts(self, context, instance_refs, policy=None):
+        """Places instance_refs and claims the chosen hosts.
+
+        Instances whose host was claimed by another scheduler in the
+        meantime are placed again against a fresh snapshot, up to
+        scheduler_claim_retries times.  Returns a dict mapping each host
+        to the ids of the instances claimed on it.
+
+        If some instance cannot be placed, the claims already made are
+        released before NoValidHost is raised.
+        """
+        placement = {}
+        remaining = instance_refs
+        try:
+            for _attempt in xrange(FLAGS.scheduler_claim_retries + 1):
+                state = self.host_state(context)
+                chosen = {}
+                for instance_ref in remaining:
+                    index = self.select_host(state, instance_ref, policy)
+                    state.consume(index, instance_ref)
+                    chosen.setdefault(index, []).append(instance_ref)
+
+                remaining = []
+                for index, refs in sorted(chosen.iteritems()):
+                    host = state.hosts[index]
+                    instance_ids = [ref['id'] for ref in refs]
+                    try:
+                        db.instance_claim_host(context, host,
+                                               state.generations[index],
+                                               instance_ids)
+                    except db.HostClaimConflict:
+                        LOG.debug(_("Lost claim on %s, placing again"), host)
+                        self.claim_conflicts += 1
+                        remaining.extend(refs)
+                        continue
+                    placement.setdefault(host, []).extend(instance_ids)
+                if not remaining:
+                    return placement
+            raise driver.NoValidHost(_("Hosts kept changing, gave up after "
+                                       "%d claim attempts")
+                                     % (FLAGS.scheduler_claim_retries + 1))
+        except driver.NoValidHost:
+            self.release_hosts(context, placement)
+            raise
+
+    def schedule_run_instance(self, context, instance_id, *_args, **_kwargs):
+        """Picks the cheapest host that passes every filter."""
+        instance_ref = db.instance_get(context, instance_id)
+        if self._is_forced_host(context, instance_ref):
+            # NOTE(vish): an admin asked for a specific host, so skip the
+            #             filters and let the simple scheduler check it
+            return super(WeightedScheduler, self).schedule_run_instance(
+                    context, instance_id, *_args, **_kwargs)
+
+        placement = self.claim_hosts(context, [instance_ref])
+        return placement.keys()[0]
+
+    def schedule_run_instances(self, context, instance_ids, *_args,
+                               **kwargs):
+        """Places a whole reservation against one snapshot of the hosts.
+
+        Every placement is charged to the snapshot before the next instance
+        is placed, and each chosen host is claimed once for all of its
+        instances.  The optional policy kwarg ('spread' or 'pack') applies
+        to the whole reservation.
+        """
+        placement = {}
+        instance_refs = []
+        for instance_id in instance_ids:
+            instance_ref = db.instance_get(context, instance_id)
+            if self._is_forced_host(context, instance_ref):
+                host = super(WeightedScheduler, self).schedule_run_instance(
+                        context, instance_id)
+                placement.setdefault(host, []).append(instance_id)
+            else:
+                instance_refs.append(instance_ref)
+
+        if instance_refs:
+            try:
+                claimed = self.claim_hosts(context, instance_refs,
+                                           kwargs.get('policy'))
+            except driver.NoValidHost:
+                self.release_hosts(context, placement)
+                raise
+            for host, host_instance_ids in claimed.iteritems():
+                placement.setdefault(host, []).extend(host_instance_ids)
+        return placement
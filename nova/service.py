@@ -50,6 +50,10 @@ flags.DEFINE_integer('periodic_interval', 60,
                      'seconds between running periodic tasks',
                      lower_bound=1)
 
+flags.DEFINE_boolean('heartbeat_via_rpc', False,
+                     'cast heartbeats to the scheduler, which writes them '
+                     'to the datastore in batches')
+
 flags.DEFINE_string('pidfile', None,
                     'pidfile to use for this service')
 
@@ -189,17 +193,27 @@ class Service(object):
         """Update the state of this service in the datastore."""
         ctxt = context.get_admin_context()
         try:
-            try:
-                service_ref = db.service_get(ctxt, self.service_id)
-            except exception.NotFound:
-                logging.debug(_("The service database object disappeared, "
-                                "Recreating it."))
-                self._create_service_ref(ctxt)
-                service_ref = db.service_get(ctxt, self.service_id)
-
-            db.service_update(ctxt,
-                             self.service_id,
-                             {'report_count': service_ref['report_count'] + 1})
+            state = self.manager.service_state()
+            if FLAGS.heartbeat_via_rpc:
+                args = {'service_id': self.service_id}
+                if state:
+                    args['state'] = state
+                rpc.cast(ctxt,
+                         FLAGS.scheduler_topic,
+                         {'method': 'service_heartbeat',
+                          'args': args})
+            else:
+                try:
+                    service_ref = db.service_get(ctxt, self.service_id)
+                except exception.NotFound:
+                    logging.debug(_("The service database object "
+                                    "disappeared, Recreating it."))
+                    self._create_service_ref(ctxt)
+                    service_ref = db.service_get(ctxt, self.service_id)
+
+                values = {'report_count': service_ref['report_count'] + 1}
+                values.update(state)
+                db.service_update(ctxt, self.service_id, values)
 
             # TODO(termie): make this pattern be more elegant.
             if getattr(self, "model_disconnected", False):
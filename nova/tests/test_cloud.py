@@ -30,6 +30,7 @@ from eventlet import greenthread
 from nova import context
 from nova import crypto
 from nova import db
+from nova import exception
 from nova import flags
 from nova import log as logging
 from nova import rpc
@@ -207,6 +208,21 @@ class CloudTestCase(test.TestCase):
         output = self.cloud.get_console_output(context=self.context,
                                                      instance_id=[instance_id])
         self.assertEquals(b64decode(output['output']), 'FAKE CONSOLE OUTPUT')
+        output = self.cloud.get_console_output(context=self.context,
+                                               instance_id=[instance_id],
+                                               since_offset='5')
+        self.assertEquals(b64decode(output['output']), 'CONSOLE OUTPUT')
+        self.assertEquals(output['nextOffset'], 19)
+        self.assertRaises(exception.ApiError, self.cloud.get_console_output,
+                          context=self.context, instance_id=[instance_id],
+                          since_offset='end')
+        try:
+            self.cloud.get_console_output(context=self.context,
+                                          instance_id=[instance_id],
+                                          max_bytes='-1')
+            self.fail('negative max_bytes accepted')
+        except exception.ApiError, e:
+            self.assertEqual('max_bytes must not be negative', e.message)
         # TODO(soren): We need this until we can stop polling in the rpc code
         #              for unit tests.
         greenthread.sleep(0.3)
@@ -21,6 +21,8 @@ Tests For Compute
 
 import datetime
 
+from eventlet import greenthread
+
 from nova import compute
 from nova import context
 from nova import db
@@ -30,6 +32,9 @@ from nova import log as logging
 from nova import test
 from nova import utils
 from nova.auth import manager
+from nova.compute import instance_cache
+from nova.compute import power_state
+from nova.compute import state_journal
 
 
 LOG = logging.getLogger('nova.tests.compute')
@@ -154,6 +159,27 @@ class ComputeTestCase(test.TestCase):
         LOG.info(_("After terminating instances: %s"), instances)
         self.assertEqual(len(instances), 0)
 
+    def test_run_instances(self):
+        """Make sure a batch of instances can be run at once"""
+        instance_ids = [self._create_instance() for i in xrange(2)]
+        self.compute.run_instances(self.context, instance_ids)
+        for instance_id in instance_ids:
+            instance_ref = db.instance_get(self.context, instance_id)
+            self.assertNotEqual(instance_ref['launched_at'], None)
+            self.compute.terminate_instance(self.context, instance_id)
+
+    def test_run_instances_builds_concurrently(self):
+        """Ensure the instances of a batch are built at the same time"""
+        running = []
+
+        def fake_run_instance(context, instance_id, **kwargs):
+            running.append(self.compute.builds_running)
+            greenthread.sleep(0)
+
+        self.stubs.Set(self.compute, '_run_instance', fake_run_instance)
+        self.compute.run_instances(self.context, [1, 2, 3])
+        self.assertEqual([1, 2, 3], running)
+
     def test_run_terminate_timestamps(self):
         """Make sure timestamps are set for launched and destroyed"""
         instance_id = self._create_instance()
@@ -225,7 +251,10 @@ class ComputeTestCase(test.TestCase):
 
         console = self.compute.get_console_output(self.context,
                                                         instance_id)
-        self.assert_(console)
+        self.assert_(console['output'])
+        console = self.compute.get_console_output(self.context, instance_id,
+                                                  console['next_offset'])
+        self.assertEqual('', console['output'])
         self.compute.terminate_instance(self.context, instance_id)
 
     def test_ajax_console(self):
@@ -266,3 +295,207 @@ class ComputeTestCase(test.TestCase):
         self.assertEqual(ret_val, None)
 
         self.compute.terminate_instance(self.context, instance_id)
+
+    def test_prefetch_image(self):
+        """Ensure prefetch_image hands the images to the driver"""
+        self.mox.StubOutWithMock(self.compute.driver, 'prefetch_image')
+        self.compute.driver.prefetch_image(self.context, 'ami-test',
+                                           'aki-test', None)
+        self.mox.ReplayAll()
+        self.compute.prefetch_image(self.context, 'ami-test',
+                                    kernel_id='aki-test')
+
+    def test_popular_images(self):
+        """Ensure images are ranked by the number of instances using them"""
+        instance_ids = [self._create_instance() for _i in xrange(3)]
+        db.instance_update(self.context, instance_ids[0],
+                           {'image_id': 'ami-other'})
+        admin_context = context.get_admin_context()
+        images = db.instance_get_popular_images(admin_context, 2)
+        self.assertEqual(len(images), 2)
+        self.assertEqual(images[0]['image_id'], 'ami-test')
+        self.assertEqual(images[0]['launches'], 2)
+        self.assertEqual(images[0]['project_id'], self.project.id)
+        self.assertEqual(images[1]['image_id'], 'ami-other')
+        for instance_id in instance_ids:
+            db.instance_destroy(self.context, instance_id)
+
+    def test_run_instance_takes_a_build_slot(self):
+        """Ensure builds are counted while they hold a build slot"""
+        states = []
+
+        def fake_run_instance(context, instance_id, **kwargs):
+            states.append(self.compute.service_state())
+
+        self.stubs.Set(self.compute, '_run_instance', fake_run_instance)
+        self.compute.run_instance(self.context, 1)
+        self.assertEqual([{'builds_running': 1, 'builds_queued': 0}],
+                         states)
+        self.assertEqual({'builds_running': 0, 'builds_queued': 0},
+                         self.compute.service_state())
+
+    def test_sync_power_states(self):
+        """Ensure only instances whose state changed are written"""
+        instance_ids = [self._create_instance() for _i in xrange(3)]
+        for instance_id in instance_ids:
+            self.compute.run_instance(self.context, instance_id)
+        instance_refs = [db.instance_get(self.context, instance_id)
+                         for instance_id in instance_ids]
+        self.compute.driver.instances[instance_refs[0]['name']]._state = \
+                power_state.SHUTDOWN
+        del self.compute.driver.instances[instance_refs[1]['name']]
+        written = []
+        self.stubs.Set(self.compute.db, 'instance_set_states',
+                       lambda context, states: written.append(states))
+        self.compute._sync_power_states(context.get_admin_context())
+        self.assertEqual([{instance_ids[0]: power_state.SHUTDOWN,
+                           instance_ids[1]: power_state.FAILED}], written)
+        for instance_id in instance_ids:
+            db.instance_destroy(self.context, instance_id)
+
+    def test_instance_cache_serves_repeated_lookups(self):
+        """Ensure lock checks and state reads share one instance lookup
+
+        Terminating reads the instance afresh, as its floating ips and
+        volumes may have changed without the cache knowing.
+        """
+        instance_id = self._create_instance()
+        self.compute.run_instance(self.context, instance_id)
+        lookups = []
+        instance_get = db.instance_get
+
+        def fake_instance_get(context, instance_id):
+            lookups.append(instance_id)
+            return instance_get(context, instance_id)
+
+        self.stubs.Set(self.compute.db, 'instance_get', fake_instance_get)
+        self.compute.pause_instance(self.context, instance_id)
+        self.compute.unpause_instance(self.context, instance_id)
+        self.assertEqual(lookups, [])
+        self.compute.terminate_instance(self.context, instance_id)
+        self.assertEqual(lookups, [instance_id])
+
+    def test_instance_cache_invalidated_by_writes(self):
+        """Ensure a lookup after a write sees the written values"""
+        instance_id = self._create_instance()
+        self.compute.run_instance(self.context, instance_id)
+        self.compute.lock_instance(self.context, instance_id)
+        self.assertTrue(self.compute.get_lock(self.context, instance_id))
+        self.compute.unlock_instance(self.context, instance_id)
+        self.assertFalse(self.compute.get_lock(self.context, instance_id))
+        self.compute.terminate_instance(self.context, instance_id)
+
+
+class InstanceCacheTestCase(test.TestCase):
+    """Test case for the instance cache of the compute manager"""
+    def setUp(self):
+        super(InstanceCacheTestCase, self).setUp()
+        self.context = context.get_admin_context()
+        self.instance_id = db.instance_create(self.context,
+                                              {'state': 0})['id']
+        self.cache = instance_cache.InstanceCache(db)
+
+    def tearDown(self):
+        db.instance_destroy(self.context, self.instance_id)
+        super(InstanceCacheTestCase, self).tearDown()
+
+    def test_get_loads_once(self):
+        first = self.cache.get(self.context, self.instance_id)
+        second = self.cache.get(self.context, self.instance_id)
+        self.assertTrue(first is second)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_invalidate_reloads(self):
+        self.cache.get(self.context, self.instance_id)
+        db.instance_update(self.context, self.instance_id,
+                           {'hostname': 'changed'})
+        self.cache.invalidate(self.instance_id)
+        instance_ref = self.cache.get(self.context, self.instance_id)
+        self.assertEqual(instance_ref['hostname'], 'changed')
+        self.assertEqual(self.cache.misses, 2)
+
+    def test_set_state_updates_cached_record(self):
+        self.cache.get(self.context, self.instance_id)
+        self.cache.set_state(self.instance_id, power_state.RUNNING,
+                             'running')
+        instance_ref = self.cache.get(self.context, self.instance_id)
+        self.assertEqual(instance_ref['state'], power_state.RUNNING)
+        self.assertEqual(instance_ref['state_description'], 'running')
+
+    def test_update_applies_values_to_cached_record(self):
+        self.cache.get(self.context, self.instance_id)
+        self.cache.update(self.instance_id, {'locked': True})
+        instance_ref = self.cache.get(self.context, self.instance_id)
+        self.assertTrue(instance_ref['locked'])
+        self.assertEqual(self.cache.misses, 1)
+
+    def test_zero_ttl_disables_cache(self):
+        self.flags(instance_cache_ttl=0)
+        self.cache.get(self.context, self.instance_id)
+        self.cache.get(self.context, self.instance_id)
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 2))
+
+    def test_pending_updates_are_applied(self):
+        journal = state_journal.StateJournal()
+        self.stubs.Set(journal, '_schedule', lambda seconds: None)
+        self.cache.journal = journal
+        self.cache.get(self.context, self.instance_id)
+        journal.set_state(self.instance_id, power_state.NOSTATE, 'spawning')
+        instance_ref = self.cache.get(self.context, self.instance_id)
+        self.assertEqual(instance_ref['state_description'], 'spawning')
+
+
+class StateJournalTestCase(test.TestCase):
+    """Test case for the write behind journal of instance updates"""
+    def setUp(self):
+        super(StateJournalTestCase, self).setUp()
+        self.writes = []
+        self.stubs.Set(db, 'instance_update', self._instance_update)
+        self.journal = state_journal.StateJournal()
+        self.scheduled = []
+        self.stubs.Set(self.journal, '_schedule', self.scheduled.append)
+
+    def _instance_update(self, context, instance_id, values):
+        if instance_id == 'gone':
+            raise exception.NotFound()
+        if instance_id == 'broken':
+            raise exception.DBError(Exception())
+        self.writes.append((instance_id, values))
+
+    def test_updates_are_merged_until_settled(self):
+        self.journal.update(1, {'host': 'compute1'})
+        self.journal.set_state(1, power_state.NOSTATE, 'networking')
+        self.journal.set_state(1, power_state.NOSTATE, 'spawning')
+        self.assertEqual([], self.writes)
+        self.journal.set_state(1, power_state.RUNNING)
+        self.assertEqual([(1, {'host': 'compute1',
+                               'state': power_state.RUNNING,
+                               'state_description': 'running'})],
+                         self.writes)
+        self.assertEqual((4, 1), (self.journal.updates, self.journal.writes))
+        self.assertEqual([FLAGS.state_flush_interval] * 3, self.scheduled)
+
+    def test_flush_writes_one_update_per_instance(self):
+        self.journal.set_state(1, power_state.NOSTATE, 'spawning')
+        self.journal.set_state(2, power_state.NOSTATE, 'spawning')
+        self.journal.update(1, {'host': 'compute1'})
+        self.journal.flush()
+        self.assertEqual(2, len(self.writes))
+        self.assertEqual({}, self.journal.pending(1))
+
+    def test_zero_interval_writes_at_once(self):
+        FLAGS.state_flush_interval = 0
+        self.journal.set_state(1, power_state.NOSTATE, 'spawning')
+        self.assertEqual(1, len(self.writes))
+
+    def test_failed_write_stays_pending(self):
+        self.journal.set_state('broken', power_state.NOSTATE, 'spawning')
+        self.journal.flush()
+        self.assertEqual({'state': power_state.NOSTATE,
+                          'state_description': 'spawning'},
+                         self.journal.pending('broken'))
+        self.assertEqual(1.0, self.scheduled[-1])
+
+    def test_missing_instance_is_dropped(self):
+        self.journal.set_state('gone', power_state.SHUTDOWN)
+        self.assertEqual({}, self.journal.pending('gone'))
@@ -15,8 +15,11 @@
 #    under the License.
 
 import os
+import time
 
+from nova import exception
 from nova import test
+from nova import utils
 from nova.utils import parse_mailmap, str_dict_replace
 
 
@@ -53,3 +56,25 @@ class ProjectTestCase(test.TestCase):
                                 '%r not listed in Authors' % missing)
             finally:
                 tree.unlock()
+
+
+class ExecuteTestCase(test.TestCase):
+    def test_output_and_input(self):
+        self.assertEqual(('data', ''),
+                         utils.execute('cat', process_input='data'))
+        self.assertRaises(exception.ProcessExecutionError,
+                          utils.execute, 'false')
+
+    def test_timeout_kills_command(self):
+        start = time.time()
+        self.assertRaises(exception.ProcessExecutionError,
+                          utils.execute, 'sleep 10', timeout=0.2)
+        self.assertTrue(time.time() - start < 5)
+
+    def test_commands_share_their_class_limit(self):
+        self.flags(execute_concurrency=['qemu-img:1'])
+        limit = utils._execute_semaphore('qemu-img convert a b')
+        self.assertEqual(1, limit.balance)
+        self.assertTrue(limit is utils._execute_semaphore(
+                'sudo -E /usr/bin/qemu-img info a'))
+        self.assertEqual(None, utils._execute_semaphore('ls'))
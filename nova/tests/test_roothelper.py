@@ -0,0 +1,100 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import shutil
+import signal
+import tempfile
+import time
+
+from eventlet import greenpool
+
+from nova import exception
+from nova import roothelper
+from nova import test
+from nova import utils
+
+
+class RootHelperTestCase(test.TestCase):
+    def setUp(self):
+        super(RootHelperTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        path = os.path.join(self.tmpdir, 'helper.sock')
+        self.flags(root_helper_socket=path,
+                   root_helper_commands=['cat', 'echo', 'false', 'sleep'])
+        self.helper = roothelper.RootHelper()
+        server = self.helper.listen()
+        self.pid = os.fork()
+        if not self.pid:
+            try:
+                self.helper.serve(server)
+            finally:
+                os._exit(0)
+        server.close()
+
+    def tearDown(self):
+        os.kill(self.pid, signal.SIGKILL)
+        os.waitpid(self.pid, 0)
+        shutil.rmtree(self.tmpdir)
+        super(RootHelperTestCase, self).tearDown()
+
+    def test_can_run(self):
+        self.assertTrue(roothelper.can_run('sudo echo hi'))
+        self.assertFalse(roothelper.can_run('echo hi'))
+        self.assertFalse(roothelper.can_run('sudo -E echo hi'))
+        self.assertFalse(roothelper.can_run('sudo ls'))
+        self.assertFalse(roothelper.can_run('sudo /tmp/x/echo hi'))
+        self.assertFalse(roothelper.can_run('sudo echo hi &'))
+        roothelper.FLAGS.root_helper_socket = ''
+        self.assertFalse(roothelper.can_run('sudo echo hi'))
+
+    def test_execute_goes_through_helper(self):
+        self.assertEqual(('hi\n', ''), utils.execute('sudo echo hi'))
+        self.assertEqual(('data', ''),
+                         utils.execute('sudo cat', process_input='data'))
+
+    def test_commands_must_be_allowed(self):
+        self.assertEqual(126, self.helper.run('ls')[0])
+        self.assertEqual(126, self.helper.run('/tmp/x/echo hi')[0])
+        self.assertEqual(126, self.helper.run('./echo hi')[0])
+
+    def test_batch_stops_at_checked_failure(self):
+        self.assertEqual([('a\n', ''), ('', ''), ('b\n', '')],
+                         utils.execute_batch([('sudo echo a', True),
+                                              ('sudo false', False),
+                                              ('sudo echo b', True)]))
+        self.assertRaises(exception.ProcessExecutionError,
+                          utils.execute_batch,
+                          [('sudo false', True), ('sudo echo a', True)])
+        results = self.helper.run_batch([('false', None, True),
+                                         ('echo', None, True)])
+        self.assertEqual(1, len(results))
+
+    def test_commands_run_concurrently(self):
+        pool = greenpool.GreenPool()
+        start = time.time()
+        for _i in xrange(3):
+            pool.spawn_n(self.helper.run, 'sleep 0.5')
+        pool.waitall()
+        self.assertTrue(time.time() - start < 1.2)
+
+    def test_timeout_kills_command(self):
+        start = time.time()
+        self.assertEqual(None, self.helper.run('sleep 10', timeout=0.2)[0])
+        self.assertRaises(exception.ProcessExecutionError,
+                          utils.execute, 'sudo sleep 10', timeout=0.2)
+        self.assertTrue(time.time() - start < 5)
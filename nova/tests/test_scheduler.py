@@ -20,6 +20,9 @@ Tests For Scheduler
 """
 
 import datetime
+import os
+import random
+import tempfile
 
 from mox import IgnoreArg
 from nova import context
@@ -30,12 +33,16 @@ from nova import test
 from nova import rpc
 from nova import utils
 from nova.auth import manager as auth_manager
+from nova.compute import power_state
 from nova.scheduler import manager
 from nova.scheduler import driver
+from nova.scheduler import liveness
+from nova.scheduler import simulator
 
 
 FLAGS = flags.FLAGS
 flags.DECLARE('max_cores', 'nova.scheduler.simple')
+flags.DECLARE('max_memory_mb', 'nova.scheduler.weighted')
 flags.DECLARE('stub_network', 'nova.compute.manager')
 
 
@@ -76,6 +83,18 @@ class SchedulerTestCase(test.TestCase):
         self.mox.ReplayAll()
         scheduler.named_method(ctxt, 'topic', num=7)
 
+    def test_run_instances_casts_once_per_host(self):
+        scheduler = manager.SchedulerManager()
+        self.mox.StubOutWithMock(rpc, 'cast', use_mock_anything=True)
+        ctxt = context.get_admin_context()
+        rpc.cast(ctxt,
+                 'topic.fallback_host',
+                 {'method': 'run_instances',
+                  'args': {'instance_ids': [1, 2, 3],
+                           'num': 7}})
+        self.mox.ReplayAll()
+        scheduler.run_instances(ctxt, 'topic', instance_ids=[1, 2, 3], num=7)
+
 
 class ZoneSchedulerTestCase(test.TestCase):
     """Test case for zone scheduler"""
@@ -329,6 +348,25 @@ class SimpleDriverTestCase(test.TestCase):
         compute1.kill()
         compute2.kill()
 
+    def test_failed_instance_releases_the_reservation(self):
+        """Ensures earlier instances give back their host on failure"""
+        compute1 = service.Service('host1',
+                                   'nova-compute',
+                                   'compute',
+                                   FLAGS.compute_manager)
+        compute1.start()
+        instance_ids = [self._create_instance()
+                        for index in xrange(FLAGS.max_cores + 1)]
+        self.assertRaises(driver.NoValidHost,
+                          self.scheduler.driver.schedule_run_instances,
+                          self.context,
+                          instance_ids)
+        for instance_id in instance_ids:
+            instance_ref = db.instance_get(self.context, instance_id)
+            self.assertEqual(None, instance_ref['host'])
+            db.instance_destroy(self.context, instance_id)
+        compute1.kill()
+
     def test_least_busy_host_gets_volume(self):
         """Ensures the host with less gigabytes gets the next one"""
         volume1 = service.Service('host1',
@@ -384,3 +422,396 @@ class SimpleDriverTestCase(test.TestCase):
             volume2.delete_volume(self.context, volume_id)
         volume1.kill()
         volume2.kill()
+
+
+def _no_small_hosts(state, instance_ref, candidates):
+    """Filter for tests that drops hosts whose name ends in 'small'"""
+    return [i for i in candidates if not state.hosts[i].endswith('small')]
+
+
+class WeightedSchedulerTestCase(test.TestCase):
+    """Test case for weighted scheduler"""
+    def setUp(self):
+        super(WeightedSchedulerTestCase, self).setUp()
+        self.flags(max_cores=4,
+                   max_memory_mb=2048,
+                   max_local_gb=100,
+                   scheduler_driver='nova.scheduler.weighted.'
+                                    'WeightedScheduler')
+        self.scheduler = manager.SchedulerManager()
+        self.context = context.get_admin_context()
+        self.service_ids = []
+        self.instance_ids = []
+
+    def tearDown(self):
+        for instance_id in self.instance_ids:
+            db.instance_destroy(self.context, instance_id)
+        for service_id in self.service_ids:
+            db.service_destroy(self.context, service_id)
+        super(WeightedSchedulerTestCase, self).tearDown()
+
+    def _create_service(self, host, zone='nova', disabled=False):
+        service_ref = db.service_create(self.context,
+                                        {'host': host,
+                                         'binary': 'nova-compute',
+                                         'topic': 'compute',
+                                         'report_count': 0,
+                                         'availability_zone': zone})
+        db.service_update(self.context, service_ref['id'],
+                          {'disabled': disabled})
+        self.service_ids.append(service_ref['id'])
+        return service_ref['id']
+
+    def _create_instance(self, host=None, vcpus=1, memory_mb=512,
+                         local_gb=0, availability_zone=None):
+        inst = {'image_id': 'ami-test',
+                'reservation_id': 'r-fakeres',
+                'instance_type': 'm1.tiny',
+                'mac_address': utils.generate_mac(),
+                'host': host,
+                'vcpus': vcpus,
+                'memory_mb': memory_mb,
+                'local_gb': local_gb,
+                'availability_zone': availability_zone}
+        instance_id = db.instance_create(self.context, inst)['id']
+        self.instance_ids.append(instance_id)
+        return instance_id
+
+    def _schedule(self, instance_id):
+        return self.scheduler.driver.schedule_run_instance(self.context,
+                                                           instance_id)
+
+    def test_least_loaded_host_gets_instance(self):
+        self._create_service('host1')
+        self._create_service('host2')
+        self._create_instance(host='host1')
+        instance_id = self._create_instance()
+        self.assertEqual('host2', self._schedule(instance_id))
+        instance_ref = db.instance_get(self.context, instance_id)
+        self.assertEqual('host2', instance_ref['host'])
+
+    def test_negative_weight_packs(self):
+        self.flags(scheduler_cost_functions=['cores:-1.0'])
+        self._create_service('host1')
+        self._create_service('host2')
+        self._create_instance(host='host1')
+        instance_id = self._create_instance()
+        self.assertEqual('host1', self._schedule(instance_id))
+
+    def test_skips_disabled_host(self):
+        self._create_service('host1', disabled=True)
+        self._create_service('host2')
+        self._create_instance(host='host2')
+        instance_id = self._create_instance()
+        self.assertEqual('host2', self._schedule(instance_id))
+
+    def test_skips_dead_host(self):
+        service_id = self._create_service('host1')
+        self._create_service('host2')
+        self._create_instance(host='host2')
+        past = datetime.datetime.utcnow() - datetime.timedelta(
+                seconds=FLAGS.service_down_time * 2)
+        db.service_update(self.context, service_id, {'updated_at': past})
+        instance_id = self._create_instance()
+        self.assertEqual('host2', self._schedule(instance_id))
+
+    def test_respects_availability_zone(self):
+        self._create_service('host1', zone='zone1')
+        self._create_service('host2', zone='zone2')
+        self._create_instance(host='host2')
+        instance_id = self._create_instance(availability_zone='zone2')
+        self.assertEqual('host2', self._schedule(instance_id))
+
+    def test_too_much_memory(self):
+        self._create_service('host1')
+        self._create_service('host2')
+        self._create_instance(host='host1', memory_mb=2048)
+        self._create_instance(host='host2', memory_mb=1536)
+        instance_id = self._create_instance(memory_mb=1024)
+        self.assertRaises(driver.NoValidHost, self._schedule, instance_id)
+
+    def test_too_much_disk(self):
+        self._create_service('host1')
+        self._create_instance(host='host1', local_gb=90)
+        instance_id = self._create_instance(local_gb=20)
+        self.assertRaises(driver.NoValidHost, self._schedule, instance_id)
+
+    def test_specific_host_gets_instance(self):
+        self._create_service('host1', disabled=True)
+        self._create_service('host2')
+        instance_id = self._create_instance(availability_zone='nova:host1')
+        self.assertEqual('host1', self._schedule(instance_id))
+
+    def test_custom_filter_by_import_path(self):
+        self.flags(scheduler_filters=['alive',
+                                      'nova.tests.test_scheduler.'
+                                      '_no_small_hosts'])
+        self._create_service('host1small')
+        self._create_service('host2')
+        self._create_instance(host='host2', vcpus=3)
+        instance_id = self._create_instance()
+        self.assertEqual('host2', self._schedule(instance_id))
+
+    def test_no_hosts(self):
+        instance_id = self._create_instance()
+        self.assertRaises(driver.NoValidHost, self._schedule, instance_id)
+
+    def test_batch_spreads_across_hosts(self):
+        self._create_service('host1')
+        self._create_service('host2')
+        instance_ids = [self._create_instance() for i in xrange(4)]
+        placement = self.scheduler.driver.schedule_run_instances(
+                self.context, instance_ids)
+        self.assertEqual(2, len(placement['host1']))
+        self.assertEqual(2, len(placement['host2']))
+        for host, host_instance_ids in placement.iteritems():
+            for instance_id in host_instance_ids:
+                instance_ref = db.instance_get(self.context, instance_id)
+                self.assertEqual(host, instance_ref['host'])
+
+    def test_batch_pack_policy(self):
+        self._create_service('host1')
+        self._create_service('host2')
+        self._create_instance(host='host2')
+        instance_ids = [self._create_instance() for i in xrange(3)]
+        placement = self.scheduler.driver.schedule_run_instances(
+                self.context, instance_ids, policy='pack')
+        self.assertEqual({'host2': instance_ids}, placement)
+
+    def test_batch_larger_than_capacity(self):
+        self._create_service('host1')
+        instance_ids = [self._create_instance() for i in xrange(5)]
+        self.assertRaises(driver.NoValidHost,
+                          self.scheduler.driver.schedule_run_instances,
+                          self.context, instance_ids)
+        for instance_id in instance_ids:
+            instance_ref = db.instance_get(self.context, instance_id)
+            self.assertEqual(None, instance_ref['host'])
+
+    def test_run_instances_casts_batches(self):
+        self._create_service('host1')
+        self._create_service('host2')
+        instance_ids = [self._create_instance() for i in xrange(2)]
+        self.mox.StubOutWithMock(rpc, 'cast', use_mock_anything=True)
+        rpc.cast(self.context, 'compute.host1',
+                 {'method': 'run_instances',
+                  'args': {'instance_ids': IgnoreArg()}}).InAnyOrder()
+        rpc.cast(self.context, 'compute.host2',
+                 {'method': 'run_instances',
+                  'args': {'instance_ids': IgnoreArg()}}).InAnyOrder()
+        self.mox.ReplayAll()
+        self.scheduler.run_instances(self.context, 'compute',
+                                     instance_ids=instance_ids)
+
+    def test_claim_with_stale_generation_conflicts(self):
+        self._create_service('host1')
+        instance_id = self._create_instance()
+        db.instance_claim_host(self.context, 'host1', 0, [instance_id])
+        self.assertRaises(db.HostClaimConflict,
+                          db.instance_claim_host,
+                          self.context, 'host1', 0, [instance_id])
+        db.instance_claim_host(self.context, 'host1', 1, [instance_id])
+
+    def _stale_host_state(self, times):
+        """Makes host_state return snapshots that another scheduler beats.
+
+        Before each of the first `times` snapshots is returned an instance
+        is claimed behind its back on every host.
+        """
+        scheduler_driver = self.scheduler.driver
+        real_host_state = scheduler_driver.host_state
+        calls = []
+
+        def host_state(context):
+            state = real_host_state(context)
+            calls.append(state)
+            if len(calls) <= times:
+                for host, generation in zip(state.hosts, state.generations):
+                    other_id = self._create_instance()
+                    db.instance_claim_host(context, host, generation,
+                                           [other_id])
+            return state
+
+        self.stubs.Set(scheduler_driver, 'host_state', host_state)
+        return calls
+
+    def test_lost_claim_is_placed_again(self):
+        self._create_service('host1')
+        self._create_service('host2')
+        self._create_instance(host='host2')
+        instance_id = self._create_instance()
+        calls = self._stale_host_state(1)
+        host = self._schedule(instance_id)
+        self.assertEqual(2, len(calls))
+        self.assertEqual(1, self.scheduler.driver.claim_conflicts)
+        instance_ref = db.instance_get(self.context, instance_id)
+        self.assertEqual(host, instance_ref['host'])
+
+    def test_gives_up_after_claim_retries(self):
+        self.flags(scheduler_claim_retries=1)
+        self._create_service('host1')
+        instance_id = self._create_instance()
+        self._stale_host_state(2)
+        self.assertRaises(driver.NoValidHost, self._schedule, instance_id)
+        instance_ref = db.instance_get(self.context, instance_id)
+        self.assertEqual(None, instance_ref['host'])
+
+    def test_failed_reservation_releases_its_claims(self):
+        self.flags(scheduler_claim_retries=1)
+        self._create_service('host1')
+        self._create_service('host2')
+        instance_ids = [self._create_instance() for _i in xrange(2)]
+        hosts = dict(zip(instance_ids, ['host1', 'host2']))
+        scheduler_driver = self.scheduler.driver
+        real_host_state = scheduler_driver.host_state
+
+        def host_state(context):
+            state = real_host_state(context)
+            index = state.hosts.index('host2')
+            db.instance_claim_host(context, 'host2',
+                                   state.generations[index],
+                                   [self._create_instance()])
+            return state
+
+        self.stubs.Set(scheduler_driver, 'host_state', host_state)
+        self.stubs.Set(scheduler_driver, 'select_host',
+                       lambda state, instance_ref, policy=None:
+                               state.hosts.index(hosts[instance_ref['id']]))
+        self.assertRaises(driver.NoValidHost,
+                          scheduler_driver.schedule_run_instances,
+                          self.context, instance_ids)
+        for instance_id in instance_ids:
+            instance_ref = db.instance_get(self.context, instance_id)
+            self.assertEqual(None, instance_ref['host'])
+
+    def test_host_subset_picks_among_cheapest(self):
+        self.flags(scheduler_host_subset_size=2)
+        self._create_service('host1')
+        self._create_service('host2')
+        self._create_service('host3')
+        self._create_instance(host='host1')
+        self._create_instance(host='host2')
+        self._create_instance(host='host2')
+        self.stubs.Set(random, 'choice', lambda seq: seq[-1])
+        self.assertEqual('host1', self._schedule(self._create_instance()))
+
+
+class SimulatorTestCase(test.TestCase):
+    """Test case for the scheduler simulator"""
+    def setUp(self):
+        super(SimulatorTestCase, self).setUp()
+        self.flags(max_cores=4, max_memory_mb=16384, connection_type='fake')
+        self.simulator = simulator.Simulator(
+                'nova.scheduler.weighted.WeightedScheduler', num_hosts=2)
+
+    def tearDown(self):
+        self.simulator.destroy()
+        super(SimulatorTestCase, self).tearDown()
+
+    def test_generated_trace_is_repeatable(self):
+        trace = simulator.generate_trace(50, seed=42)
+        self.assertEqual(trace, simulator.generate_trace(50, seed=42))
+        self.assertEqual(50, len(trace))
+
+    def test_trace_file_round_trip(self):
+        trace = [('run', '1', 'm1.small'),
+                 ('run', '2', 'm1.tiny'),
+                 ('terminate', '1', None)]
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            simulator.save_trace(trace, path)
+            self.assertEqual(trace, simulator.load_trace(path))
+        finally:
+            os.unlink(path)
+
+    def test_replay(self):
+        trace = [('run', 1, 'm1.medium'),
+                 ('run', 2, 'm1.medium'),
+                 ('run', 3, 'm1.large'),
+                 ('terminate', 1, None),
+                 ('run', 4, 'm1.large')]
+        stats = self.simulator.replay(trace)
+        self.assertEqual(4, stats['decisions'])
+        self.assertEqual(1, stats['rejected'])
+        self.assertEqual(1, stats['terminated'])
+        self.assertEqual(2, stats['running'])
+        self.assertEqual(2, stats['used_hosts'])
+        self.assertEqual(0.75, stats['cores_efficiency'])
+        for instance_id in self.simulator.instances.values():
+            instance_ref = db.instance_get(self.simulator.context,
+                                           instance_id)
+            self.assertEqual(power_state.RUNNING, instance_ref['state'])
+
+
+class LivenessTestCase(test.TestCase):
+    """Test case for heartbeats received over rpc"""
+    def setUp(self):
+        super(LivenessTestCase, self).setUp()
+        liveness.LivenessView.instance()
+        self.view = liveness.LivenessView()
+        self.stubs.Set(liveness.LivenessView, '_instance', self.view)
+        self.scheduler = manager.SchedulerManager()
+        self.context = context.get_admin_context()
+        self.service_ids = []
+
+    def tearDown(self):
+        for service_id in self.service_ids:
+            db.service_destroy(self.context, service_id)
+        super(LivenessTestCase, self).tearDown()
+
+    def _create_service(self, host):
+        service_ref = db.service_create(self.context,
+                                        {'host': host,
+                                         'binary': 'nova-compute',
+                                         'topic': 'compute',
+                                         'report_count': 0})
+        self.service_ids.append(service_ref['id'])
+        return service_ref['id']
+
+    def test_heartbeat_keeps_service_up(self):
+        service_id = self._create_service('host1')
+        past = datetime.datetime.utcnow() - datetime.timedelta(
+                seconds=FLAGS.service_down_time * 2)
+        db.service_update(self.context, service_id, {'updated_at': past})
+        service_ref = db.service_get(self.context, service_id)
+        self.assertFalse(driver.Scheduler.service_is_up(service_ref))
+        self.scheduler.service_heartbeat(self.context, service_id=service_id)
+        self.assertTrue(driver.Scheduler.service_is_up(service_ref))
+
+    def test_flush_writes_batched_counts(self):
+        service1 = self._create_service('host1')
+        service2 = self._create_service('host2')
+        self.scheduler.service_heartbeat(self.context, service_id=service1)
+        self.scheduler.service_heartbeat(self.context, service_id=service1)
+        self.scheduler.service_heartbeat(self.context, service_id=service2)
+        self.scheduler.flush_heartbeats()
+        self.assertEqual({}, self.view.pending)
+        service_ref = db.service_get(self.context, service1)
+        self.assertEqual(2, service_ref['report_count'])
+        self.assert_(service_ref['updated_at'])
+        self.assertEqual(1,
+                         db.service_get(self.context,
+                                        service2)['report_count'])
+
+    def test_failed_flush_keeps_heartbeats(self):
+        service_id = self._create_service('host1')
+        self.scheduler.service_heartbeat(self.context, service_id=service_id)
+
+        def fail(*args):
+            raise Exception()
+
+        self.stubs.Set(db, 'service_report_heartbeats', fail)
+        self.scheduler.flush_heartbeats()
+        self.assertEqual({service_id: 1}, self.view.pending)
+
+    def test_flush_writes_reported_state(self):
+        service_id = self._create_service('host1')
+        self.scheduler.service_heartbeat(self.context, service_id=service_id,
+                                         state={'builds_running': 3,
+                                                'builds_queued': 7})
+        self.scheduler.flush_heartbeats()
+        service_ref = db.service_get(self.context, service_id)
+        self.assertEqual(3, service_ref['builds_running'])
+        self.assertEqual(7, service_ref['builds_queued'])
+        self.assertEqual({}, self.view.states)
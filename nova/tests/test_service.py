@@ -258,3 +258,99 @@ class ServiceTestCase(test.TestCase):
         serv.report_state()
 
         self.assert_(not serv.model_disconnected)
+
+    def test_report_state_includes_manager_state(self):
+        host = 'foo'
+        binary = 'bar'
+        topic = 'test'
+        service_ref = {'host': host,
+                       'binary': binary,
+                       'topic': topic,
+                       'report_count': 0,
+                       'availability_zone': 'nova',
+                       'id': 1}
+
+        service.db.service_get_by_args(mox.IgnoreArg(),
+                                      host,
+                                      binary).AndReturn(service_ref)
+        service.db.service_get(mox.IgnoreArg(),
+                               service_ref['id']).AndReturn(service_ref)
+        service.db.service_update(mox.IgnoreArg(), service_ref['id'],
+                                  {'report_count': 1, 'builds_queued': 2})
+
+        self.mox.ReplayAll()
+        serv = service.Service(host,
+                               binary,
+                               topic,
+                               'nova.tests.test_service.FakeManager')
+        serv.start()
+        self.stubs.Set(serv.manager, 'service_state',
+                       lambda: {'builds_queued': 2})
+        serv.report_state()
+
+    def test_report_state_via_rpc(self):
+        self.flags(heartbeat_via_rpc=True)
+        host = 'foo'
+        binary = 'bar'
+        topic = 'test'
+        service_create = {'host': host,
+                          'binary': binary,
+                          'topic': topic,
+                          'report_count': 0,
+                          'availability_zone': 'nova'}
+        service_ref = {'host': host,
+                          'binary': binary,
+                          'topic': topic,
+                          'report_count': 0,
+                          'availability_zone': 'nova',
+                          'id': 1}
+
+        service.db.service_get_by_args(mox.IgnoreArg(),
+                                      host,
+                                      binary).AndRaise(exception.NotFound())
+        service.db.service_create(mox.IgnoreArg(),
+                                  service_create).AndReturn(service_ref)
+        self.mox.StubOutWithMock(rpc, 'cast', use_mock_anything=True)
+        rpc.cast(mox.IgnoreArg(),
+                 FLAGS.scheduler_topic,
+                 {'method': 'service_heartbeat',
+                  'args': {'service_id': service_ref['id']}})
+
+        self.mox.ReplayAll()
+        serv = service.Service(host,
+                               binary,
+                               topic,
+                               'nova.tests.test_service.FakeManager')
+        serv.start()
+        serv.report_state()
+
+    def test_report_state_via_rpc_survives_failed_cast(self):
+        self.flags(heartbeat_via_rpc=True)
+        host = 'foo'
+        binary = 'bar'
+        topic = 'test'
+        service_ref = {'host': host,
+                       'binary': binary,
+                       'topic': topic,
+                       'report_count': 0,
+                       'availability_zone': 'nova',
+                       'id': 1}
+
+        service.db.service_get_by_args(mox.IgnoreArg(),
+                                      host,
+                                      binary).AndReturn(service_ref)
+        self.mox.StubOutWithMock(rpc, 'cast', use_mock_anything=True)
+        rpc.cast(mox.IgnoreArg(), FLAGS.scheduler_topic,
+                 mox.IgnoreArg()).AndRaise(IOError('broker went away'))
+        rpc.cast(mox.IgnoreArg(), FLAGS.scheduler_topic, mox.IgnoreArg())
+
+        self.mox.ReplayAll()
+        serv = service.Service(host,
+                               binary,
+                               topic,
+                               'nova.tests.test_service.FakeManager')
+        serv.start()
+        serv.report_state()
+        self.assert_(serv.model_disconnected)
+        serv.report_state()
+        self.assert_(not serv.model_disconnected)
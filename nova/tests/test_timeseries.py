@@ -0,0 +1,205 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import datetime
+import os
+import shutil
+import struct
+import tempfile
+import time
+import zlib
+
+from nova import test
+from nova.compute import monitor
+from nova.compute import timeseries
+
+
+class TimeSeriesTestCase(test.TestCase):
+    def setUp(self):
+        super(TimeSeriesTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'net.ts')
+        self.sources = [('cpu', timeseries.GAUGE),
+                        ('rx', timeseries.COUNTER)]
+        self.tiers = ((1, 4), (2, 4))
+        self.series = self._open()
+
+    def tearDown(self):
+        self.series.close()
+        shutil.rmtree(self.tmpdir)
+        super(TimeSeriesTestCase, self).tearDown()
+
+    def _open(self, sources=None):
+        return timeseries.Series(self.path, sources or self.sources, 10,
+                                 self.tiers)
+
+    def test_gauges_and_counter_rates(self):
+        self.series.update([50, 1000], 1000)
+        self.series.update([70, 1500], 1010)
+        seconds, points = self.series.fetch(1000, 1010)
+        self.assertEqual(10, seconds)
+        self.assertEqual([(1000, [50.0, None]), (1010, [70.0, 50.0])],
+                         points)
+
+    def test_older_samples_are_ignored(self):
+        self.assertTrue(self.series.update([50, 0], 1000))
+        self.assertFalse(self.series.update([60, 0], 1000))
+        self.assertEqual([(1000, [50.0, None])],
+                         self.series.fetch(1000, 1000)[1])
+
+    def test_coarse_tier_keeps_average_and_peak(self):
+        for timestamp, cpu in ((1000, 10), (1010, 30), (1020, 50)):
+            self.series.update([cpu, None], timestamp)
+        seconds, points = self.series.fetch(960, 1020)
+        self.assertEqual(20, seconds)
+        self.assertEqual([(960, [None, None]), (980, [None, None]),
+                          (1000, [20.0, None]), (1020, [50.0, None])],
+                         points)
+        self.assertEqual((1000, [30.0, None]),
+                         self.series.fetch(960, 1020, peak=True)[1][2])
+
+    def test_ring_drops_old_rows(self):
+        for i in xrange(6):
+            self.series.update([i, None], 1000 + 10 * i)
+        points = self.series.fetch(1010, 1040)[1]
+        self.assertEqual((1010, [None, None]), points[0])
+        self.assertEqual((1020, [2.0, None]), points[1])
+
+    def test_samples_persist(self):
+        self.series.update([50, 1000], 1000)
+        self.series.close()
+        self.series = self._open()
+        self.series.update([50, 2000], 1010)
+        self.assertEqual([50.0, 100.0], self.series.fetch(1010, 1010)[1][0][1])
+
+    def test_changed_layout_is_recreated(self):
+        self.series.update([50, 1000], 1000)
+        self.series.close()
+        self.series = self._open([('cpu', timeseries.GAUGE)])
+        self.assertEqual([(1000, [None])], self.series.fetch(1000, 1000)[1])
+
+    def test_render_png(self):
+        points = [(0, [10.0, 5.0]), (10, [None, 20.0])]
+        png = timeseries.render_png(points, ['00ff00', '0000ff'],
+                                    width=4, height=3)
+        self.assertEqual('\x89PNG\r\n\x1a\n', png[:8])
+        width, height = struct.unpack('>II', png[16:24])
+        self.assertEqual((4, 3), (width, height))
+        length = struct.unpack('>I', png[33:37])[0]
+        rows = zlib.decompress(png[41:41 + length])
+        self.assertEqual(3 * (1 + 4 * 3), len(rows))
+        self.assertEqual('\x00\xff\x00', rows[14:17])
+        self.assertEqual('\x00\x00\xff', rows[-12:-9])
+
+
+class FakeConnection(object):
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.device_lookups = 0
+
+    def list_instances(self):
+        return ['instance-1']
+
+    def get_devices(self, instance_id):
+        self.device_lookups += 1
+        return {'disks': ['vda'], 'interfaces': ['vnet0']}
+
+    def get_instance_stats(self, instance_id, disks, interfaces):
+        time.sleep(self.delay)
+        if instance_id == 'broken':
+            raise Exception('domain vanished')
+        return {'cpu_time': 0,
+                'num_cpu': 1,
+                'disks': {'vda': [0, 3000, 0, 4000, 0]},
+                'interfaces': {'vnet0': [1000, 0, 0, 0, 2000]}}
+
+
+class MonitorTestCase(test.TestCase):
+    def setUp(self):
+        super(MonitorTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.flags(monitoring_rrd_path=self.tmpdir)
+        self.conn = FakeConnection()
+        self.instance = monitor.Instance(self.conn, 'instance-1')
+        self.monitor = monitor.InstanceMonitor()
+
+    def tearDown(self):
+        for series in self.instance.series.values():
+            series.close()
+        for instance in self.monitor._instances.values():
+            for series in instance.series.values():
+                series.close()
+        if self.monitor._pool:
+            self.monitor._pool.close()
+        if self.monitor._cycles:
+            self.monitor._cycles.close()
+        shutil.rmtree(self.tmpdir)
+        super(MonitorTestCase, self).tearDown()
+
+    def test_update_writes_series_without_graphs(self):
+        self.instance.update()
+        self.assertEqual(['cpu.ts', 'disk.ts', 'net.ts'],
+                         sorted(os.listdir(os.path.join(self.tmpdir,
+                                                        'instance-1'))))
+
+    def test_graph_is_drawn_on_request(self):
+        self.instance.update()
+        for name in monitor.SERIES:
+            for duration in monitor.DURATIONS:
+                png = monitor.graph(self.instance, name, duration)
+                self.assertEqual('\x89PNG', png[:4])
+
+    def test_graphs_are_served_on_the_configured_host(self):
+        self.flags(monitoring_graph_host='127.0.0.2')
+        service = monitor.graph_service(self.monitor)
+        self.assertEqual({'interface': '127.0.0.2'}, service.kwargs)
+
+    def test_devices_are_parsed_once(self):
+        self.instance.collect()
+        self.instance.collect()
+        self.assertEqual(1, self.conn.device_lookups)
+        self.instance.devices_expire = 0
+        self.instance.collect()
+        self.assertEqual(2, self.conn.device_lookups)
+
+    def test_workers_call_the_driver_directly(self):
+        conn = monitor._thread_connection()
+        self.assertTrue(conn is monitor._thread_connection())
+        self.assertFalse(conn.use_tpool)
+
+    def test_departed_domains_are_dropped(self):
+        self.stubs.Set(monitor, '_thread_connection', lambda: self.conn)
+        self.monitor.updateInstances_(self.conn, ['instance-1', 'instance-2'])
+        departed = self.monitor._instances['instance-2']
+        self.monitor.updateInstances_(self.conn, ['instance-1'])
+        self.assertEqual(['instance-1'], self.monitor._instances.keys())
+        self.assertRaises(ValueError, departed.series['cpu'].fetch, 0)
+
+    def test_domains_are_collected_concurrently(self):
+        self.flags(monitoring_workers=4)
+        self.stubs.Set(monitor, '_thread_connection', lambda: self.conn)
+        self.conn.delay = 0.2
+        domain_ids = ['instance-%d' % i for i in xrange(4)] + ['broken']
+        self.monitor.updateInstances_(self.conn, domain_ids)
+        self.assertTrue(self.monitor.last_cycle_duration < 0.6)
+        for domain_id in domain_ids[:4]:
+            instance = self.monitor._instances[domain_id]
+            self.assertNotEqual(datetime.datetime.min, instance.last_updated)
+        self.assertEqual(datetime.datetime.min,
+                         self.monitor._instances['broken'].last_updated)
+        self.assertTrue(os.path.exists(os.path.join(self.tmpdir,
+                                                    'cycle.ts')))
@@ -14,16 +14,34 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import hashlib
+import httplib
+import os
+import shutil
+import struct
+import tempfile
 from xml.etree.ElementTree import fromstring as xml_to_tree
 from xml.dom.minidom import parseString as xml_to_dom
 
+from eventlet import greenpool
+from eventlet import greenthread
+from eventlet import tpool
+
 from nova import context
 from nova import db
+from nova import exception
 from nova import flags
 from nova import test
 from nova import utils
 from nova.api.ec2 import cloud
 from nova.auth import manager
+from nova.compute import power_state
+from nova.compute import state_journal
+from nova.virt import configdrive
+from nova.virt import console_log
+from nova.virt import disk
+from nova.virt import image_cache
+from nova.virt import images
 from nova.virt import libvirt_conn
 
 FLAGS = flags.FLAGS
@@ -83,8 +101,21 @@ class LibvirtConnTestCase(test.TestCase):
         self._check_xml_and_uri(instance_data, expect_kernel=True,
                                 expect_ramdisk=True, rescue=True)
 
+    def test_xml_and_uri_config_drive(self):
+        self.flags(use_config_drive=True)
+        instance_data = dict(self.test_instance)
+        self._check_xml_and_uri(instance_data, expect_kernel=False,
+                                expect_ramdisk=False, config_drive=True)
+
+    def test_xml_and_uri_rescue_config_drive(self):
+        self.flags(use_config_drive=True)
+        instance_data = dict(self.test_instance)
+        self._check_xml_and_uri(instance_data, expect_kernel=True,
+                                expect_ramdisk=True, rescue=True,
+                                config_drive=True)
+
     def _check_xml_and_uri(self, instance, expect_ramdisk, expect_kernel,
-                           rescue=False):
+                           rescue=False, config_drive=False):
         user_context = context.RequestContext(project=self.project,
                                               user=self.user)
         instance_ref = db.instance_create(user_context, instance)
@@ -171,6 +202,12 @@ class LibvirtConnTestCase(test.TestCase):
             common_checks += [(lambda t: t.findall(
                 './devices/disk/source')[1].get('file').split('/')[1],
                                'disk.local')]
+        if config_drive:
+            config_drive_path = rescue and 'disk.config.rescue' or \
+                                'disk.config'
+            common_checks += [(lambda t: t.findall(
+                './devices/disk/source')[-1].get('file').split('/')[1],
+                               config_drive_path)]
 
         for (libvirt_type, (expected_uri, checks)) in type_uri_map.iteritems():
             FLAGS.libvirt_type = libvirt_type
@@ -205,12 +242,318 @@ class LibvirtConnTestCase(test.TestCase):
             uri = conn.get_uri()
             self.assertEquals(uri, testuri)
 
+    def test_prepare_images_skips_existing_disks(self):
+        instances_path = tempfile.mkdtemp()
+        self.flags(instances_path=instances_path)
+        instance_data = dict(self.test_instance)
+        instance_data['kernel_id'] = 'aki-deadbeef'
+        instance_data['user_id'] = self.user.id
+        user_context = context.RequestContext(project=self.project,
+                                              user=self.user)
+        instance_ref = db.instance_create(user_context, instance_data)
+        os.mkdir(os.path.join(instances_path, instance_ref['name']))
+        open(os.path.join(instances_path, instance_ref['name'],
+                          'kernel'), 'w').close()
+        created = []
+
+        def fake_cache_image(fn, target, fname, cow=False, *args, **kwargs):
+            created.append(os.path.basename(target))
+
+        conn = libvirt_conn.LibvirtConnection(True)
+        self.stubs.Set(conn, '_cache_image', fake_cache_image)
+        conn.prepare_images(instance_ref)
+        self.assertEqual(['disk', 'disk.local'], created)
+        actions = [action['action'].split()[0] for action in
+                   db.instance_get_actions(context.get_admin_context(),
+                                           instance_ref['id'])]
+        self.assertEqual(['spawn.disk', 'spawn.disk.local'], actions)
+        db.instance_destroy(user_context, instance_ref['id'])
+        shutil.rmtree(instances_path)
+
+    def test_write_config_drive(self):
+        target = os.path.join(tempfile.mkdtemp(), 'disk.config')
+        instance_ref = db.instance_create(context.get_admin_context(),
+                                          {'hostname': 'vm1',
+                                           'launch_index': 0,
+                                           'reservation_id': 'r-1',
+                                           'user_data': 'aGVsbG8='})
+        conn = libvirt_conn.LibvirtConnection(True)
+        conn._write_config_drive(instance_ref, target, 'ssh-rsa AAAA', None)
+        files = configdrive.read(open(target).read())
+        self.assertEqual(['authorized_keys', 'meta_data.json', 'user_data'],
+                         sorted(files))
+        self.assertEqual('ssh-rsa AAAA\n', files['authorized_keys'])
+        self.assertEqual('hello', files['user_data'])
+        self.assertEqual('vm1',
+                         utils.loads(files['meta_data.json'])['hostname'])
+        shutil.rmtree(os.path.dirname(target))
+
+    def test_init_host_syncs_states_in_bulk(self):
+        admin_context = context.get_admin_context()
+        running = db.instance_create(admin_context, {'host': 'fakehost'})
+        gone = db.instance_create(admin_context, {'host': 'fakehost'})
+
+        class FakeDomain(object):
+            def __init__(self, name):
+                self._name = name
+
+            def name(self):
+                return self._name
+
+            def info(self):
+                return (power_state.RUNNING, 0, 0, 1, 0)
+
+        class FakeLibvirt(object):
+            class libvirtError(Exception):
+                pass
+
+        class FakeConnection(object):
+            def getInfo(self):
+                pass
+
+            def listDomainsID(self):
+                return [1, 2]
+
+            def lookupByID(self, domain_id):
+                if domain_id == 2:
+                    raise FakeLibvirt.libvirtError('vanished')
+                return FakeDomain(running['name'])
+
+            def listDefinedDomains(self):
+                return []
+
+        self.stubs.Set(libvirt_conn, 'libvirt', FakeLibvirt)
+        conn = libvirt_conn.LibvirtConnection(True)
+        conn._wrapped_conn = FakeConnection()
+        filtered = []
+        self.stubs.Set(conn.firewall_driver, 'prepare_instance_filters',
+                       lambda instances: filtered.extend(instance['id']
+                                                         for instance in
+                                                         instances))
+        self.stubs.Set(conn.firewall_driver, 'apply_instance_filter',
+                       lambda instance: None)
+        conn.init_host('fakehost')
+        self.assertEqual(power_state.RUNNING,
+                         db.instance_get(admin_context,
+                                         running['id'])['state'])
+        self.assertEqual([running['id']], filtered)
+        self.assertEqual([running['id']],
+                         [instance['id'] for instance in
+                          db.instance_get_all_by_host(admin_context,
+                                                      'fakehost')])
+        db.instance_destroy(admin_context, running['id'])
+
+    def test_connection_is_checked_lazily(self):
+        class FakeLibvirt(object):
+            VIR_ERR_SYSTEM_ERROR = 38
+            VIR_FROM_REMOTE = 13
+
+            class virDomain(object):
+                pass
+
+            class libvirtError(Exception):
+                def get_error_code(self):
+                    return FakeLibvirt.VIR_ERR_SYSTEM_ERROR
+
+                def get_error_domain(self):
+                    return FakeLibvirt.VIR_FROM_REMOTE
+
+        class FakeConnection(object):
+            broken = False
+            checks = 0
+
+            def getInfo(self):
+                FakeConnection.checks += 1
+                if self.broken:
+                    raise FakeLibvirt.libvirtError()
+
+            def listDomainsID(self):
+                if self.broken:
+                    raise FakeLibvirt.libvirtError()
+                return []
+
+        connections = []
+
+        def fake_connect(uri, read_only):
+            if connections and connections[-1] is None:
+                raise IOError('libvirtd is down')
+            connections.append(FakeConnection())
+            return connections[-1]
+
+        self.stubs.Set(libvirt_conn, 'libvirt', FakeLibvirt)
+        self.stubs.Set(tpool, 'execute',
+                       lambda function, *args, **kwargs: function(*args,
+                                                                  **kwargs))
+        conn = libvirt_conn.LibvirtConnection(True)
+        self.stubs.Set(conn, '_connect', fake_connect)
+        self.stubs.Set(conn, '_register_domain_events', lambda conn: None)
+        for _i in xrange(3):
+            conn.list_instances()
+        self.assertEqual(1, len(connections))
+        self.assertEqual(0, FakeConnection.checks)
+
+        connections[0].broken = True
+        self.assertRaises(FakeLibvirt.libvirtError, conn.list_instances)
+        conn.list_instances()
+        self.assertEqual(2, len(connections))
+        self.assertEqual(1, FakeConnection.checks)
+
+        connections[1].broken = True
+        connections.append(None)
+        self.assertRaises(FakeLibvirt.libvirtError, conn.list_instances)
+        self.assertRaises(IOError, conn.list_instances)
+        self.assertRaises(exception.Error, conn.list_instances)
+        self.assertEqual(3, len(connections))
+
+    def test_threadpool_size_comes_from_the_environment_first(self):
+        class FakeTpool(object):
+            _setup_already = False
+            _nthreads = 20
+
+        self.flags(libvirt_threadpool_size=4)
+        self.stubs.Set(libvirt_conn, 'tpool', FakeTpool)
+        self.stubs.Set(os, 'environ', {'EVENTLET_THREADPOOL_SIZE': '2'})
+        libvirt_conn._size_threadpool()
+        self.assertEqual(20, FakeTpool._nthreads)
+        self.stubs.Set(os, 'environ', {})
+        libvirt_conn._size_threadpool()
+        self.assertEqual(4, FakeTpool._nthreads)
+        FakeTpool.set_num_threads = staticmethod(self.fail)
+        FakeTpool._setup_already = True
+        self.assertRaises(AssertionError, libvirt_conn._size_threadpool)
+
+    def test_connection_without_tpool_is_not_wrapped(self):
+        class FakeLibvirt(object):
+            VIR_CRED_AUTHNAME = 2
+            VIR_CRED_NOECHOPROMPT = 7
+
+            @staticmethod
+            def openReadOnly(uri):
+                connections.append(uri)
+                return uri
+
+        def fail(*args, **kwargs):
+            raise AssertionError('tpool used')
+
+        connections = []
+        self.stubs.Set(libvirt_conn, 'libvirt', FakeLibvirt)
+        self.stubs.Set(tpool, 'execute', fail)
+        conn = libvirt_conn.LibvirtConnection(True)
+        conn.use_tpool = False
+        self.assertEqual(conn.libvirt_uri, conn._conn)
+        self.assertEqual([conn.libvirt_uri], connections)
+
+    def test_run_stages(self):
+        calls = []
+
+        def ok():
+            calls.append('ok')
+
+        def fail():
+            calls.append('fail')
+            raise IOError('stage failed')
+
+        timings = utils.run_stages([('first', ok), ('second', ok)])
+        self.assertEqual(['first', 'second'],
+                         [name for name, _seconds in timings])
+        self.assertRaises(IOError, utils.run_stages,
+                          [('first', fail), ('second', ok)])
+        self.assertEqual(['ok', 'ok', 'fail', 'ok'], calls)
+
     def tearDown(self):
         super(LibvirtConnTestCase, self).tearDown()
         self.manager.delete_project(self.project)
         self.manager.delete_user(self.user)
 
 
+class ConfigDriveTestCase(test.TestCase):
+    def test_files_read_back(self):
+        files = {'authorized_keys': 'ssh-rsa AAAA\n',
+                 'interfaces': 'x' * 5000,
+                 'empty': ''}
+        image = configdrive.build(files)
+        self.assertEqual(0, len(image) % configdrive.SECTOR_SIZE)
+        self.assertEqual(configdrive.VOLUME_LABEL,
+                         image[16 * 2048 + 40:16 * 2048 + 72].strip())
+        self.assertEqual(files, configdrive.read(image))
+
+    def test_invalid_names_are_refused(self):
+        self.assertRaises(exception.Error, configdrive.build,
+                          {'etc/network/interfaces': ''})
+        self.assertRaises(exception.Error, configdrive.build,
+                          {'a' * 31: ''})
+
+
+class ConsoleLogTestCase(test.TestCase):
+    def setUp(self):
+        super(ConsoleLogTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'console.ring')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        super(ConsoleLogTestCase, self).tearDown()
+
+    def test_ring_keeps_last_bytes(self):
+        ring = console_log.RingFile(self.path, capacity=8)
+        ring.append('abcde')
+        ring.append('fghij')
+        self.assertEqual({'output': 'cdefghij', 'offset': 2,
+                          'next_offset': 10}, ring.read())
+        ring.append('0123456789klm')
+        self.assertEqual('789klm', ring.read(since_offset=17)['output'])
+        self.assertEqual(8 + 24, os.path.getsize(self.path))
+
+    def test_ring_reads_from_offset(self):
+        ring = console_log.RingFile(self.path, capacity=8)
+        ring.append('abcdef')
+        self.assertEqual({'output': 'ef', 'offset': 4, 'next_offset': 6},
+                         ring.read(since_offset=4))
+        self.assertEqual('', ring.read(since_offset=6)['output'])
+        ring.append('ghijkl')
+        self.assertEqual({'output': 'efghijkl', 'offset': 4,
+                          'next_offset': 12}, ring.read(since_offset=1))
+
+    def test_reads_are_capped(self):
+        self.flags(console_output_max_bytes=4)
+        self.assertEqual({'output': 'cdef', 'offset': 2, 'next_offset': 6},
+                         console_log.read_string('abcdef'))
+        self.assertEqual('ab', console_log.read_string(
+                'abcdef', since_offset=0, max_bytes=2)['output'])
+        self.assertEqual('abcd', console_log.read_string(
+                'abcdef', since_offset=0, max_bytes=100)['output'])
+
+    def test_negative_arguments_are_clamped(self):
+        self.flags(console_output_max_bytes=4)
+        self.assertEqual({'output': '', 'offset': 6, 'next_offset': 6},
+                         console_log.read_string('abcdef', max_bytes=-1))
+        self.assertEqual('abcd', console_log.read_string(
+                'abcdef', since_offset=-3)['output'])
+        with open(self.path, 'w') as f:
+            f.write('abcdef')
+        self.assertEqual('', console_log.read_file(
+                self.path, since_offset=0, max_bytes=-1)['output'])
+        os.unlink(self.path)
+        ring = console_log.RingFile(self.path, capacity=8)
+        ring.append('abcdef')
+        self.assertEqual('', ring.read(since_offset=0,
+                                       max_bytes=-1)['output'])
+
+    def test_libvirt_reads_console_log_tail(self):
+        instance_dir = os.path.join(self.tmpdir, 'instance-1')
+        os.mkdir(instance_dir)
+        with open(os.path.join(instance_dir, 'console.log'), 'w') as f:
+            f.write('boot\nlogin: ')
+        self.flags(instances_path=self.tmpdir, libvirt_type='kvm')
+        self.stubs.Set(utils, 'execute', lambda *args, **kwargs: ('', ''))
+        conn = libvirt_conn.LibvirtConnection.__new__(
+                libvirt_conn.LibvirtConnection)
+        output = conn.get_console_output({'name': 'instance-1'},
+                                         since_offset=5)
+        self.assertEqual({'output': 'login: ', 'offset': 5,
+                          'next_offset': 12}, output)
+
+
 class IptablesFirewallTestCase(test.TestCase):
     def setUp(self):
         super(IptablesFirewallTestCase, self).setUp()
@@ -366,6 +709,25 @@ class IptablesFirewallTestCase(test.TestCase):
                             in self.out_rules,
                         "TCP port 80/81 acceptance rule wasn't added")
 
+    def test_bulk_prepare_applies_ruleset_once(self):
+        commands = []
+
+        def fake_iptables_execute(cmd, process_input=None):
+            commands.append(cmd)
+            return '', ''
+
+        self.fw.execute = fake_iptables_execute
+        self.stubs.Set(self.fw, 'modify_rules',
+                       lambda current_lines, ip_version=4: current_lines)
+        self.flags(use_ipv6=False)
+        instances = [{'id': instance_id} for instance_id in (1, 2, 3)]
+        self.fw.prepare_instance_filters(instances)
+        self.assertEqual(['sudo iptables-save -t filter',
+                          'sudo iptables-restore'], commands)
+        self.assertEqual([1, 2, 3], sorted(self.fw.instances))
+        self.fw.prepare_instance_filters([])
+        self.assertEqual(2, len(commands))
+
 
 class NWFilterTestCase(test.TestCase):
     def setUp(self):
@@ -514,3 +876,438 @@ class NWFilterTestCase(test.TestCase):
         self.fw.apply_instance_filter(instance)
         _ensure_all_called()
         self.teardown_security_group()
+
+
+class ImageCacheTestCase(test.TestCase):
+    def setUp(self):
+        super(ImageCacheTestCase, self).setUp()
+        self.base_dir = os.path.join(tempfile.mkdtemp(), '_base')
+        self.cache = image_cache.ImageCache(self.base_dir)
+        self.fetched = []
+
+    def tearDown(self):
+        shutil.rmtree(os.path.dirname(self.base_dir))
+        super(ImageCacheTestCase, self).tearDown()
+
+    def _fetch(self, target, contents='image'):
+        self.fetched.append(target)
+        with open(target, 'w') as f:
+            f.write(contents)
+
+    def _slow_fetch(self, target):
+        greenthread.sleep(0)
+        self._fetch(target)
+
+    def _fail(self, target):
+        self._slow_fetch(target)
+        raise IOError('fetch failed')
+
+    def test_miss_then_hit(self):
+        base = self.cache.fetch('ami-1', self._fetch, contents='one')
+        self.assertEqual(os.path.join(self.base_dir, 'ami-1'), base)
+        self.assertEqual('one', open(base).read())
+        self.assertEqual(base, self.cache.fetch('ami-1', self._fetch))
+        self.assertEqual(1, len(self.fetched))
+        self.assertNotEqual(base, self.fetched[0])
+        self.assertEqual(['ami-1'], os.listdir(self.base_dir))
+        stats = self.cache.stats()
+        self.assertEqual((1, 1, 0),
+                         (stats['hits'], stats['misses'], stats['waits']))
+        self.assertEqual(0.5, stats['hit_ratio'])
+        self.assertEqual(1, stats['images'])
+
+    def test_concurrent_requests_share_one_fetch(self):
+        pool = greenpool.GreenPool()
+        results = list(pool.imap(lambda i: self.cache.fetch('ami-1',
+                                                            self._slow_fetch),
+                                 xrange(5)))
+        self.assertEqual(1, len(self.fetched))
+        self.assertEqual([results[0]] * 5, results)
+        stats = self.cache.stats()
+        self.assertEqual((0, 1, 4),
+                         (stats['hits'], stats['misses'], stats['waits']))
+
+    def test_failed_fetch_is_not_cached(self):
+        pool = greenpool.GreenPool()
+        waiter = pool.spawn(self.cache.fetch, 'ami-1', self._fetch)
+        self.assertRaises(IOError, self.cache.fetch, 'ami-1', self._fail)
+        self.assertRaises(IOError, waiter.wait)
+        self.assertEqual([], os.listdir(self.base_dir))
+        self.cache.fetch('ami-1', self._fetch)
+        self.assertEqual(['ami-1'], os.listdir(self.base_dir))
+
+    def _make_base(self, fname, last_used):
+        self.cache.fetch(fname, self._fetch, contents='x' * 8192)
+        os.utime(self.cache.path(fname), (last_used, last_used))
+
+    def _make_overlay(self, instance_name, base):
+        instance_dir = os.path.join(os.path.dirname(self.base_dir),
+                                    instance_name)
+        os.mkdir(instance_dir)
+        header = struct.pack('>4sIQI', image_cache.QCOW2_MAGIC, 2, 72,
+                             len(base))
+        with open(os.path.join(instance_dir, 'disk'), 'w') as f:
+            f.write(header.ljust(72, '\0') + base)
+
+    def test_qcow2_backing_file(self):
+        self._make_base('ami-1', 1)
+        self._make_overlay('instance-1', self.cache.path('ami-1'))
+        instance_dir = os.path.join(os.path.dirname(self.base_dir),
+                                    'instance-1')
+        self.assertEqual(self.cache.path('ami-1'),
+                         image_cache.qcow2_backing_file(
+                                 os.path.join(instance_dir, 'disk')))
+        self.assertEqual(None, image_cache.qcow2_backing_file(
+                                       self.cache.path('ami-1')))
+
+    def test_evicts_least_recently_used_unreferenced(self):
+        self._make_base('ami-old', 1)
+        self._make_base('ami-mid', 2)
+        self._make_base('ami-new', 3)
+        self._make_overlay('instance-1', self.cache.path('ami-old'))
+        sizes = dict((fname, size)
+                     for fname, size, _last_used in self.cache.usage())
+        budget = sizes['ami-old'] + sizes['ami-new']
+        evicted = self.cache.evict(budget, os.path.dirname(self.base_dir))
+        self.assertEqual(['ami-mid'], evicted)
+        self.assertEqual(['ami-new', 'ami-old'],
+                         sorted(os.listdir(self.base_dir)))
+
+    def test_referenced_images_are_never_evicted(self):
+        self._make_base('ami-1', 1)
+        self._make_overlay('instance-1', self.cache.path('ami-1'))
+        self.assertEqual([], self.cache.evict(0,
+                                              os.path.dirname(self.base_dir)))
+        self.assertEqual(['ami-1'], os.listdir(self.base_dir))
+
+    def test_unreadable_disk_stops_eviction(self):
+        self._make_base('ami-1', 1)
+        self._make_overlay('instance-1', self.cache.path('ami-1'))
+        self._make_overlay('instance-2', self.cache.path('ami-1'))
+
+        def fake_backing_file(path):
+            if 'instance-2' in path:
+                raise IOError('Permission denied')
+            return self.cache.path('ami-1')
+
+        self.stubs.Set(image_cache, 'qcow2_backing_file', fake_backing_file)
+        self.assertEqual(None, self.cache.referenced(
+                os.path.dirname(self.base_dir)))
+        self.assertEqual([], self.cache.evict(0,
+                                              os.path.dirname(self.base_dir)))
+        self.assertEqual(['ami-1'], os.listdir(self.base_dir))
+
+    def test_hit_marks_image_used(self):
+        self._make_base('ami-1', 1)
+        self.cache.fetch('ami-1', self._fetch)
+        self.assertNotEqual(1, os.stat(self.cache.path('ami-1')).st_mtime)
+
+
+class FakeHTTPResponse(object):
+    def __init__(self, status, body, headers, fail_after=None):
+        self.status = status
+        self.body = body
+        self.headers = headers
+        self.fail_after = fail_after
+        self.position = 0
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
+
+    def getheaders(self):
+        return self.headers.items()
+
+    def read(self, size=None):
+        if self.fail_after is not None and self.position >= self.fail_after:
+            raise IOError('connection reset')
+        end = len(self.body)
+        if size is not None:
+            end = min(end, self.position + size)
+        if self.fail_after is not None:
+            end = min(end, self.fail_after)
+        data = self.body[self.position:end]
+        self.position = end
+        return data
+
+
+class FakeHTTPConnection(object):
+    """Serves one image, honouring Range and failing when asked to."""
+
+    image = ''
+    etag = None
+    fail_after = []
+    requests = []
+    opened = 0
+
+    def __init__(self, host, port):
+        FakeHTTPConnection.opened += 1
+
+    def request(self, method, path, headers):
+        FakeHTTPConnection.requests.append(headers.get('Range'))
+        self.headers = headers
+
+    def getresponse(self):
+        image = FakeHTTPConnection.image
+        headers = {}
+        if FakeHTTPConnection.etag:
+            headers['etag'] = '"%s"' % FakeHTTPConnection.etag
+        status = httplib.OK
+        body = image
+        byte_range = self.headers.get('Range')
+        if byte_range:
+            first, _sep, last = byte_range[len('bytes='):].partition('-')
+            last = int(last or len(image) - 1)
+            body = image[int(first):last + 1]
+            status = httplib.PARTIAL_CONTENT
+            headers['content-range'] = 'bytes %s-%d/%d' % (first, last,
+                                                           len(image))
+        headers['content-length'] = str(len(body))
+        fail_after = None
+        if FakeHTTPConnection.fail_after:
+            fail_after = FakeHTTPConnection.fail_after.pop(0)
+        return FakeHTTPResponse(status, body, headers, fail_after)
+
+    def close(self):
+        pass
+
+
+class ImageFetchTestCase(test.TestCase):
+    def setUp(self):
+        super(ImageFetchTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'image')
+        self.stubs.Set(images, '_new_connection', FakeHTTPConnection)
+        self.stubs.Set(images, '_connections', {})
+        image = ''.join(chr(i % 251) for i in xrange(3 * images.BLOCK_SIZE))
+        FakeHTTPConnection.image = (image + '\0' * 4 * images.BLOCK_SIZE +
+                                    image + '\0' * 10)
+        FakeHTTPConnection.etag = hashlib.md5(
+                FakeHTTPConnection.image).hexdigest()
+        FakeHTTPConnection.fail_after = []
+        FakeHTTPConnection.requests = []
+        FakeHTTPConnection.opened = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        super(ImageFetchTestCase, self).tearDown()
+
+    def _fetch(self):
+        images.fetch_url('http://images:3333/_images/ami-1/image',
+                         self.path, {'Authorization': 'AWS a:b'})
+
+    def test_fetch_is_sparse_and_complete(self):
+        self._fetch()
+        self.assertEqual(FakeHTTPConnection.image, open(self.path).read())
+        self.assertTrue(os.stat(self.path).st_blocks * 512 <
+                        len(FakeHTTPConnection.image))
+
+    def test_connections_are_reused(self):
+        self._fetch()
+        self._fetch()
+        self.assertEqual(1, FakeHTTPConnection.opened)
+
+    def test_resume_after_error(self):
+        FakeHTTPConnection.fail_after = [images.BLOCK_SIZE]
+        self._fetch()
+        self.assertEqual(FakeHTTPConnection.image, open(self.path).read())
+        self.assertEqual([None, 'bytes=%d-' % images.BLOCK_SIZE],
+                         FakeHTTPConnection.requests)
+
+    def test_gives_up_after_retries(self):
+        self.flags(image_fetch_retries=1)
+        FakeHTTPConnection.fail_after = [10, 10]
+        self.assertRaises(IOError, self._fetch)
+
+    def test_checksum_mismatch(self):
+        FakeHTTPConnection.etag = hashlib.md5('other').hexdigest()
+        self.assertRaises(images.ImageFetchError, self._fetch)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_ranges_fill_their_part(self):
+        size = len(FakeHTTPConnection.image)
+        open(self.path, 'wb').close()
+        url = 'http://images:3333/_images/ami-1/image'
+        step = size / 3 + 1
+        for start in (step, 0, 2 * step):
+            images._fetch_range(url, self.path, {}, start,
+                                min(start + step, size))
+        self.assertEqual(FakeHTTPConnection.image, open(self.path).read())
+
+    def test_failed_range_stops_the_others(self):
+        self.flags(image_fetch_ranges=3, image_fetch_range_bytes=1)
+        stopped = []
+
+        def fake_fetch_range(url, path, headers, start, end, digest=None):
+            if start == 0:
+                raise IOError('connection reset')
+            try:
+                greenthread.sleep(10)
+            finally:
+                stopped.append(start)
+
+        self.stubs.Set(images, '_fetch_range', fake_fetch_range)
+        self.assertRaises(IOError, self._fetch)
+        self.assertEqual(2, len(stopped))
+
+
+class DomainStateWatcherTestCase(test.TestCase):
+    def setUp(self):
+        super(DomainStateWatcherTestCase, self).setUp()
+        self.states = {}
+        self.writes = []
+        self.stubs.Set(state_journal, 'set_state', self._set_state)
+        self.watcher = libvirt_conn.DomainStateWatcher(self._get_state)
+        self.stubs.Set(utils.LoopingCall, 'start',
+                       lambda *args, **kwargs: None)
+
+    def _get_state(self, name):
+        state = self.states[name]
+        if isinstance(state, Exception):
+            raise state
+        return state
+
+    def _set_state(self, instance_id, state, description=None):
+        self.writes.append((instance_id, state))
+
+    def test_writes_only_changes(self):
+        done = self.watcher.watch({'id': 1, 'name': 'instance-1'}, 'boot')
+        self.states['instance-1'] = power_state.NOSTATE
+        self.watcher.poll()
+        self.watcher.poll()
+        self.assertEqual([(1, power_state.NOSTATE)], self.writes)
+        self.states['instance-1'] = power_state.RUNNING
+        self.watcher.poll()
+        self.assertEqual([(1, power_state.NOSTATE), (1, power_state.RUNNING)],
+                         self.writes)
+        self.assertTrue(done.ready())
+        self.assertEqual({}, self.watcher.watched)
+        self.assertEqual(None, self.watcher._timer)
+
+    def test_one_poller_for_all_domains(self):
+        self.watcher.watch({'id': 1, 'name': 'instance-1'}, 'boot')
+        timer = self.watcher._timer
+        self.watcher.watch({'id': 2, 'name': 'instance-2'}, 'reboot')
+        self.assertTrue(timer is self.watcher._timer)
+        self.states['instance-1'] = power_state.RUNNING
+        self.states['instance-2'] = power_state.RUNNING
+        self.watcher.poll()
+        self.assertEqual({}, self.watcher.watched)
+
+    def test_events_limit_checks(self):
+        self.watcher.use_events = True
+        self.watcher.watch({'id': 1, 'name': 'instance-1'}, 'boot')
+        self.watcher.watch({'id': 2, 'name': 'instance-2'}, 'boot')
+        self.states['instance-1'] = power_state.NOSTATE
+        self.states['instance-2'] = power_state.NOSTATE
+        self.watcher.poll()
+        self.assertEqual(2, len(self.writes))
+        self.states['instance-1'] = power_state.RUNNING
+        self.states['instance-2'] = power_state.RUNNING
+        self.watcher.domain_event('instance-2')
+        self.watcher.poll()
+        self.assertEqual(['instance-1'], self.watcher.watched.keys())
+
+    def test_failed_check_keeps_polling(self):
+        self.watcher.watch({'id': 1, 'name': 'instance-1'}, 'boot')
+        self.watcher.watch({'id': 2, 'name': 'instance-2'}, 'boot')
+        self.states['instance-1'] = power_state.RUNNING
+        self.states['instance-2'] = power_state.RUNNING
+
+        def fail_once(instance_id, state, description=None):
+            self.stubs.Set(state_journal, 'set_state', self._set_state)
+            raise Exception('database is away')
+
+        self.stubs.Set(state_journal, 'set_state', fail_once)
+        self.watcher.poll()
+        self.assertEqual(1, len(self.watcher.watched))
+        self.assertNotEqual(None, self.watcher._timer)
+        self.watcher.poll()
+        self.assertEqual({}, self.watcher.watched)
+        self.assertEqual(None, self.watcher._timer)
+
+    def test_failure_marks_shutdown(self):
+        done = self.watcher.watch({'id': 1, 'name': 'instance-1'}, 'boot')
+        self.states['instance-1'] = Exception('domain vanished')
+        self.watcher.poll()
+        self.assertEqual([(1, power_state.SHUTDOWN)], self.writes)
+        self.assertFalse(done.wait())
+
+
+class TemplateCacheTestCase(test.TestCase):
+    def setUp(self):
+        super(TemplateCacheTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'template')
+        self.cache = libvirt_conn.TemplateCache()
+        self.compiled = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        super(TemplateCacheTestCase, self).tearDown()
+
+    def _write(self, contents, mtime):
+        with open(self.path, 'w') as f:
+            f.write(contents)
+        os.utime(self.path, (mtime, mtime))
+
+    def _compile(self, source):
+        self.compiled.append(source)
+        return source.upper()
+
+    def test_compiled_once(self):
+        self._write('one', 1000)
+        self.assertEqual('ONE', self.cache.get(self.path, self._compile))
+        self.assertEqual('ONE', self.cache.get(self.path, self._compile))
+        self.assertEqual(['one'], self.compiled)
+
+    def test_reloaded_when_changed(self):
+        self._write('one', 1000)
+        self.cache.get(self.path, self._compile)
+        self._write('two', 2000)
+        self.assertEqual('TWO', self.cache.get(self.path, self._compile))
+        self.assertEqual(['one', 'two'], self.compiled)
+
+
+class NbdPoolTestCase(test.TestCase):
+    def setUp(self):
+        super(NbdPoolTestCase, self).setUp()
+        self.lock_path = tempfile.mkdtemp()
+        self.flags(nbd_lock_path=self.lock_path, nbd_devices=2)
+        self.attached = set()
+        self.stubs.Set(disk, '_device_in_use',
+                       lambda device: device in self.attached)
+        self.pool = disk.NbdPool()
+
+    def tearDown(self):
+        shutil.rmtree(self.lock_path)
+        super(NbdPoolTestCase, self).tearDown()
+
+    def test_devices_are_not_handed_out_twice(self):
+        self.flags(nbd_wait_timeout=0)
+        first = self.pool.allocate()
+        second = self.pool.allocate()
+        self.assertNotEqual(first, second)
+        self.assertRaises(exception.Error, self.pool.allocate)
+        self.pool.free(first)
+        self.assertEqual(first, self.pool.allocate())
+
+    def test_locked_devices_are_skipped(self):
+        self.flags(nbd_wait_timeout=0)
+        taken = self.pool.allocate()
+        other_process = disk.NbdPool()
+        self.assertNotEqual(taken, other_process.allocate())
+        self.assertRaises(exception.Error, other_process.allocate)
+
+    def test_attached_devices_are_skipped(self):
+        self.attached.add('/dev/nbd0')
+        self.assertEqual('/dev/nbd1', self.pool.allocate())
+
+    def test_waiters_get_freed_device(self):
+        first = self.pool.allocate()
+        self.pool.allocate()
+        greenthread.spawn_after(0.1, self.pool.free, first)
+        self.assertEqual(first, self.pool.allocate())
+        stats = self.pool.stats()
+        self.assertEqual(3, stats['allocations'])
+        self.assertEqual(1, stats['waits'])
+        self.assertTrue(stats['max_wait'] > 0)
@@ -22,10 +22,12 @@ System-level utilities and helper functions.
 
 import base64
 import datetime
+import errno
 import inspect
 import json
 import os
 import random
+import signal
 import socket
 import string
 import struct
@@ -37,14 +39,25 @@ import netaddr
 
 from eventlet import event
 from eventlet import greenthread
+from eventlet import semaphore
+from eventlet.green import select
 from eventlet.green import subprocess
 
 from nova import exception
 from nova.exception import ProcessExecutionError
+from nova import flags
 from nova import log as logging
+from nova import roothelper
 
 
 LOG = logging.getLogger("nova.utils")
+FLAGS = flags.FLAGS
+flags.DEFINE_integer('execute_timeout', 0,
+                     'seconds after which commands run by nova are killed, '
+                     '0 means never')
+flags.DEFINE_list('execute_concurrency', ['qemu-img:4', 'dd:2'],
+                  'program:count pairs limiting how many of each program '
+                  'run at once')
 TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
 
 
@@ -126,19 +139,132 @@ def fetchfile(url, target):
     execute("curl --fail %s -o %s" % (url, target))
 
 
-def execute(cmd, process_input=None, addl_env=None, check_exit_code=True):
+def _command_class(cmd):
+    """Returns the name of the program cmd runs, looking past sudo."""
+    words = cmd.split()
+    if words and words[0] == 'sudo':
+        words = [word for word in words[1:] if not word.startswith('-')]
+    if not words:
+        return None
+    return os.path.basename(words[0])
+
+
+_EXECUTE_SEMAPHORES = {}
+
+
+def _execute_semaphore(cmd):
+    """Returns the semaphore limiting commands like cmd, or None."""
+    name = _command_class(cmd)
+    for item in FLAGS.execute_concurrency:
+        limit_name, _sep, limit = item.partition(':')
+        if limit_name == name:
+            if name not in _EXECUTE_SEMAPHORES:
+                _EXECUTE_SEMAPHORES[name] = semaphore.Semaphore(int(limit))
+            return _EXECUTE_SEMAPHORES[name]
+    return None
+
+
+def execute(cmd, process_input=None, addl_env=None, check_exit_code=True,
+            timeout=None):
+    """Runs cmd in a shell without blocking other green threads.
+
+    Commands named in execute_concurrency wait for their turn first.  A
+    command still running after timeout seconds, execute_timeout by
+    default, is killed and ProcessExecutionError raised.
+    """
+    limit = _execute_semaphore(cmd)
+    if limit:
+        limit.acquire()
+    try:
+        timeout = timeout or FLAGS.execute_timeout
+        if not addl_env and roothelper.can_run(cmd):
+            return _execute_on_helper([(cmd, process_input,
+                                        check_exit_code)], timeout)[0]
+        return _execute(cmd, process_input, addl_env, check_exit_code,
+                        timeout)
+    finally:
+        if limit:
+            limit.release()
+
+
+def _communicate(obj, process_input):
+    """Popen.communicate that lets other green threads run meanwhile.
+
+    The green Popen of eventlet ends up in the poll based communicate of
+    python 2.7, which blocks the whole process, so the pipes are drained
+    here with green select instead.
+    """
+    output = {obj.stdout: [], obj.stderr: []}
+    read_set = [obj.stdout, obj.stderr]
+    write_set = []
+    offset = 0
+    if process_input:
+        write_set.append(obj.stdin)
+    else:
+        obj.stdin.close()
+    while read_set or write_set:
+        rlist, wlist, _xlist = select.select(read_set, write_set, [])
+        if wlist:
+            try:
+                offset += os.write(obj.stdin.fileno(),
+                                   process_input[offset:offset + 512])
+            except OSError as e:
+                if e.errno != errno.EPIPE:
+                    raise
+                offset = len(process_input)
+            if offset >= len(process_input):
+                obj.stdin.close()
+                write_set.remove(obj.stdin)
+        for pipe in rlist:
+            data = os.read(pipe.fileno(), 4096)
+            if not data:
+                pipe.close()
+                read_set.remove(pipe)
+            output[pipe].append(data)
+    obj.wait()
+    return ''.join(output[obj.stdout]), ''.join(output[obj.stderr])
+
+
+def _execute(cmd, process_input, addl_env, check_exit_code, timeout):
     LOG.debug(_("Running cmd (subprocess): %s"), cmd)
     env = os.environ.copy()
     if addl_env:
         env.update(addl_env)
+    # NOTE(vish): a timed command gets its own process group, so that
+    #             killing it also kills whatever the shell started
+    preexec_fn = timeout and os.setsid or None
     obj = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE,
-        stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
-    result = None
-    if process_input != None:
-        result = obj.communicate(process_input)
-    else:
-        result = obj.communicate()
-    obj.stdin.close()
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env,
+        preexec_fn=preexec_fn)
+    timed_out = []
+
+    def kill():
+        LOG.warn(_("Killing %(cmd)s after %(timeout)s seconds")
+                 % {'cmd': cmd, 'timeout': timeout})
+        timed_out.append(True)
+        try:
+            if cmd.startswith('sudo '):
+                # NOTE(vish): what sudo started runs as root, and only
+                #             root may kill it
+                execute('sudo kill -9 -- -%d' % obj.pid)
+            else:
+                os.killpg(obj.pid, signal.SIGKILL)
+        except Exception:
+            LOG.exception(_("Cannot kill %s"), cmd)
+
+    killer = None
+    if timeout:
+        killer = greenthread.spawn_after(timeout, kill)
+    try:
+        result = _communicate(obj, process_input)
+    finally:
+        if killer:
+            killer.cancel()
+    if timed_out:
+        raise ProcessExecutionError(
+                cmd=cmd,
+                description=_("Command timed out after %s seconds")
+                            % timeout)
     if obj.returncode:
         LOG.debug(_("Result was %s") % obj.returncode)
         if check_exit_code and obj.returncode != 0:
@@ -154,6 +280,51 @@ def execute(cmd, process_input=None, addl_env=None, check_exit_code=True):
     return result
 
 
+def _execute_on_helper(commands, timeout):
+    """Runs a batch of sudo commands on the root helper."""
+    for cmd, _process_input, _check_exit_code in commands:
+        LOG.debug(_("Running cmd (root helper): %s"), cmd)
+    results = roothelper.execute([(cmd[len('sudo '):], process_input,
+                                   check_exit_code)
+                                  for cmd, process_input, check_exit_code
+                                  in commands],
+                                 timeout)
+    output = []
+    for (cmd, _process_input, check_exit_code), (exit_code, stdout, stderr) \
+            in zip(commands, results):
+        if exit_code is None:
+            raise ProcessExecutionError(
+                    cmd=cmd,
+                    description=_("Command timed out after %s seconds")
+                                % timeout)
+        if exit_code:
+            LOG.debug(_("Result was %s") % exit_code)
+            if check_exit_code:
+                raise ProcessExecutionError(exit_code=exit_code,
+                                            stdout=stdout,
+                                            stderr=stderr,
+                                            cmd=cmd)
+        output.append((stdout, stderr))
+    return output
+
+
+def execute_batch(commands):
+    """Runs commands, a list of (cmd, check_exit_code) pairs, in order.
+
+    Stops at the first command that fails with check_exit_code set and
+    raises ProcessExecutionError for it.  When every command can go to the
+    root helper the whole batch is sent in a single request.  Returns the
+    (stdout, stderr) of each command.
+    """
+    if commands and all(roothelper.can_run(cmd)
+                        for cmd, _check_exit_code in commands):
+        return _execute_on_helper([(cmd, None, check_exit_code)
+                                   for cmd, check_exit_code in commands],
+                                  FLAGS.execute_timeout)
+    return [execute(cmd, check_exit_code=check_exit_code)
+            for cmd, check_exit_code in commands]
+
+
 def ssh_execute(ssh, cmd, process_input=None,
                 addl_env=None, check_exit_code=True):
     LOG.debug(_("Running cmd (SSH): %s"), cmd)
@@ -433,6 +604,35 @@ class LoopingCall(object):
         return self.done.wait()
 
 
+def run_stages(stages):
+    """Runs (name, function) pairs concurrently and times each of them.
+
+    Returns a list of (name, seconds) in the order of stages once every
+    stage has finished.  If any stage raised, the first error in stage
+    order is raised instead.
+    """
+    def _timed(function):
+        start = time.time()
+        try:
+            function()
+            return time.time() - start, None
+        except Exception:
+            return time.time() - start, sys.exc_info()
+
+    if len(stages) == 1:
+        results = [_timed(stages[0][1])]
+    else:
+        threads = [greenthread.spawn(_timed, function)
+                   for _name, function in stages]
+        results = [thread.wait() for thread in threads]
+    for _seconds, exc_info in results:
+        if exc_info:
+            raise exc_info[0], exc_info[1], exc_info[2]
+    return [(name, seconds)
+            for (name, _function), (seconds, _exc_info)
+            in zip(stages, results)]
+
+
 def xhtml_escape(value):
     """Escapes a string so it is valid within XML or XHTML.
 
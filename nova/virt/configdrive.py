@@ -0,0 +1,184 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Config drives hand the ssh key, network configuration and user data of an
+instance to the guest on a small read only disk.
+
+The drive is a single directory ISO 9660 image written here in Python, so
+building one needs neither root nor any mount; the guest mounts the disk
+labelled config-2 and reads the files from it.  File names are stored in
+upper case, which Linux shows in lower case, so ``authorized_keys`` reads
+back as written.
+"""
+
+import struct
+import time
+
+from nova import exception
+
+
+VOLUME_LABEL = 'config-2'
+SECTOR_SIZE = 2048
+
+# NOTE(vish): sectors 0-15 are the system area, then come the primary
+#             volume descriptor, the terminator, both path tables and the
+#             root directory; file data starts after those
+_PVD_SECTOR = 16
+_PATH_TABLE_L_SECTOR = 18
+_PATH_TABLE_M_SECTOR = 19
+_ROOT_SECTOR = 20
+_DATA_SECTOR = 21
+
+_ALLOWED = set('ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_.')
+
+
+def _both16(value):
+    return struct.pack('<H', value) + struct.pack('>H', value)
+
+
+def _both32(value):
+    return struct.pack('<I', value) + struct.pack('>I', value)
+
+
+def _sectors(size):
+    return (size + SECTOR_SIZE - 1) // SECTOR_SIZE
+
+
+def _iso_name(name):
+    """Returns the on disk identifier of the file called name."""
+    iso_name = name.upper()
+    if (not iso_name or len(iso_name) > 30 or iso_name.count('.') > 1 or
+        not set(iso_name) <= _ALLOWED):
+        raise exception.Error(_('Invalid config drive file name: %s') % name)
+    return iso_name + ';1'
+
+
+def _record_date(timestamp):
+    t = time.gmtime(timestamp)
+    return struct.pack('7B', t.tm_year - 1900, t.tm_mon, t.tm_mday,
+                       t.tm_hour, t.tm_min, t.tm_sec, 0)
+
+
+def _volume_date(timestamp):
+    return time.strftime('%Y%m%d%H%M%S00', time.gmtime(timestamp)) + '\0'
+
+
+def _directory_record(identifier, sector, size, is_dir, timestamp):
+    length = 33 + len(identifier)
+    if length % 2:
+        length += 1
+    record = (struct.pack('BB', length, 0) +
+              _both32(sector) +
+              _both32(size) +
+              _record_date(timestamp) +
+              struct.pack('BBB', is_dir and 2 or 0, 0, 0) +
+              _both16(1) +
+              struct.pack('B', len(identifier)) +
+              identifier)
+    return record.ljust(length, '\0')
+
+
+def _text(value, size):
+    return value.upper().ljust(size)[:size]
+
+
+def build(files, timestamp=None):
+    """Returns an ISO 9660 image holding files, a dict of name to data."""
+    if timestamp is None:
+        timestamp = time.time()
+    names = sorted((_iso_name(name), data) for name, data in files.items())
+
+    root = [_directory_record('\0', _ROOT_SECTOR, SECTOR_SIZE, True,
+                              timestamp),
+            _directory_record('\1', _ROOT_SECTOR, SECTOR_SIZE, True,
+                              timestamp)]
+    data = []
+    sector = _DATA_SECTOR
+    for iso_name, contents in names:
+        root.append(_directory_record(iso_name, sector, len(contents),
+                                      False, timestamp))
+        data.append(contents.ljust(_sectors(len(contents)) * SECTOR_SIZE,
+                                   '\0'))
+        sector += _sectors(len(contents))
+    root = ''.join(root)
+    if len(root) > SECTOR_SIZE:
+        raise exception.Error(_('Too many files for a config drive'))
+
+    path_table_l = (struct.pack('<BBIH', 1, 0, _ROOT_SECTOR, 1) + '\0\0')
+    path_table_m = (struct.pack('>BBIH', 1, 0, _ROOT_SECTOR, 1) + '\0\0')
+    date = _volume_date(timestamp)
+    pvd = ('\1CD001\1\0' +
+           _text('LINUX', 32) +
+           VOLUME_LABEL.ljust(32) +
+           '\0' * 8 +
+           _both32(sector) +
+           '\0' * 32 +
+           _both16(1) +
+           _both16(1) +
+           _both16(SECTOR_SIZE) +
+           _both32(len(path_table_l)) +
+           struct.pack('<I', _PATH_TABLE_L_SECTOR) + '\0' * 4 +
+           struct.pack('>I', _PATH_TABLE_M_SECTOR) + '\0' * 4 +
+           _directory_record('\0', _ROOT_SECTOR, SECTOR_SIZE, True,
+                             timestamp) +
+           ' ' * 128 +
+           _text('NOVA', 128) +
+           ' ' * 128 +
+           _text('NOVA', 128) +
+           ' ' * (37 * 3) +
+           date + date + '0' * 16 + '\0' + date +
+           '\1\0')
+    terminator = '\xffCD001\1'
+
+    sectors = ['\0' * SECTOR_SIZE * _PVD_SECTOR,
+               pvd, terminator, path_table_l, path_table_m, root]
+    image = ''.join(part.ljust(_sectors(len(part) or 1) * SECTOR_SIZE, '\0')
+                    for part in sectors)
+    return image + ''.join(data)
+
+
+def write(path, files):
+    """Writes the config drive holding files to path."""
+    with open(path, 'wb') as f:
+        f.write(build(files))
+
+
+def read(image):
+    """Returns the files on the config drive image as a dict.
+
+    Only understands the drives written by :func:`build`.
+    """
+    pvd = image[_PVD_SECTOR * SECTOR_SIZE:(_PVD_SECTOR + 1) * SECTOR_SIZE]
+    if pvd[1:6] != 'CD001':
+        raise exception.Error(_('Not a config drive'))
+    root_sector, root_size = struct.unpack('<I4xI', pvd[158:170])
+    root = image[root_sector * SECTOR_SIZE:
+                 root_sector * SECTOR_SIZE + root_size]
+    files = {}
+    offset = 0
+    while offset < len(root) and ord(root[offset]):
+        length = ord(root[offset])
+        record = root[offset:offset + length]
+        offset += length
+        sector, size = struct.unpack('<I4xI', record[2:14])
+        identifier = record[33:33 + ord(record[32])]
+        if ord(record[25]) & 2:
+            continue
+        name = identifier.split(';')[0].lower()
+        files[name] = image[sector * SECTOR_SIZE:sector * SECTOR_SIZE + size]
+    return files
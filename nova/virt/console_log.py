@@ -0,0 +1,131 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Console output of instances, read by offset.
+
+Offsets count the bytes an instance wrote to its console since it was
+created, so a client that remembers the next_offset of its last request
+only fetches what was written since.  Every read returns at most
+console_output_max_bytes, the latest ones when no offset is given, as a
+dict of output, the offset it starts at and the next_offset to ask for.
+
+Console output that nova collects itself is kept in a :class:`RingFile`
+holding the last console_log_max_bytes bytes; older output is dropped, and
+a client asking for it gets the oldest output still kept instead.
+"""
+
+import os
+import struct
+
+from nova import flags
+
+
+FLAGS = flags.FLAGS
+flags.DEFINE_integer('console_log_max_bytes', 1024 * 1024,
+                     'bytes of console output kept for every instance')
+flags.DEFINE_integer('console_output_max_bytes', 64 * 1024,
+                     'most bytes of console output returned at once')
+
+MAGIC = 'NOVACON1'
+_HEADER = struct.Struct('<8sQQ')
+
+
+def _window(first, total, since_offset, max_bytes):
+    """Returns the offsets to read of the output kept from first to total."""
+    if max_bytes is None:
+        max_bytes = FLAGS.console_output_max_bytes
+    max_bytes = max(0, min(max_bytes, FLAGS.console_output_max_bytes))
+    if since_offset is None:
+        start = max(first, total - max_bytes)
+    else:
+        start = min(max(first, since_offset, 0), total)
+    return start, min(total, start + max_bytes)
+
+
+def _result(output, start):
+    return {'output': output, 'offset': start,
+            'next_offset': start + len(output)}
+
+
+def read_string(data, since_offset=None, max_bytes=None):
+    """Reads from console output held in memory."""
+    start, end = _window(0, len(data), since_offset, max_bytes)
+    return _result(data[start:end], start)
+
+
+def read_file(path, since_offset=None, max_bytes=None):
+    """Reads from a plain log file, written by the hypervisor."""
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        start, end = _window(0, f.tell(), since_offset, max_bytes)
+        f.seek(start)
+        return _result(f.read(end - start), start)
+
+
+class RingFile(object):
+    """Log file keeping only the last capacity bytes written to it."""
+
+    def __init__(self, path, capacity=None):
+        self.path = path
+        if not os.path.exists(path):
+            with open(path, 'wb') as f:
+                f.write(_HEADER.pack(MAGIC,
+                                     capacity or FLAGS.console_log_max_bytes,
+                                     0))
+        with open(path, 'rb') as f:
+            magic, self.capacity, _total = _HEADER.unpack(
+                    f.read(_HEADER.size))
+        if magic != MAGIC:
+            raise ValueError(_('%s is not a console ring file') % path)
+
+    def _total(self, f):
+        f.seek(0)
+        return _HEADER.unpack(f.read(_HEADER.size))[2]
+
+    def append(self, data):
+        """Writes data after the output already kept."""
+        if not data:
+            return
+        with open(self.path, 'r+b') as f:
+            total = self._total(f)
+            new_total = total + len(data)
+            data = data[-self.capacity:]
+            position = (new_total - len(data)) % self.capacity
+            head = data[:self.capacity - position]
+            f.seek(_HEADER.size + position)
+            f.write(head)
+            if len(head) < len(data):
+                f.seek(_HEADER.size)
+                f.write(data[len(head):])
+            f.seek(0)
+            f.write(_HEADER.pack(MAGIC, self.capacity, new_total))
+
+    def read(self, since_offset=None, max_bytes=None):
+        """Reads the output kept, see the module docstring."""
+        with open(self.path, 'rb') as f:
+            total = self._total(f)
+            start, end = _window(max(0, total - self.capacity), total,
+                                 since_offset, max_bytes)
+            position = start % self.capacity
+            length = end - start
+            f.seek(_HEADER.size + position)
+            output = f.read(min(length, self.capacity - position))
+            if len(output) < length:
+                f.seek(_HEADER.size)
+                output += f.read(length - len(output))
+            return _result(output, start)
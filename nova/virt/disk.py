@@ -20,12 +20,22 @@ Utility methods to resize, repartition, and modify disk images.
 
 Includes injection of SSH PGP keys into authorized_keys file.
 
+Images are mounted through /dev/nbdN devices handed out by an
+:class:`NbdPool`.  Each device has a lock file under nbd_lock_path that is
+held while the device is in use, so several nova processes on one host
+never pick the same device.
+
 """
 
+import fcntl
 import os
 import tempfile
 import time
 
+from eventlet import event
+from eventlet import greenthread
+from eventlet import timeout
+
 from nova import exception
 from nova import flags
 from nova import log as logging
@@ -38,6 +48,15 @@ flags.DEFINE_integer('minimum_root_size', 1024 * 1024 * 1024 * 10,
                      'minimum size in bytes of root partition')
 flags.DEFINE_integer('block_size', 1024 * 1024 * 256,
                      'block_size to use for dd')
+flags.DEFINE_integer('nbd_devices', 16,
+                     'number of /dev/nbdN devices used to inject data')
+flags.DEFINE_string('nbd_lock_path', '$state_path/nbd',
+                    'directory of the lock files that reserve nbd devices '
+                    'across the nova processes of a host')
+flags.DEFINE_integer('nbd_wait_timeout', 60,
+                     'seconds to wait for a free nbd device')
+flags.DEFINE_integer('timeout_nbd', 10,
+                     'seconds to wait for a connected nbd device to show up')
 
 
 def extend(image, size):
@@ -113,15 +132,19 @@ def inject_data(image, key=None, net=None, partition=None, nbd=False):
 def _link_device(image, nbd):
     """Link image to device using loopback or nbd"""
     if nbd:
-        device = _allocate_device()
-        utils.execute('sudo qemu-nbd -c %s %s' % (device, image))
-        # NOTE(vish): this forks into another process, so give it a chance
-        #             to set up before continuuing
-        for i in xrange(10):
-            if os.path.exists("/sys/block/%s/pid" % os.path.basename(device)):
-                return device
-            time.sleep(1)
-        raise exception.Error(_('nbd device %s did not show up') % device)
+        device = _pool.allocate()
+        try:
+            utils.execute('sudo qemu-nbd -c %s %s' % (device, image))
+            # NOTE(vish): this forks into another process, so give it a
+            #             chance to set up before continuing
+            if not _wait_for_device(device, FLAGS.timeout_nbd):
+                utils.execute('sudo qemu-nbd -d %s' % device)
+                raise exception.Error(_('nbd device %s did not show up')
+                                      % device)
+        except Exception:
+            _pool.free(device)
+            raise
+        return device
     else:
         out, err = utils.execute('sudo losetup --find --show %s' % image)
         if err:
@@ -133,30 +156,123 @@ def _link_device(image, nbd):
 def _unlink_device(device, nbd):
     """Unlink image from device using loopback or nbd"""
     if nbd:
-        utils.execute('sudo qemu-nbd -d %s' % device)
-        _free_device(device)
+        try:
+            utils.execute('sudo qemu-nbd -d %s' % device)
+        finally:
+            _pool.free(device)
     else:
         utils.execute('sudo losetup --detach %s' % device)
 
 
-_DEVICES = ['/dev/nbd%s' % i for i in xrange(16)]
+def _device_in_use(device):
+    """True if a qemu-nbd process is attached to device."""
+    return os.path.exists('/sys/block/%s/pid' % os.path.basename(device))
 
 
-def _allocate_device():
-    # NOTE(vish): This assumes no other processes are allocating nbd devices.
-    #             It may race cause a race condition if multiple
-    #             workers are running on a given machine.
-    while True:
-        if not _DEVICES:
-            raise exception.Error(_('No free nbd devices'))
-        device = _DEVICES.pop()
-        if not os.path.exists("/sys/block/%s/pid" % os.path.basename(device)):
-            break
-    return device
+def _wait_for_device(device, seconds):
+    """Waits up to seconds for device to be attached.
 
+    The kernel sends no notification we could wait on, so this checks with
+    a growing green sleep instead of blocking the whole process.
+    """
+    deadline = time.time() + seconds
+    interval = 0.05
+    while not _device_in_use(device):
+        if time.time() >= deadline:
+            return False
+        greenthread.sleep(interval)
+        interval = min(interval * 2, 1.0)
+    return True
+
+
+class NbdPool(object):
+    """Hands out the nbd devices of the host.
+
+    A device is taken by holding an exclusive flock on its lock file, which
+    the kernel releases if the process dies, and only if no qemu-nbd is
+    attached to it already.  Callers in this process waiting for a device
+    are woken as soon as one is freed here; devices freed by other
+    processes are noticed within a second.
+    """
 
-def _free_device(device):
-    _DEVICES.append(device)
+    def __init__(self):
+        self._locks = {}
+        self._freed = event.Event()
+        self.allocations = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+
+    def _lock_file(self, device):
+        if not os.path.exists(FLAGS.nbd_lock_path):
+            os.makedirs(FLAGS.nbd_lock_path)
+        return os.path.join(FLAGS.nbd_lock_path, os.path.basename(device))
+
+    def _try_allocate(self):
+        for i in xrange(FLAGS.nbd_devices):
+            device = '/dev/nbd%d' % i
+            if device in self._locks:
+                continue
+            lock_file = open(self._lock_file(device), 'a')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                lock_file.close()
+                continue
+            if _device_in_use(device):
+                lock_file.close()
+                continue
+            self._locks[device] = lock_file
+            return device
+        return None
+
+    def allocate(self):
+        """Returns a free nbd device, waiting up to nbd_wait_timeout."""
+        start = time.time()
+        device = self._try_allocate()
+        if device is None:
+            self.waits += 1
+            LOG.debug(_('Waiting for a free nbd device'))
+        while device is None:
+            remaining = start + FLAGS.nbd_wait_timeout - time.time()
+            if remaining <= 0:
+                raise exception.Error(_('No free nbd devices'))
+            with timeout.Timeout(min(remaining, 1.0), False):
+                self._freed.wait()
+            device = self._try_allocate()
+        waited = time.time() - start
+        if waited >= 1:
+            LOG.info(_('Waited %(waited).1f seconds for nbd device '
+                       '%(device)s') % locals())
+        self.allocations += 1
+        self.wait_time += waited
+        self.max_wait = max(self.max_wait, waited)
+        return device
+
+    def free(self, device):
+        """Gives device back and wakes up anybody waiting for one."""
+        lock_file = self._locks.pop(device, None)
+        if lock_file is None:
+            return
+        lock_file.close()
+        freed, self._freed = self._freed, event.Event()
+        freed.send()
+
+    def stats(self):
+        """Returns how many devices were handed out and the time waited."""
+        return {'allocations': self.allocations,
+                'waits': self.waits,
+                'wait_time': self.wait_time,
+                'max_wait': self.max_wait,
+                'in_use': len(self._locks)}
+
+
+_pool = NbdPool()
+
+
+def nbd_stats():
+    """Returns the stats of the nbd devices used by this process."""
+    return _pool.stats()
 
 
 def _inject_key_into_fs(key, fs):
@@ -27,6 +27,7 @@ semantics of real hypervisor connections.
 
 from nova import exception
 from nova.compute import power_state
+from nova.virt import console_log
 
 
 def get_connection(_):
@@ -245,6 +246,17 @@ class FakeConnection(object):
                 'num_cpu': 2,
                 'cpu_time': 0}
 
+    def get_all_info(self):
+        """
+        Get the same information as get_info for every instance known to the
+        virtualization layer at once, as a dictionary keyed by instance name.
+
+        Drivers should gather this in as few calls to the hypervisor as
+        they can, it is used to reconcile the state of all the instances on
+        a host.
+        """
+        return dict((name, self.get_info(name)) for name in self.instances)
+
     def get_diagnostics(self, instance_name):
         pass
 
@@ -273,6 +285,35 @@ class FakeConnection(object):
         """
         return ['A_VIF']
 
+    def get_devices(self, instance_name):
+        """
+        Return the IDs of the virtual disks and network interfaces of the
+        specified instance, as a dict with a 'disks' and an 'interfaces'
+        list, like list_disks and list_interfaces do in two calls.
+
+        Note that this function takes an instance ID, not a
+        compute.service.Instance, so that it can be called by compute.monitor.
+        """
+        return {'disks': ['A_DISK'], 'interfaces': ['A_VIF']}
+
+    def get_instance_stats(self, instance_name, disks, interfaces):
+        """
+        Return the performance counters of the given instance in one call:
+        a dict holding num_cpu and cpu_time as returned by get_info, a
+        'disks' dict of the block_stats of each of disks, and an
+        'interfaces' dict of the interface_stats of each of interfaces.
+
+        Note that this function takes an instance ID, not a
+        compute.service.Instance, so that it can be called by compute.monitor.
+        """
+        return {'num_cpu': 1,
+                'cpu_time': 0,
+                'disks': dict((disk, [0L, 0L, 0L, 0L, 0L])
+                              for disk in disks),
+                'interfaces': dict((interface, [0L, 0L, 0L, 0L,
+                                                0L, 0L, 0L, 0L])
+                                   for interface in interfaces)}
+
     def block_stats(self, instance_name, disk_id):
         """
         Return performance counters associated with the given disk_id on the
@@ -315,8 +356,43 @@ class FakeConnection(object):
         """
         return [0L, 0L, 0L, 0L, 0L, 0L, 0L, 0L]
 
-    def get_console_output(self, instance):
-        return 'FAKE CONSOLE OUTPUT'
+    def get_console_output(self, instance, since_offset=None, max_bytes=None):
+        """
+        Return the console output of the given instance written since
+        since_offset, at most max_bytes of it, as a dict holding the output,
+        the offset it starts at and the next_offset to ask for.  See
+        nova.virt.console_log.
+        """
+        return console_log.read_string('FAKE CONSOLE OUTPUT', since_offset,
+                                       max_bytes)
+
+    def prepare_images(self, instance):
+        """Creates the disks of instance ahead of spawn.
+
+        The compute manager calls this while it allocates the network of
+        instance, so drivers can fetch images concurrently with it.  spawn
+        is called afterwards and must work whether or not this ran.
+        """
+        pass
+
+    def prefetch_image(self, context, image_id, kernel_id=None,
+                       ramdisk_id=None):
+        """Caches an image, kernel and ramdisk on this host.
+
+        This lets the first launch of image_id here skip the download.
+        The credentials of context are used to fetch the images.
+        """
+        pass
+
+    def manage_image_cache(self, context):
+        """Trims the host's cache of base images.
+
+        Called periodically by the compute manager, this should evict base
+        images no instance needs any more once the cache is too large.
+        Platforms that do not keep a local image cache can leave this
+        empty.
+        """
+        pass
 
     def get_ajax_console(self, instance):
         return 'http://fakeajaxconsole.com/?token=FAKETOKEN'
@@ -393,6 +393,24 @@ class HyperVConnection(object):
                 LOG.debug(_("Del: disk %(vhdfile)s vm %(instance_name)s")
                         % locals())
 
+    def prepare_images(self, instance):
+        """Disks are created from the image by spawn"""
+        pass
+
+    def prefetch_image(self, context, image_id, kernel_id=None,
+                       ramdisk_id=None):
+        """There is no local image cache to warm"""
+        pass
+
+    def manage_image_cache(self, context):
+        """There is no local image cache to trim"""
+        pass
+
+    def get_all_info(self):
+        """Get information about every VM, keyed by name"""
+        return dict((name, self.get_info(name))
+                    for name in self.list_instances())
+
     def get_info(self, instance_id):
         """Get information about the VM"""
         vm = self._lookup(instance_id)
@@ -0,0 +1,215 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Cache of base images shared by the instances on a host.
+
+Each base image is created at most once at a time: the first request runs
+the fetch into a temporary file that is renamed into place when complete,
+and requests for the same image that arrive meanwhile wait for that fetch
+instead of starting their own.  A half written base image is therefore
+never visible under its final name.
+
+Every use of a base image bumps its mtime.  When the cache grows past
+image_cache_max_bytes, :meth:`ImageCache.evict` removes the least recently
+used base images that no qcow2 overlay of an instance on the host still
+uses as its backing file.
+"""
+
+import os
+import struct
+import sys
+import uuid
+
+from eventlet import event
+from eventlet import semaphore
+
+from nova import flags
+from nova import log as logging
+
+
+LOG = logging.getLogger('nova.virt.image_cache')
+FLAGS = flags.FLAGS
+flags.DEFINE_integer('image_cache_max_bytes', 0,
+                     'evict unused base images once _base holds more than '
+                     'this many bytes, 0 means never')
+flags.DEFINE_integer('max_concurrent_downloads', 2,
+                     'number of base images fetched at once, other fetches '
+                     'wait their turn')
+
+QCOW2_MAGIC = 'QFI\xfb'
+
+
+def qcow2_backing_file(path):
+    """Returns the backing file of the qcow2 image at path, or None.
+
+    Raises IOError if path cannot be read.
+    """
+    with open(path, 'rb') as f:
+        header = f.read(20)
+        if len(header) < 20 or header[:4] != QCOW2_MAGIC:
+            return None
+        offset, size = struct.unpack('>QI', header[8:20])
+        if not offset or not size:
+            return None
+        f.seek(offset)
+        return f.read(size)
+
+
+class ImageCache(object):
+    """Single flight cache of the base images in base_dir."""
+
+    def __init__(self, base_dir):
+        self.base_dir = base_dir
+        self._fetching = {}
+        self._download_semaphore = semaphore.Semaphore(
+                FLAGS.max_concurrent_downloads)
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+
+    def path(self, fname):
+        """Returns where the base image fname is kept."""
+        return os.path.join(self.base_dir, fname)
+
+    def fetch(self, fname, fn, *args, **kwargs):
+        """Returns the path of base image fname, creating it if needed.
+
+        fn is called with a target kwarg naming the file it should create,
+        plus args and kwargs.  If fn raises, the error is raised to every
+        caller waiting on it and nothing is cached.  At most
+        max_concurrent_downloads calls of fn run at once.
+        """
+        base = self.path(fname)
+        if fname in self._fetching:
+            self.waits += 1
+            LOG.debug(_('Waiting for base image %s being fetched'), fname)
+            self._fetching[fname].wait()
+            return base
+        if os.path.exists(base):
+            self.hits += 1
+            os.utime(base, None)
+            return base
+
+        self.misses += 1
+        LOG.debug(_('Fetching base image %s'), fname)
+        done = event.Event()
+        self._fetching[fname] = done
+        if not os.path.exists(self.base_dir):
+            os.mkdir(self.base_dir)
+        partial = os.path.join(self.base_dir,
+                               '.%s.%s.part' % (fname, uuid.uuid4().hex))
+        try:
+            with self._download_semaphore:
+                fn(target=partial, *args, **kwargs)
+            os.rename(partial, base)
+        except Exception:
+            exc_info = sys.exc_info()
+            if os.path.exists(partial):
+                os.unlink(partial)
+            done.send_exception(*exc_info)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        else:
+            done.send()
+        finally:
+            del self._fetching[fname]
+        return base
+
+    def usage(self):
+        """Returns (fname, bytes on disk, last use) for each base image."""
+        if not os.path.exists(self.base_dir):
+            return []
+        result = []
+        for fname in os.listdir(self.base_dir):
+            if fname.startswith('.'):
+                continue
+            stat = os.stat(self.path(fname))
+            result.append((fname, stat.st_blocks * 512, stat.st_mtime))
+        return result
+
+    def referenced(self, instances_path):
+        """Returns the base images backing a disk under instances_path.
+
+        Returns None if a disk cannot be read, as it may be backed by any
+        of them.
+        """
+        result = set()
+        for name in os.listdir(instances_path):
+            instance_dir = os.path.join(instances_path, name)
+            if (instance_dir == self.base_dir or
+                not os.path.isdir(instance_dir)):
+                continue
+            for fname in os.listdir(instance_dir):
+                path = os.path.join(instance_dir, fname)
+                try:
+                    backing = qcow2_backing_file(path)
+                except IOError:
+                    if fname == 'disk' or fname.startswith('disk.'):
+                        LOG.warn(_('Cannot read %s, not evicting any base '
+                                   'image'), path)
+                        return None
+                    continue
+                if backing and os.path.dirname(backing) == self.base_dir:
+                    result.add(os.path.basename(backing))
+        return result
+
+    def evict(self, max_bytes, instances_path):
+        """Removes unreferenced base images, oldest use first.
+
+        Stops once the cache fits in max_bytes or only base images in use
+        are left.  Returns the names of the evicted images.
+        """
+        usage = self.usage()
+        total = sum(size for _fname, size, _last_used in usage)
+        if total <= max_bytes:
+            return []
+        in_use = self.referenced(instances_path)
+        if in_use is None:
+            return []
+        evicted = []
+        for fname, size, _last_used in sorted(usage, key=lambda u: u[2]):
+            if total <= max_bytes:
+                break
+            if fname in in_use or fname in self._fetching:
+                continue
+            LOG.info(_('Evicting base image %(fname)s (%(size)d bytes)')
+                     % locals())
+            os.unlink(self.path(fname))
+            total -= size
+            evicted.append(fname)
+        if total > max_bytes:
+            LOG.warn(_('Base images in use take %(total)d bytes, more than '
+                       'the %(max_bytes)d allowed') % locals())
+        return evicted
+
+    def stats(self):
+        """Returns the size of the cache and how well it is doing.
+
+        hit_ratio counts requests that found the image cached or already
+        being fetched.
+        """
+        usage = self.usage()
+        requests = self.hits + self.misses + self.waits
+        hit_ratio = 0.0
+        if requests:
+            hit_ratio = float(self.hits + self.waits) / requests
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'waits': self.waits,
+                'hit_ratio': hit_ratio,
+                'images': len(usage),
+                'bytes': sum(size for _fname, size, _last_used in usage)}
@@ -21,13 +21,18 @@
 Handling of VM disk images.
 """
 
+import hashlib
+import httplib
 import os.path
+import re
 import shutil
 import sys
 import time
-import urllib2
 import urlparse
 
+from eventlet import greenpool
+
+from nova import exception
 from nova import flags
 from nova import log as logging
 from nova import utils
@@ -39,9 +44,32 @@ from nova.objectstore import image
 FLAGS = flags.FLAGS
 flags.DEFINE_bool('use_s3', True,
                   'whether to get images from s3 or use local copy')
+flags.DEFINE_integer('image_fetch_retries', 3,
+                     'times to resume an image download after an error')
+flags.DEFINE_integer('image_fetch_ranges', 1,
+                     'download images larger than image_fetch_range_bytes '
+                     'as this many ranges in parallel')
+flags.DEFINE_integer('image_fetch_range_bytes', 512 * 1024 * 1024,
+                     'images at least this large are fetched in parallel '
+                     'ranges if image_fetch_ranges is above 1')
+flags.DEFINE_integer('image_fetch_timeout', 60,
+                     'seconds an image server may stay silent before the '
+                     'request is retried')
 
 LOG = logging.getLogger('nova.virt.images')
 
+CHUNK_SIZE = 1024 * 1024
+BLOCK_SIZE = 4096
+_ZERO_BLOCK = '\0' * BLOCK_SIZE
+_MD5_ETAG = re.compile('^[0-9a-f]{32}$')
+
+# NOTE(vish): idle keep-alive connections, keyed by (host, port)
+_connections = {}
+
+
+class ImageFetchError(exception.Error):
+    pass
+
 
 def fetch(image, path, user, project):
     if FLAGS.use_s3:
@@ -51,31 +79,200 @@ def fetch(image, path, user, project):
     return f(image, path, user, project)
 
 
-def _fetch_image_no_curl(url, path, headers):
-    request = urllib2.Request(url)
-    for (k, v) in headers.iteritems():
-        request.add_header(k, v)
+def _new_connection(host, port):
+    return httplib.HTTPConnection(host, port,
+                                  timeout=FLAGS.image_fetch_timeout)
+
+
+def _get_connection(host, port):
+    """Returns an idle connection to host:port, or a new one."""
+    idle = _connections.get((host, port))
+    if idle:
+        return idle.pop()
+    return _new_connection(host, port)
+
+
+def _put_connection(host, port, conn):
+    """Keeps conn around for the next request to host:port."""
+    _connections.setdefault((host, port), []).append(conn)
+
+
+def _host_port(url):
+    parts = urlparse.urlparse(url)
+    return parts.hostname, parts.port or 80
+
+
+def _request(url, headers):
+    """Sends a GET for url and returns (connection, response).
+
+    Statuses other than 200 and 206 raise ImageFetchError.
+    """
+    host, port = _host_port(url)
+    conn = _get_connection(host, port)
+    try:
+        conn.request('GET', urlparse.urlparse(url).path, headers=headers)
+        response = conn.getresponse()
+    except Exception:
+        # NOTE(vish): the server may have dropped an idle connection, so
+        #             try once more on a fresh one
+        conn.close()
+        conn = _new_connection(host, port)
+        conn.request('GET', urlparse.urlparse(url).path, headers=headers)
+        response = conn.getresponse()
+    if response.status not in (httplib.OK, httplib.PARTIAL_CONTENT):
+        response.read()
+        conn.close()
+        raise ImageFetchError(_('Fetching %(url)s failed with status '
+                                '%(status)s') % {'url': url,
+                                                 'status': response.status})
+    return conn, response
+
 
-    def urlretrieve(urlfile, fpath):
-        chunk = 1 * 1024 * 1024
-        f = open(fpath, "wb")
-        while 1:
-            data = urlfile.read(chunk)
+def _write_sparse(f, data):
+    """Writes data at the current position of f, skipping zero blocks."""
+    for start in xrange(0, len(data), BLOCK_SIZE):
+        block = data[start:start + BLOCK_SIZE]
+        if block == _ZERO_BLOCK[:len(block)]:
+            f.seek(len(block), os.SEEK_CUR)
+        else:
+            f.write(block)
+
+
+def _fetch_range(url, path, headers, start, end, digest=None):
+    """Streams bytes start to end (exclusive, None for all) of url into path.
+
+    The download resumes from the last byte written after an error, up to
+    image_fetch_retries times.  If end is None the response headers of the
+    first request are returned so the caller can see the size and ETag.
+    """
+    offset = start
+    first_headers = None
+    retries = 0
+    with open(path, 'r+b') as f:
+        while end is None or offset < end:
+            request_headers = dict(headers)
+            if offset or end is not None:
+                last = ''
+                if end is not None:
+                    last = str(end - 1)
+                request_headers['Range'] = 'bytes=%d-%s' % (offset, last)
+            conn = None
+            try:
+                conn, response = _request(url, request_headers)
+                if offset and response.status != httplib.PARTIAL_CONTENT:
+                    raise ImageFetchError(_('%s does not support ranged '
+                                            'requests') % url)
+                if first_headers is None:
+                    first_headers = dict(response.getheaders())
+                length = response.getheader('content-length')
+                expected = None
+                if length is not None:
+                    expected = offset + int(length)
+                f.seek(offset)
+                while True:
+                    data = response.read(CHUNK_SIZE)
+                    if not data:
+                        break
+                    _write_sparse(f, data)
+                    if digest:
+                        digest.update(data)
+                    offset += len(data)
+                if expected is not None and offset != expected:
+                    raise IOError(_('Connection closed after %(offset)d of '
+                                    '%(expected)d bytes') % locals())
+                host, port = _host_port(url)
+                _put_connection(host, port, conn)
+                if end is None:
+                    break
+            except (IOError, httplib.HTTPException), e:
+                if conn:
+                    conn.close()
+                retries += 1
+                if retries > FLAGS.image_fetch_retries:
+                    raise
+                LOG.warn(_('Resuming %(url)s at byte %(offset)d after '
+                           '%(e)s') % locals())
+    return offset, first_headers
+
+
+def _file_md5(path):
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(CHUNK_SIZE)
             if not data:
                 break
-            f.write(data)
+            digest.update(data)
+    return digest.hexdigest()
+
 
-    urlopened = urllib2.urlopen(request)
-    urlretrieve(urlopened, path)
-    LOG.debug(_("Finished retreving %(url)s -- placed in %(path)s") % locals())
+def _content_length(url, headers):
+    """Returns the size of url from a one byte ranged request, or None."""
+    request_headers = dict(headers)
+    request_headers['Range'] = 'bytes=0-0'
+    conn, response = _request(url, request_headers)
+    response.read()
+    host, port = _host_port(url)
+    _put_connection(host, port, conn)
+    content_range = response.getheader('content-range')
+    if response.status != httplib.PARTIAL_CONTENT or not content_range:
+        return None, None
+    return (int(content_range.rpartition('/')[2]),
+            response.getheader('etag'))
+
+
+def fetch_url(url, path, headers):
+    """Downloads url to path, checking it against the ETag if it is an md5.
+
+    Zero blocks are not written, so path is sparse where the image is.
+    Images of at least image_fetch_range_bytes are downloaded as
+    image_fetch_ranges parallel ranges when that is more than one, with
+    their md5 checked in a second pass over the file.
+    """
+    open(path, 'wb').close()
+    size = etag = None
+    ranges = FLAGS.image_fetch_ranges
+    if ranges > 1:
+        size, etag = _content_length(url, headers)
+    if size is not None and size >= FLAGS.image_fetch_range_bytes:
+        step = (size + ranges - 1) / ranges
+        pool = greenpool.GreenPool(ranges)
+        threads = [pool.spawn(_fetch_range, url, path, headers, start,
+                              min(start + step, size))
+                   for start in xrange(0, size, step)]
+        try:
+            for thread in threads:
+                thread.wait()
+        except Exception:
+            for thread in threads:
+                thread.kill()
+            raise
+        written = size
+        md5 = None
+        if etag and _MD5_ETAG.match(etag.strip('"')):
+            md5 = _file_md5(path)
+    else:
+        digest = hashlib.md5()
+        written, response_headers = _fetch_range(url, path, headers, 0, None,
+                                                 digest)
+        etag = response_headers.get('etag')
+        md5 = digest.hexdigest()
+    with open(path, 'r+b') as f:
+        f.truncate(written)
+
+    # NOTE(vish): multipart uploads have ETags that are not the md5
+    if etag and md5 and _MD5_ETAG.match(etag.strip('"')):
+        if md5 != etag.strip('"'):
+            os.unlink(path)
+            raise ImageFetchError(_('Checksum mismatch for %(url)s: got '
+                                    '%(md5)s, expected %(etag)s') % locals())
+    LOG.debug(_("Finished retrieving %(url)s -- placed in %(path)s")
+              % locals())
 
 
 def _fetch_s3_image(image, path, user, project):
     url = image_url(image)
 
-    # This should probably move somewhere else, like e.g. a download_as
-    # method on User objects and at the same time get rewritten to use
-    # a web client.
     headers = {}
     headers['Date'] = time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime())
 
@@ -85,17 +282,7 @@ def _fetch_s3_image(image, path, user, project):
                                                                      'GET',
                                                                      url_path)
     headers['Authorization'] = 'AWS %s:%s' % (access, signature)
-
-    if sys.platform.startswith('win'):
-        return _fetch_image_no_curl(url, path, headers)
-    else:
-        cmd = ['/usr/bin/curl', '--fail', '--silent', url]
-        for (k, v) in headers.iteritems():
-            cmd += ['-H', '\'%s: %s\'' % (k, v)]
-
-        cmd += ['-o', path]
-        cmd_out = ' '.join(cmd)
-        return utils.execute(cmd_out)
+    return fetch_url(url, path, headers)
 
 
 def _fetch_local_image(image, path, user, project):
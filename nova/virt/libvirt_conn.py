@@ -36,16 +36,22 @@ Supports KVM, QEMU, UML, and XEN.
 
 """
 
+import base64
+import collections
+import functools
 import os
 import shutil
 import random
 import subprocess
+import time
 import uuid
 from xml.dom import minidom
 
 
 from eventlet import greenthread
 from eventlet import event
+from eventlet import patcher
+from eventlet import semaphore
 from eventlet import tpool
 
 import IPy
@@ -60,7 +66,11 @@ from nova import utils
 from nova.auth import manager
 from nova.compute import instance_types
 from nova.compute import power_state
+from nova.compute import state_journal
+from nova.virt import configdrive
+from nova.virt import console_log
 from nova.virt import disk
+from nova.virt import image_cache
 from nova.virt import images
 
 libvirt = None
@@ -94,12 +104,36 @@ flags.DEFINE_bool('allow_project_net_traffic',
 flags.DEFINE_bool('use_cow_images',
                   True,
                   'Whether to use cow images')
+flags.DEFINE_bool('use_config_drive', False,
+                  'hand the ssh key, network config and user data to '
+                  'instances on an attached config drive instead of '
+                  'mounting their root disk to write them')
 flags.DEFINE_string('ajaxterm_portrange',
                     '10000-12000',
                     'Range of ports that ajaxterm should randomly try to bind')
 flags.DEFINE_string('firewall_driver',
                     'nova.virt.libvirt_conn.IptablesFirewallDriver',
                     'Firewall driver (defaults to iptables)')
+flags.DEFINE_integer('max_concurrent_disk_preps', 4,
+                     'number of instance disks copied, created or injected '
+                     'into at once')
+flags.DEFINE_integer('libvirt_health_check_interval', 60,
+                     'seconds between checks that the libvirt connection '
+                     'still works, it is also checked after any error')
+flags.DEFINE_integer('libvirt_reconnect_max_backoff', 60,
+                     'most seconds to wait between attempts to reconnect '
+                     'to libvirt')
+flags.DEFINE_integer('libvirt_threadpool_size', 10,
+                     'native threads that run blocking libvirt calls, 0 '
+                     'runs them on the calling greenthread')
+flags.DEFINE_bool('libvirt_use_events', True,
+                  'watch domains through libvirt lifecycle events when '
+                  'libvirt supports them, instead of polling every domain')
+flags.DEFINE_float('libvirt_state_interval', 0.5,
+                   'seconds between checks of domains waiting to boot')
+flags.DEFINE_integer('libvirt_state_sweep_ticks', 20,
+                     'with lifecycle events, still check every waiting '
+                     'domain once in this many intervals')
 
 
 def get_connection(read_only):
@@ -111,12 +145,187 @@ def get_connection(read_only):
     global libxml2
     if libvirt is None:
         libvirt = __import__('libvirt')
+        _size_threadpool()
+        _start_event_loop()
     if libxml2 is None:
         libxml2 = __import__('libxml2')
     _late_load_cheetah()
     return LibvirtConnection(read_only)
 
 
+def _size_threadpool():
+    """Gives tpool libvirt_threadpool_size threads before it starts.
+
+    An EVENTLET_THREADPOOL_SIZE set in the environment wins, eventlet
+    reads it when tpool is imported, before the flags are parsed.
+    """
+    if 'EVENTLET_THREADPOOL_SIZE' in os.environ:
+        return
+    if hasattr(tpool, 'set_num_threads'):
+        tpool.set_num_threads(FLAGS.libvirt_threadpool_size)
+    elif (hasattr(tpool, '_nthreads') and
+          not getattr(tpool, '_setup_already', True)):
+        # NOTE(vish): older eventlets, 0.9 among them, have no public way
+        #             to size the pool once tpool is imported
+        tpool._nthreads = FLAGS.libvirt_threadpool_size
+
+
+def _start_event_loop():
+    """Runs libvirt's default event loop in a native thread, if it has one.
+
+    The loop has to be registered before any connection is opened.
+    """
+    if not (FLAGS.libvirt_use_events and
+            hasattr(libvirt, 'virEventRegisterDefaultImpl')):
+        return
+    libvirt.virEventRegisterDefaultImpl()
+
+    def _run():
+        while True:
+            libvirt.virEventRunDefaultImpl()
+
+    # NOTE(vish): libvirt blocks in C, so this can't be a greenthread
+    threading = patcher.original('threading')
+    thread = threading.Thread(target=_run, name='libvirt-events')
+    thread.setDaemon(True)
+    thread.start()
+
+
+def _is_connection_error(error):
+    """True if error means the connection to libvirtd is gone."""
+    return (error.get_error_code() == libvirt.VIR_ERR_SYSTEM_ERROR and
+            error.get_error_domain() == libvirt.VIR_FROM_REMOTE)
+
+
+class LibvirtProxy(object):
+    """Runs the methods of a libvirt object in tpool's native threads.
+
+    Libvirt calls block in C, so making them on the hub would stall every
+    other greenthread.  Errors meaning libvirtd went away are reported to
+    on_error so the connection gets checked before its next use.  Domains
+    returned by a call are wrapped the same way.
+    """
+
+    def __init__(self, obj, on_error):
+        self._obj = obj
+        self._on_error = on_error
+
+    def __getattr__(self, name):
+        attr = getattr(self._obj, name)
+        if not callable(attr):
+            return attr
+
+        def _call(*args, **kwargs):
+            try:
+                result = tpool.execute(attr, *args, **kwargs)
+            except libvirt.libvirtError as e:
+                if _is_connection_error(e):
+                    self._on_error()
+                raise
+            if isinstance(result, libvirt.virDomain):
+                return LibvirtProxy(result, self._on_error)
+            return result
+
+        return _call
+
+
+class DomainStateWatcher(object):
+    """Follows domains until they are running, recording their state.
+
+    A single poller serves every domain being watched, and an instance's
+    state is only written to the database when it changes.  When libvirt
+    delivers lifecycle events, each tick only looks at the domains that
+    sent one, with a sweep of every watched domain once in
+    libvirt_state_sweep_ticks ticks in case an event was lost.
+    """
+
+    def __init__(self, get_state):
+        self.get_state = get_state
+        self.use_events = False
+        self.watched = {}
+        self.events = collections.deque()
+        self._ticks = 0
+        self._timer = None
+
+    def watch(self, instance, label):
+        """Returns an event sent once instance's domain is running."""
+        done = event.Event()
+        self.watched[instance['name']] = {'id': instance['id'],
+                                          'state': None,
+                                          'label': label,
+                                          'done': done}
+        self.events.append(instance['name'])
+        if not self._timer:
+            self._timer = utils.LoopingCall(self.poll)
+            self._timer.start(interval=FLAGS.libvirt_state_interval,
+                              now=True)
+        return done
+
+    def domain_event(self, name):
+        """Notes that the domain name changed state.
+
+        Called from libvirt's event thread, so it only queues the name.
+        """
+        self.events.append(name)
+
+    def poll(self):
+        """Checks the watched domains that may have changed state."""
+        self._ticks += 1
+        if self.use_events and self._ticks % FLAGS.libvirt_state_sweep_ticks:
+            names = set()
+            while self.events:
+                names.add(self.events.popleft())
+        else:
+            self.events.clear()
+            names = self.watched.keys()
+        for name in names:
+            if name not in self.watched:
+                continue
+            # NOTE(vish): an error escaping poll would end the LoopingCall
+            #             while _timer is still set, leaving every domain
+            #             watched later without a poller
+            try:
+                self._check(name)
+            except Exception:
+                LOG.exception(_('instance %s: failed to check its state, '
+                                'will retry'), name)
+        if not self.watched and self._timer:
+            self._timer.stop()
+            self._timer = None
+
+    def _check(self, name):
+        watched = self.watched[name]
+        try:
+            state = self.get_state(name)
+        except Exception:
+            LOG.exception(_('instance %(name)s: failed to %(label)s')
+                          % {'name': name, 'label': watched['label']})
+            state_journal.set_state(watched['id'], power_state.SHUTDOWN)
+            del self.watched[name]
+            watched['done'].send(False)
+            return
+        if state != watched['state']:
+            state_journal.set_state(watched['id'], state)
+            watched['state'] = state
+        if state == power_state.RUNNING:
+            LOG.debug(_('instance %(name)s: %(label)s done')
+                      % {'name': name, 'label': watched['label']})
+            del self.watched[name]
+            watched['done'].send(True)
+
+
+def record_stages(instance_id, timings):
+    """Adds the duration of each spawn stage to the instance's actions."""
+    admin_context = context.get_admin_context()
+    for name, seconds in timings:
+        LOG.debug(_('instance %(instance_id)s: stage %(name)s took '
+                    '%(seconds).3fs') % locals())
+        db.instance_action_create(admin_context,
+                                  {'instance_id': instance_id,
+                                   'action': 'spawn.%s %.3fs' % (name,
+                                                                 seconds)})
+
+
 def _late_load_cheetah():
     global Template
     if Template is None:
@@ -125,6 +334,37 @@ def _late_load_cheetah():
         Template = t.Template
 
 
+class TemplateCache(object):
+    """Templates read and compiled once, reloaded when their file changes.
+
+    Keeps one entry per path, compiled by the function given on first
+    use.  Checking for changes costs a stat() per lookup.
+    """
+
+    def __init__(self):
+        self._templates = {}
+
+    def get(self, path, compile_fn=None):
+        mtime = os.stat(path).st_mtime
+        cached = self._templates.get(path)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        LOG.debug(_('Loading template %s'), path)
+        with open(path) as f:
+            template = f.read()
+        if compile_fn:
+            template = compile_fn(template)
+        self._templates[path] = (mtime, template)
+        return template
+
+
+_templates = TemplateCache()
+
+
+def _compile_cheetah(source):
+    return Template.compile(source=source)
+
+
 def _get_net_and_mask(cidr):
     net = IPy.IP(cidr)
     return str(net.net()), str(net.netmask())
@@ -145,27 +385,47 @@ class LibvirtConnection(object):
     def __init__(self, read_only):
         self.libvirt_uri = self.get_uri()
 
-        self.libvirt_xml = open(FLAGS.libvirt_xml_template).read()
         self._wrapped_conn = None
+        self._last_check = 0
+        self._conn_suspect = False
+        self._reconnect_backoff = 0
+        self._next_connect = 0
         self.read_only = read_only
+        # NOTE(vish): processes without an eventlet hub, such as
+        #             nova-instancemonitor, call libvirt from their own
+        #             native threads and turn this off
+        self.use_tpool = True
 
         fw_class = utils.import_class(FLAGS.firewall_driver)
         self.firewall_driver = fw_class(get_connection=self._get_connection)
+        self.image_cache = image_cache.ImageCache(
+                os.path.join(FLAGS.instances_path, '_base'))
+        # NOTE(vish): downloads are limited by the image cache, this limits
+        #             the local disk work that follows them
+        self._disk_semaphore = semaphore.Semaphore(
+                FLAGS.max_concurrent_disk_preps)
+        self.state_watcher = DomainStateWatcher(
+                lambda name: self.get_info(name)['state'])
 
     def init_host(self, host):
         # Adopt existing VM's running here
         ctxt = context.get_admin_context()
-        for instance in db.instance_get_all_by_host(ctxt, host):
-            try:
-                LOG.debug(_('Checking state of %s'), instance['name'])
-                state = self.get_info(instance['name'])['state']
-            except exception.NotFound:
-                state = power_state.SHUTOFF
-
+        instances = db.instance_get_all_by_host(ctxt, host)
+        infos = self.get_all_info()
+        states = {}
+        for instance in instances:
+            state = power_state.SHUTOFF
+            if instance['name'] in infos:
+                state = infos[instance['name']]['state']
             LOG.debug(_('Current state of %(name)s was %(state)s.'),
                           {'name': instance['name'], 'state': state})
-            db.instance_set_state(ctxt, instance['id'], state)
+            if state != instance['state']:
+                states[instance['id']] = state
+        db.instance_set_states(ctxt, states)
 
+        running = []
+        for instance in instances:
+            state = states.get(instance['id'], instance['state'])
             if state == power_state.SHUTOFF:
                 # TODO(soren): This is what the compute manager does when you
                 # terminate # an instance. At some point I figure we'll have a
@@ -173,30 +433,95 @@ class LibvirtConnection(object):
                 # occasionally, cleaning them out.
                 db.instance_destroy(ctxt, instance['id'])
 
-            if state != power_state.RUNNING:
-                continue
-            self.firewall_driver.prepare_instance_filter(instance)
+            if state == power_state.RUNNING:
+                running.append(instance)
+
+        # NOTE(vish): the filters of all the instances are prepared at once,
+        #             so iptables is rewritten once rather than once for
+        #             every instance
+        start = time.time()
+        self.firewall_driver.prepare_instance_filters(running)
+        for instance in running:
             self.firewall_driver.apply_instance_filter(instance)
+        LOG.info(_('Restored the filters of %(count)d instances in '
+                   '%(seconds).3fs'),
+                 {'count': len(running), 'seconds': time.time() - start})
 
     def _get_connection(self):
-        if not self._wrapped_conn or not self._test_connection():
+        """Returns the libvirt connection, reconnecting if it broke.
+
+        The connection is only tested after a call on it failed with a
+        connection error or once every libvirt_health_check_interval
+        seconds.  Failed reconnects are retried with exponential backoff
+        up to libvirt_reconnect_max_backoff seconds; until then callers get
+        an error straight away.
+        """
+        now = time.time()
+        if self._wrapped_conn and (self._conn_suspect or
+                                   now - self._last_check >=
+                                   FLAGS.libvirt_health_check_interval):
+            self._last_check = now
+            if not self._test_connection():
+                self._wrapped_conn = None
+            self._conn_suspect = False
+        if not self._wrapped_conn:
+            if now < self._next_connect:
+                raise exception.Error(_('Not connected to libvirt, next '
+                                        'attempt in %ds')
+                                      % (self._next_connect - now))
             LOG.debug(_('Connecting to libvirt: %s'), self.libvirt_uri)
-            self._wrapped_conn = self._connect(self.libvirt_uri,
-                                               self.read_only)
+            try:
+                conn = self._connect(self.libvirt_uri, self.read_only)
+            except Exception:
+                self._reconnect_backoff = min(
+                        max(self._reconnect_backoff * 2, 1),
+                        FLAGS.libvirt_reconnect_max_backoff)
+                self._next_connect = now + self._reconnect_backoff
+                raise
+            self._reconnect_backoff = 0
+            self._last_check = now
+            if self.use_tpool:
+                self._wrapped_conn = LibvirtProxy(conn,
+                                                  self._connection_failed)
+                self._register_domain_events(self._wrapped_conn)
+            else:
+                self._wrapped_conn = conn
         return self._wrapped_conn
     _conn = property(_get_connection)
 
+    def _connection_failed(self):
+        self._conn_suspect = True
+
     def _test_connection(self):
         try:
             self._wrapped_conn.getInfo()
             return True
         except libvirt.libvirtError as e:
-            if e.get_error_code() == libvirt.VIR_ERR_SYSTEM_ERROR and \
-               e.get_error_domain() == libvirt.VIR_FROM_REMOTE:
+            if _is_connection_error(e):
                 LOG.debug(_('Connection to libvirt broke'))
                 return False
             raise
 
+    def _register_domain_events(self, conn):
+        """Subscribes the state watcher to conn's lifecycle events."""
+        self.state_watcher.use_events = False
+        if not (FLAGS.libvirt_use_events and
+                hasattr(libvirt, 'virEventRegisterDefaultImpl')):
+            return
+
+        def _lifecycle(_conn, dom, _event, _detail, _opaque):
+            self.state_watcher.domain_event(dom.name())
+
+        try:
+            conn.domainEventRegisterAny(None,
+                                        libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+                                        _lifecycle,
+                                        None)
+            self.state_watcher.use_events = True
+        except Exception:
+            LOG.warn(_('Libvirt lifecycle events are not available, '
+                       'polling domain states instead'))
+
     def get_uri(self):
         if FLAGS.libvirt_type == 'uml':
             uri = FLAGS.libvirt_uri or 'uml:///system'
@@ -212,9 +537,12 @@ class LibvirtConnection(object):
                 None]
 
         if read_only:
-            return libvirt.openReadOnly(uri)
+            call = (libvirt.openReadOnly, uri)
         else:
-            return libvirt.openAuth(uri, auth, 0)
+            call = (libvirt.openAuth, uri, auth, 0)
+        if not self.use_tpool:
+            return call[0](*call[1:])
+        return tpool.execute(*call)
 
     def list_instances(self):
         return [self._conn.lookupByID(x).name()
@@ -230,19 +558,18 @@ class LibvirtConnection(object):
 
         # We'll save this for when we do shutdown,
         # instead of destroy - but destroy returns immediately
-        timer = utils.LoopingCall(f=None)
-
+        last_state = None
         while True:
             try:
                 state = self.get_info(instance['name'])['state']
-                db.instance_set_state(context.get_admin_context(),
-                                      instance['id'], state)
+                if state != last_state:
+                    state_journal.set_state(instance['id'], state)
+                    last_state = state
                 if state == power_state.SHUTDOWN:
                     break
             except Exception:
-                db.instance_set_state(context.get_admin_context(),
-                                      instance['id'],
-                                      power_state.SHUTDOWN)
+                state_journal.set_state(instance['id'],
+                                        power_state.SHUTDOWN)
                 break
 
         self.firewall_driver.unfilter_instance(instance)
@@ -325,25 +652,7 @@ class LibvirtConnection(object):
         self.destroy(instance, False)
         xml = self.to_xml(instance)
         self._conn.createXML(xml, 0)
-        timer = utils.LoopingCall(f=None)
-
-        def _wait_for_reboot():
-            try:
-                state = self.get_info(instance['name'])['state']
-                db.instance_set_state(context.get_admin_context(),
-                                      instance['id'], state)
-                if state == power_state.RUNNING:
-                    LOG.debug(_('instance %s: rebooted'), instance['name'])
-                    timer.stop()
-            except Exception, exn:
-                LOG.exception(_('_wait_for_reboot failed: %s'), exn)
-                db.instance_set_state(context.get_admin_context(),
-                                      instance['id'],
-                                      power_state.SHUTDOWN)
-                timer.stop()
-
-        timer.f = _wait_for_reboot
-        return timer.start(interval=0.5, now=True)
+        return self.state_watcher.watch(instance, 'reboot')
 
     @exception.wrap_exception
     def pause(self, instance, callback):
@@ -371,25 +680,7 @@ class LibvirtConnection(object):
                          'ramdisk_id': FLAGS.rescue_ramdisk_id}
         self._create_image(instance, xml, '.rescue', rescue_images)
         self._conn.createXML(xml, 0)
-
-        timer = utils.LoopingCall(f=None)
-
-        def _wait_for_rescue():
-            try:
-                state = self.get_info(instance['name'])['state']
-                db.instance_set_state(None, instance['id'], state)
-                if state == power_state.RUNNING:
-                    LOG.debug(_('instance %s: rescued'), instance['name'])
-                    timer.stop()
-            except Exception, exn:
-                LOG.exception(_('_wait_for_rescue failed: %s'), exn)
-                db.instance_set_state(None,
-                                      instance['id'],
-                                      power_state.SHUTDOWN)
-                timer.stop()
-
-        timer.f = _wait_for_rescue
-        return timer.start(interval=0.5, now=True)
+        return self.state_watcher.watch(instance, 'rescue')
 
     @exception.wrap_exception
     def unrescue(self, instance):
@@ -400,37 +691,21 @@ class LibvirtConnection(object):
     @exception.wrap_exception
     def spawn(self, instance):
         xml = self.to_xml(instance)
-        db.instance_set_state(context.get_admin_context(),
-                              instance['id'],
-                              power_state.NOSTATE,
-                              'launching')
-        self.firewall_driver.setup_basic_filtering(instance)
-        self.firewall_driver.prepare_instance_filter(instance)
-        self._create_image(instance, xml)
+        state_journal.set_state(instance['id'], power_state.NOSTATE,
+                                'launching')
+
+        def _prepare_filter():
+            self.firewall_driver.setup_basic_filtering(instance)
+            self.firewall_driver.prepare_instance_filter(instance)
+
+        self._create_image(instance, xml,
+                           extra_stages=[('filter', _prepare_filter)])
+        start = time.time()
         self._conn.createXML(xml, 0)
+        record_stages(instance['id'], [('boot', time.time() - start)])
         LOG.debug(_("instance %s: is running"), instance['name'])
         self.firewall_driver.apply_instance_filter(instance)
-
-        timer = utils.LoopingCall(f=None)
-
-        def _wait_for_boot():
-            try:
-                state = self.get_info(instance['name'])['state']
-                db.instance_set_state(context.get_admin_context(),
-                                      instance['id'], state)
-                if state == power_state.RUNNING:
-                    LOG.debug(_('instance %s: booted'), instance['name'])
-                    timer.stop()
-            except:
-                LOG.exception(_('instance %s: failed to boot'),
-                              instance['name'])
-                db.instance_set_state(context.get_admin_context(),
-                                      instance['id'],
-                                      power_state.SHUTDOWN)
-                timer.stop()
-
-        timer.f = _wait_for_boot
-        return timer.start(interval=0.5, now=True)
+        return self.state_watcher.watch(instance, 'boot')
 
     def _flush_xen_console(self, virsh_output):
         LOG.info(_('virsh said: %r'), virsh_output)
@@ -444,35 +719,25 @@ class LibvirtConnection(object):
         else:
             return ''
 
-    def _append_to_file(self, data, fpath):
-        LOG.info(_('data: %(data)r, fpath: %(fpath)r') % locals())
-        fp = open(fpath, 'a+')
-        fp.write(data)
-        return fpath
-
-    def _dump_file(self, fpath):
-        fp = open(fpath, 'r+')
-        contents = fp.read()
-        LOG.info(_('Contents of file %(fpath)s: %(contents)r') % locals())
-        return contents
-
     @exception.wrap_exception
-    def get_console_output(self, instance):
-        console_log = os.path.join(FLAGS.instances_path, instance['name'],
-                                   'console.log')
-
-        utils.execute('sudo chown %d %s' % (os.getuid(), console_log))
+    def get_console_output(self, instance, since_offset=None, max_bytes=None):
+        basepath = os.path.join(FLAGS.instances_path, instance['name'])
 
         if FLAGS.libvirt_type == 'xen':
             # Xen is special
             virsh_output = utils.execute("virsh ttyconsole %s" %
                                          instance['name'])
             data = self._flush_xen_console(virsh_output)
-            fpath = self._append_to_file(data, console_log)
-        else:
-            fpath = console_log
+            ring = console_log.RingFile(os.path.join(basepath,
+                                                     'console.ring'))
+            ring.append(data)
+            return ring.read(since_offset, max_bytes)
 
-        return self._dump_file(fpath)
+        # NOTE(vish): qemu writes console.log itself, so it is read in place
+        console_log_path = os.path.join(basepath, 'console.log')
+        utils.execute('sudo chown %d %s' % (os.getuid(), console_log_path))
+        return console_log.read_file(console_log_path, since_offset,
+                                     max_bytes)
 
     @exception.wrap_exception
     def get_ajax_console(self, instance):
@@ -524,20 +789,52 @@ class LibvirtConnection(object):
         to be unique to a given image.
 
         If cow is True, it will make a CoW image instead of a copy.
+
+        Concurrent requests for the same base image share a single fetch,
+        see nova.virt.image_cache.
         """
         if not os.path.exists(target):
-            base_dir = os.path.join(FLAGS.instances_path, '_base')
-            if not os.path.exists(base_dir):
-                os.mkdir(base_dir)
-            base = os.path.join(base_dir, fname)
-            if not os.path.exists(base):
-                fn(target=base, *args, **kwargs)
-            if cow:
-                utils.execute('qemu-img create -f qcow2 -o '
-                              'cluster_size=2M,backing_file=%s %s'
-                              % (base, target))
-            else:
-                utils.execute('cp %s %s' % (base, target))
+            base = self.image_cache.fetch(fname, fn, *args, **kwargs)
+            with self._disk_semaphore:
+                if cow:
+                    utils.execute('qemu-img create -f qcow2 -o '
+                                  'cluster_size=2M,backing_file=%s %s'
+                                  % (base, target))
+                else:
+                    utils.execute('cp %s %s' % (base, target))
+
+    def prefetch_image(self, context, image_id, kernel_id=None,
+                       ramdisk_id=None):
+        """Puts the images an instance of image_id needs into the cache.
+
+        The root image is prepared the way _create_image needs it for
+        every instance type but m1.tiny, already extended to
+        minimum_root_size.
+        """
+        user = manager.AuthManager().get_user(context.user_id)
+        project = manager.AuthManager().get_project(context.project_id)
+        for disk_id in (kernel_id, ramdisk_id):
+            if disk_id:
+                self.image_cache.fetch(disk_id,
+                                       self._fetch_image,
+                                       image_id=disk_id,
+                                       user=user,
+                                       project=project)
+        self.image_cache.fetch(image_id,
+                               self._fetch_image,
+                               image_id=image_id,
+                               user=user,
+                               project=project,
+                               size=FLAGS.minimum_root_size)
+
+    def manage_image_cache(self, context):
+        """Evicts unused base images once the cache is over its budget."""
+        if FLAGS.image_cache_max_bytes:
+            self.image_cache.evict(FLAGS.image_cache_max_bytes,
+                                   FLAGS.instances_path)
+        LOG.debug(_('Base image cache: %(bytes)d bytes in %(images)d '
+                    'images, hit ratio %(hit_ratio).2f')
+                  % self.image_cache.stats())
 
     def _fetch_image(self, target, image_id, user, project, size=None):
         """Grab image and optionally attempt to resize it"""
@@ -550,24 +847,21 @@ class LibvirtConnection(object):
         utils.execute('truncate %s -s %dG' % (target, local_gb))
         # TODO(vish): should we format disk by default?
 
-    def _create_image(self, inst, libvirt_xml, suffix='', disk_images=None):
-        # syntactic nicety
-        def basepath(fname='', suffix=suffix):
-            return os.path.join(FLAGS.instances_path,
-                                inst['name'],
-                                fname + suffix)
+    def _image_stages(self, inst, suffix='', disk_images=None):
+        """Returns (name, function) pairs that create the disks of inst.
 
-        # ensure directories exist and are writable
-        utils.execute('mkdir -p %s' % basepath(suffix=''))
-
-        LOG.info(_('instance %s: Creating image'), inst['name'])
-        f = open(basepath('libvirt.xml'), 'w')
-        f.write(libvirt_xml)
-        f.close()
+        Disks that already exist are left out.  The stages do not depend on
+        each other and can run concurrently.
+        """
+        stages = []
 
-        # NOTE(vish): No need add the suffix to console.log
-        os.close(os.open(basepath('console.log', ''),
-                         os.O_CREAT | os.O_WRONLY, 0660))
+        def add_stage(name, **kwargs):
+            target = os.path.join(FLAGS.instances_path, inst['name'],
+                                  name + suffix)
+            if not os.path.exists(target):
+                stages.append((name, functools.partial(self._cache_image,
+                                                        target=target,
+                                                        **kwargs)))
 
         user = manager.AuthManager().get_user(inst['user_id'])
         project = manager.AuthManager().get_project(inst['project_id'])
@@ -578,19 +872,19 @@ class LibvirtConnection(object):
                            'ramdisk_id': inst['ramdisk_id']}
 
         if disk_images['kernel_id']:
-            self._cache_image(fn=self._fetch_image,
-                              target=basepath('kernel'),
-                              fname=disk_images['kernel_id'],
-                              image_id=disk_images['kernel_id'],
-                              user=user,
-                              project=project)
+            add_stage('kernel',
+                      fn=self._fetch_image,
+                      fname=disk_images['kernel_id'],
+                      image_id=disk_images['kernel_id'],
+                      user=user,
+                      project=project)
             if disk_images['ramdisk_id']:
-                self._cache_image(fn=self._fetch_image,
-                                  target=basepath('ramdisk'),
-                                  fname=disk_images['ramdisk_id'],
-                                  image_id=disk_images['ramdisk_id'],
-                                  user=user,
-                                  project=project)
+                add_stage('ramdisk',
+                          fn=self._fetch_image,
+                          fname=disk_images['ramdisk_id'],
+                          image_id=disk_images['ramdisk_id'],
+                          user=user,
+                          project=project)
 
         root_fname = disk_images['image_id']
         size = FLAGS.minimum_root_size
@@ -598,22 +892,60 @@ class LibvirtConnection(object):
             size = None
             root_fname += "_sm"
 
-        self._cache_image(fn=self._fetch_image,
-                          target=basepath('disk'),
-                          fname=root_fname,
-                          cow=FLAGS.use_cow_images,
-                          image_id=disk_images['image_id'],
-                          user=user,
-                          project=project,
-                          size=size)
+        add_stage('disk',
+                  fn=self._fetch_image,
+                  fname=root_fname,
+                  cow=FLAGS.use_cow_images,
+                  image_id=disk_images['image_id'],
+                  user=user,
+                  project=project,
+                  size=size)
         type_data = instance_types.INSTANCE_TYPES[inst['instance_type']]
 
         if type_data['local_gb']:
-            self._cache_image(fn=self._create_local,
-                              target=basepath('disk.local'),
-                              fname="local_%s" % type_data['local_gb'],
-                              cow=FLAGS.use_cow_images,
-                              local_gb=type_data['local_gb'])
+            add_stage('disk.local',
+                      fn=self._create_local,
+                      fname="local_%s" % type_data['local_gb'],
+                      cow=FLAGS.use_cow_images,
+                      local_gb=type_data['local_gb'])
+        return stages
+
+    def prepare_images(self, instance):
+        """Creates the disks of instance ahead of spawn.
+
+        Run by the compute manager while the instance's network is being
+        allocated; spawn then finds the disks in place.
+        """
+        utils.execute('mkdir -p %s' % os.path.join(FLAGS.instances_path,
+                                                   instance['name']))
+        stages = self._image_stages(instance)
+        if stages:
+            record_stages(instance['id'], utils.run_stages(stages))
+
+    def _create_image(self, inst, libvirt_xml, suffix='', disk_images=None,
+                      extra_stages=None):
+        # syntactic nicety
+        def basepath(fname='', suffix=suffix):
+            return os.path.join(FLAGS.instances_path,
+                                inst['name'],
+                                fname + suffix)
+
+        # ensure directories exist and are writable
+        utils.execute('mkdir -p %s' % basepath(suffix=''))
+
+        LOG.info(_('instance %s: Creating image'), inst['name'])
+        f = open(basepath('libvirt.xml'), 'w')
+        f.write(libvirt_xml)
+        f.close()
+
+        # NOTE(vish): No need add the suffix to console.log
+        os.close(os.open(basepath('console.log', ''),
+                         os.O_CREAT | os.O_WRONLY, 0660))
+
+        stages = self._image_stages(inst, suffix, disk_images)
+        stages += extra_stages or []
+        if stages:
+            record_stages(inst['id'], utils.run_stages(stages))
 
         # For now, we assume that if we're not using a kernel, we're using a
         # partitioned disk image where the target partition is the first
@@ -632,14 +964,19 @@ class LibvirtConnection(object):
             ra_server = network_ref['ra_server']
             if not ra_server:
                 ra_server = "fd00::"
-            with open(FLAGS.injected_network_template) as f:
-                net = f.read() % {'address': address,
-                                  'netmask': network_ref['netmask'],
-                                  'gateway': network_ref['gateway'],
-                                  'broadcast': network_ref['broadcast'],
-                                  'dns': network_ref['dns'],
-                                  'ra_server': ra_server}
-        if key or net:
+            template = _templates.get(FLAGS.injected_network_template)
+            net = template % {'address': address,
+                              'netmask': network_ref['netmask'],
+                              'gateway': network_ref['gateway'],
+                              'broadcast': network_ref['broadcast'],
+                              'dns': network_ref['dns'],
+                              'ra_server': ra_server}
+        if FLAGS.use_config_drive:
+            start = time.time()
+            self._write_config_drive(inst, basepath('disk.config'), key, net)
+            record_stages(inst['id'], [('config_drive', time.time() - start)])
+        elif key or net:
+            start = time.time()
             inst_name = inst['name']
             img_id = inst.image_id
             if key:
@@ -649,19 +986,40 @@ class LibvirtConnection(object):
                 LOG.info(_('instance %(inst_name)s: injecting net into'
                         ' image %(img_id)s') % locals())
             try:
-                disk.inject_data(basepath('disk'), key, net,
-                                 partition=target_partition,
-                                 nbd=FLAGS.use_cow_images)
+                with self._disk_semaphore:
+                    disk.inject_data(basepath('disk'), key, net,
+                                     partition=target_partition,
+                                     nbd=FLAGS.use_cow_images)
             except Exception as e:
                 # This could be a windows image, or a vmdk format disk
                 LOG.warn(_('instance %(inst_name)s: ignoring error injecting'
                         ' data into image %(img_id)s (%(e)s)') % locals())
+            record_stages(inst['id'], [('inject', time.time() - start)])
 
         if FLAGS.libvirt_type == 'uml':
             utils.execute('sudo chown root %s' % basepath('disk'))
 
+    def _write_config_drive(self, inst, target, key, net):
+        """Writes the config drive of inst to target.
+
+        Holds the files that would otherwise be injected into the root
+        disk, plus the instance's user data and a little metadata.
+        """
+        files = {'meta_data.json': utils.dumps(
+                     {'instance_id': inst['name'],
+                      'hostname': inst['hostname'],
+                      'launch_index': inst['launch_index'],
+                      'reservation_id': inst['reservation_id']})}
+        if key:
+            files['authorized_keys'] = key.strip() + '\n'
+        if net:
+            files['interfaces'] = net
+        if inst['user_data']:
+            files['user_data'] = base64.b64decode(inst['user_data'])
+        LOG.info(_('instance %s: writing config drive'), inst['name'])
+        configdrive.write(target, files)
+
     def to_xml(self, instance, rescue=False):
-        # TODO(termie): cache?
         LOG.debug(_('instance %s: starting toXML method'), instance['name'])
         network = db.network_get_by_instance(context.get_admin_context(),
                                              instance['id'])
@@ -715,6 +1073,7 @@ class LibvirtConnection(object):
                     'extra_params': extra_params,
                     'rescue': rescue,
                     'local': instance_type['local_gb'],
+                    'config_drive': FLAGS.use_config_drive,
                     'driver_type': driver_type}
 
         if ra_server:
@@ -728,7 +1087,9 @@ class LibvirtConnection(object):
 
             xml_info['disk'] = xml_info['basepath'] + "/disk"
 
-        xml = str(Template(self.libvirt_xml, searchList=[xml_info]))
+        template = _templates.get(FLAGS.libvirt_xml_template,
+                                  _compile_cheetah)
+        xml = str(template(searchList=[xml_info]))
         LOG.debug(_('instance %s: finished toXML method'),
                         instance['name'])
 
@@ -747,16 +1108,44 @@ class LibvirtConnection(object):
                 'num_cpu': num_cpu,
                 'cpu_time': cpu_time}
 
+    def get_all_info(self):
+        """Returns get_info for every domain, keyed by name.
+
+        Running domains are listed by id and defined but inactive ones by
+        name, so this costs one lookup and one info() per domain rather
+        than a lookupByName for every instance the database knows about.
+        """
+        infos = {}
+        conn = self._conn
+        lookups = [(conn.lookupByID, domain_id)
+                   for domain_id in conn.listDomainsID()]
+        lookups += [(conn.lookupByName, name)
+                    for name in conn.listDefinedDomains()]
+        for lookup, key in lookups:
+            try:
+                virt_dom = lookup(key)
+                (state, max_mem, mem, num_cpu, cpu_time) = virt_dom.info()
+            except libvirt.libvirtError:
+                # NOTE(vish): the domain went away since it was listed
+                continue
+            infos[virt_dom.name()] = {'state': state,
+                                      'max_mem': max_mem,
+                                      'mem': mem,
+                                      'num_cpu': num_cpu,
+                                      'cpu_time': cpu_time}
+        return infos
+
     def get_diagnostics(self, instance_name):
         raise exception.APIError(_("diagnostics are not supported "
                                    "for libvirt"))
 
-    def get_disks(self, instance_name):
+    def get_devices(self, instance_name):
         """
         Note that this function takes an instance name, not an Instance, so
         that it can be called by monitor.
 
-        Returns a list of all block devices for this domain.
+        Returns the block devices and the network interfaces of this domain
+        as a dict of lists, parsing its XML once.
         """
         domain = self._conn.lookupByName(instance_name)
         # TODO(devcamcar): Replace libxml2 with etree.
@@ -766,74 +1155,69 @@ class LibvirtConnection(object):
         try:
             doc = libxml2.parseDoc(xml)
         except:
-            return []
+            return {'disks': [], 'interfaces': []}
 
         ctx = doc.xpathNewContext()
-        disks = []
+        devices = {}
 
         try:
-            ret = ctx.xpathEval('/domain/devices/disk')
-
-            for node in ret:
-                devdst = None
+            for kind, path in (('disks', '/domain/devices/disk'),
+                               ('interfaces', '/domain/devices/interface')):
+                devices[kind] = []
+                for node in ctx.xpathEval(path):
+                    devdst = None
 
-                for child in node.children:
-                    if child.name == 'target':
-                        devdst = child.prop('dev')
+                    for child in node.children:
+                        if child.name == 'target':
+                            devdst = child.prop('dev')
 
-                if devdst == None:
-                    continue
+                    if devdst == None:
+                        continue
 
-                disks.append(devdst)
+                    devices[kind].append(devdst)
         finally:
             if ctx != None:
                 ctx.xpathFreeContext()
             if doc != None:
                 doc.freeDoc()
 
-        return disks
+        return devices
 
-    def get_interfaces(self, instance_name):
+    def get_disks(self, instance_name):
         """
         Note that this function takes an instance name, not an Instance, so
         that it can be called by monitor.
 
-        Returns a list of all network interfaces for this instance.
+        Returns a list of all block devices for this domain.
         """
-        domain = self._conn.lookupByName(instance_name)
-        # TODO(devcamcar): Replace libxml2 with etree.
-        xml = domain.XMLDesc(0)
-        doc = None
-
-        try:
-            doc = libxml2.parseDoc(xml)
-        except:
-            return []
-
-        ctx = doc.xpathNewContext()
-        interfaces = []
-
-        try:
-            ret = ctx.xpathEval('/domain/devices/interface')
-
-            for node in ret:
-                devdst = None
+        return self.get_devices(instance_name)['disks']
 
-                for child in node.children:
-                    if child.name == 'target':
-                        devdst = child.prop('dev')
+    def get_interfaces(self, instance_name):
+        """
+        Note that this function takes an instance name, not an Instance, so
+        that it can be called by monitor.
 
-                if devdst == None:
-                    continue
+        Returns a list of all network interfaces for this instance.
+        """
+        return self.get_devices(instance_name)['interfaces']
 
-                interfaces.append(devdst)
-        finally:
-            if ctx != None:
-                ctx.xpathFreeContext()
-            if doc != None:
-                doc.freeDoc()
+    def get_instance_stats(self, instance_name, disks, interfaces):
+        """
+        Note that this function takes an instance name, not an Instance, so
+        that it can be called by monitor.
 
-        return interfaces
+        Returns the cpu counters of this domain along with the counters of
+        the given disks and interfaces, looking the domain up once.
+        """
+        domain = self._conn.lookupByName(instance_name)
+        (state, max_mem, mem, num_cpu, cpu_time) = domain.info()
+        return {'num_cpu': num_cpu,
+                'cpu_time': cpu_time,
+                'disks': dict((disk, domain.blockStats(disk))
+                              for disk in disks),
+                'interfaces': dict((interface,
+                                    domain.interfaceStats(interface))
+                                   for interface in interfaces)}
 
     def block_stats(self, instance_name, disk):
         """
@@ -873,6 +1257,14 @@ class FirewallDriver(object):
         At this point, the instance isn't running yet."""
         raise NotImplementedError()
 
+    def prepare_instance_filters(self, instances):
+        """Prepare filters for several instances at once.
+
+        Drivers that can set up the filters of many instances in one go
+        should override this."""
+        for instance in instances:
+            self.prepare_instance_filter(instance)
+
     def unfilter_instance(self, instance):
         """Stop filtering instance"""
         raise NotImplementedError()
@@ -1105,7 +1497,7 @@ class NWFilterFirewall(FirewallDriver):
         if callable(xml):
             xml = xml()
         # execute in a native thread and block current greenthread until done
-        tpool.execute(self._conn.nwfilterDefineXML, xml)
+        self._conn.nwfilterDefineXML(xml)
 
     def unfilter_instance(self, instance):
         # Nothing to do
@@ -1236,6 +1628,12 @@ class IptablesFirewallDriver(FirewallDriver):
         self.add_instance(instance)
         self.apply_ruleset()
 
+    def prepare_instance_filters(self, instances):
+        for instance in instances:
+            self.add_instance(instance)
+        if instances:
+            self.apply_ruleset()
+
     def apply_ruleset(self):
         current_filter, _ = self.execute('sudo iptables-save -t filter')
         current_lines = current_filter.split('\n')
@@ -34,6 +34,8 @@ from nova import utils
 
 from nova.auth.manager import AuthManager
 from nova.compute import power_state
+from nova.compute import state_journal
+from nova.virt import console_log
 from nova.virt.xenapi.network_utils import NetworkHelper
 from nova.virt.xenapi.vm_utils import VMHelper
 from nova.virt.xenapi.vm_utils import ImageType
@@ -72,9 +74,8 @@ class VMOps(object):
                 name = instance['name']
                 LOG.exception(_('instance %(name)s: not enough free memory')
                               % locals())
-                db.instance_set_state(context.get_admin_context(),
-                                      instance['id'],
-                                      power_state.SHUTDOWN)
+                state_journal.set_state(instance['id'],
+                                        power_state.SHUTDOWN)
                 return
 
         user = AuthManager().get_user(instance.user_id)
@@ -174,8 +175,7 @@ class VMOps(object):
         def _wait_for_boot():
             try:
                 state = self.get_info(instance['name'])['state']
-                db.instance_set_state(context.get_admin_context(),
-                                      instance['id'], state)
+                state_journal.set_state(instance['id'], state)
                 if state == power_state.RUNNING:
                     LOG.debug(_('Instance %s: booted'), instance['name'])
                     timer.stop()
@@ -185,9 +185,8 @@ class VMOps(object):
                 LOG.warn(exc)
                 LOG.exception(_('instance %s: failed to boot'),
                               instance['name'])
-                db.instance_set_state(context.get_admin_context(),
-                                      instance['id'],
-                                      power_state.SHUTDOWN)
+                state_journal.set_state(instance['id'],
+                                        power_state.SHUTDOWN)
                 timer.stop()
                 return False
 
@@ -467,16 +466,26 @@ class VMOps(object):
         rec = self._session.get_xenapi().VM.get_record(vm)
         return VMHelper.compile_info(rec)
 
+    def get_all_info(self):
+        """Return data about every VM instance, keyed by name"""
+        infos = {}
+        records = self._session.get_xenapi().VM.get_all_records()
+        for rec in records.itervalues():
+            if not rec["is_a_template"] and not rec["is_control_domain"]:
+                infos[rec["name_label"]] = VMHelper.compile_info(rec)
+        return infos
+
     def get_diagnostics(self, instance):
         """Return data about VM diagnostics"""
         vm = self._get_vm_opaque_ref(instance)
         rec = self._session.get_xenapi().VM.get_record(vm)
         return VMHelper.compile_diagnostics(self._session, rec)
 
-    def get_console_output(self, instance):
+    def get_console_output(self, instance, since_offset=None, max_bytes=None):
         """Return snapshot of console"""
         # TODO: implement this to fix pylint!
-        return 'FAKE CONSOLE OUTPUT of instance'
+        return console_log.read_string('FAKE CONSOLE OUTPUT of instance',
+                                       since_offset, max_bytes)
 
     def get_ajax_console(self, instance):
         """Return link to instance's ajax console"""
@@ -202,18 +202,36 @@ class XenAPIConnection(object):
         """Return data about VM instance"""
         return self._vmops.get_info(instance_id)
 
+    def get_all_info(self):
+        """Return data about every VM instance, keyed by name"""
+        return self._vmops.get_all_info()
+
     def get_diagnostics(self, instance):
         """Return data about VM diagnostics"""
         return self._vmops.get_diagnostics(instance)
 
-    def get_console_output(self, instance):
+    def get_console_output(self, instance, since_offset=None, max_bytes=None):
         """Return snapshot of console"""
-        return self._vmops.get_console_output(instance)
+        return self._vmops.get_console_output(instance, since_offset,
+                                              max_bytes)
 
     def get_ajax_console(self, instance):
         """Return link to instance's ajax console"""
         return self._vmops.get_ajax_console(instance)
 
+    def prepare_images(self, instance):
+        """Disks are created from the image by spawn"""
+        pass
+
+    def prefetch_image(self, context, image_id, kernel_id=None,
+                       ramdisk_id=None):
+        """Images are fetched into the SR per instance, nothing to warm"""
+        pass
+
+    def manage_image_cache(self, context):
+        """Images live in the SR, there is no local cache to trim"""
+        pass
+
     def attach_volume(self, instance_name, device_path, mountpoint):
         """Attach volume storage to VM instance"""
         return self._volumeops.attach_volume(instance_name,